@@ -0,0 +1,132 @@
+'''Benchmark of the async handlers against the plain `def` handlers they
+replaced, at 100 to 1000 concurrent clients.
+
+Serves the app with uvicorn in a subprocess, with the response cache off so
+that every request reaches the database, next to a copy of the old listing
+handler: a `def` that Starlette runs on its worker threadpool. Each client
+sends `GET /api/treasures?limit=50` requests back to back for a fixed
+duration; the report gives throughput, p50/p99 latency and the number of
+503s shed by the async pool:
+
+    python -m benchmarks.bench_async [--concurrency 100 250 500 1000] [--duration 10]
+
+The clients share one process and event loop, so at the highest
+concurrency they can become the bottleneck; compare the two modes at the
+same concurrency rather than across rows.
+'''
+from fastapi import Request, Response
+from db.statements import statements
+from serialise import ListingFormat, encode_rows
+from main import app, Order, data_version, keyset_segments, read_connection, select_treasures_query
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+LISTING_LIMIT = 50
+
+MODES = {
+    "sync def": f"/bench/sync/treasures?limit={LISTING_LIMIT}",
+    "async def": f"/api/treasures?limit={LISTING_LIMIT}",
+}
+
+
+def sync_listing(request: Request, limit: int = LISTING_LIMIT):
+    '''The first page of the treasures listing, served as before the
+    handlers were async.'''
+    with read_connection(request) as db:
+        data_version(db)
+        predicate, order_by = keyset_segments("age", Order.asc, None)[0]
+        rows, column_names = statements.run(db, select_treasures_query(predicate, order_by), limit=limit + 1)
+    body = encode_rows("treasures", column_names, rows[:limit], ListingFormat.objects, next_cursor=None)
+    return Response(content=body, media_type="application/json")
+
+
+app.add_api_route("/bench/sync/treasures", sync_listing)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int) -> subprocess.Popen:
+    env = dict(os.environ, RESPONSE_CACHE_MAX_BYTES="0")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.bench_async:app", "--port", str(port),
+         "--log-level", "warning", "--no-access-log", "--backlog", "4096"],
+        env=env, stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/api/cache", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start within 30s")
+
+
+async def drive(base_url: str, path: str, concurrency: int, duration: float) -> dict:
+    '''Runs `concurrency` clients against `path` for `duration` seconds.'''
+    latencies, statuses = [], {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        stop_at = time.perf_counter() + duration
+
+        async def client_loop():
+            while time.perf_counter() < stop_at:
+                started = time.perf_counter()
+                try:
+                    status = (await client.get(path)).status_code
+                except httpx.TransportError:
+                    status = "error"
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "ok_per_second": statuses.get(200, 0) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "rejected": statuses.get(503, 0),
+        "failed": sum(count for status, count in statuses.items() if status not in (200, 503)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[100, 250, 500, 1000])
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    port = free_port()
+    server = start_server(port)
+    base_url = f"http://127.0.0.1:{port}"
+    print(f"{'clients':>8}  {'handler':<10}{'ok/s':>10}{'p50 (ms)':>10}{'p99 (ms)':>10}{'503s':>8}{'failed':>8}")
+    try:
+        for concurrency in args.concurrency:
+            for mode, path in MODES.items():
+                result = asyncio.run(drive(base_url, path, concurrency, args.duration))
+                print(
+                    f"{concurrency:>8}  {mode:<10}{result['ok_per_second']:>10.0f}{result['p50_ms']:>10.1f}"
+                    f"{result['p99_ms']:>10.1f}{result['rejected']:>8}{result['failed']:>8}"
+                )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+'''Benchmark of the bytes and time saved on large listings by the `fields=`
+projection and by response compression.
+
+Calls the app in-process, with the response cache off so that every request
+runs its query, and times `GET /api/treasures` to the last byte for each
+field set and content coding (brotli and zstd only when their packages are
+installed). Bytes are as sent, before the client decodes them; over a real
+network the smaller bodies also save transfer time, which this does not
+measure:
+
+    python -m benchmarks.bench_compression [--limit 1000] [--iterations 20]
+
+Seed a large dataset first (see `benchmarks/generate_data.py`) for
+realistic numbers.
+'''
+import os
+
+os.environ["RESPONSE_CACHE_MAX_BYTES"] = "0"
+
+from fastapi.testclient import TestClient
+from main import app
+from compression import COMPRESSORS
+import argparse
+import statistics
+import time
+
+FIELD_SETS = {
+    "all fields": None,
+    "treasure_id,cost_at_auction": "treasure_id,cost_at_auction",
+}
+
+
+def time_listing(client, path, accept_encoding, iterations):
+    '''Returns the median time in ms and the size of the body as sent.'''
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter_ns()
+        with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as response:
+            size = sum(len(chunk) for chunk in response.iter_raw())
+        timings.append(time.perf_counter_ns() - started)
+    return statistics.median(timings) / 1e6, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=1000, help="page size; 0 lists every treasure")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    client = TestClient(app)
+    baseline = None
+    print(f"{'fields':<30}{'encoding':<10}{'bytes':>12}{'saved':>8}{'median (ms)':>14}")
+    for label, fields in FIELD_SETS.items():
+        params = [f"limit={args.limit}"] if args.limit else []
+        params += [f"fields={fields}"] if fields else []
+        path = "/api/treasures" + ("?" + "&".join(params) if params else "")
+        for encoding in ["identity", *COMPRESSORS]:
+            median_ms, size = time_listing(client, path, encoding, args.iterations)
+            baseline = baseline or size
+            print(f"{label:<30}{encoding:<10}{size:>12,}{1 - size / baseline:>8.0%}{median_ms:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+'''Benchmark of the treasures queries on a partitioned `treasures` table
+against the plain one.
+
+Seeds the database configured in the environment from `data/<env>-data` in
+each layout in turn, finishing with the plain table, and times the queries
+the endpoints prepare, colour-filtered listings first. Writes run inside a
+transaction that is rolled back:
+
+    python -m benchmarks.bench_partitioning [--env bench] [--iterations 200]
+        [--layouts list:colour,hash:colour,hash:shop_id]
+
+Generate a large dataset first (see `benchmarks/generate_data.py`);
+partitioning only pays off once `treasures` has millions of rows.
+'''
+from db.connection import connect_to_db
+from db.shop_stock import SELECT_SHOPS
+from db.seed import seed_db
+from db.statements import StatementRegistry
+from main import (
+    Colour, Order, SortBy, TreasureFilters, keyset_segments, select_treasures_query,
+    INSERT_TREASURE, UPDATE_TREASURE_PRICE, DELETE_TREASURE,
+)
+import argparse
+import contextlib
+import io
+import statistics
+import time
+
+
+def listing(sort_by=SortBy.age, limit=50, **filters):
+    treasure_filters = TreasureFilters(**filters)
+    predicate, order_by = keyset_segments(sort_by.value, Order.asc, None)[0]
+    sql = select_treasures_query(predicate, order_by, treasure_filters.conditions())
+    return sql, {"limit": limit, **treasure_filters.params()}
+
+
+def cases():
+    yield ("colour page by age", *listing(colour=Colour.gold))
+    yield ("colour page by cost", *listing(SortBy.cost_at_auction, colour=Colour.gold))
+    yield ("colour, all rows", *listing(limit=None, colour=Colour.azure))
+    yield ("shop page by age", *listing(shop_id=[3]))
+    yield ("unfiltered page by age", *listing())
+    yield "shops", SELECT_SHOPS, {}
+    yield "insert", INSERT_TREASURE, {
+        "treasure_name": "bench", "colour": "gold", "age": 1, "cost_at_auction": 1.5, "shop_id": 1
+    }
+    yield "update price by id", UPDATE_TREASURE_PRICE, {"cost_at_auction": 9.99, "treasure_id": 1}
+    yield "delete by id", DELETE_TREASURE, {"treasure_id": -1}
+
+
+def time_layout(iterations):
+    '''Returns the median time in ms of each case on the seeded layout.'''
+    db = connect_to_db()
+    registry = StatementRegistry()
+    db.run("START TRANSACTION")
+    results = {}
+    try:
+        for name, sql, params in cases():
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter_ns()
+                registry.run(db, sql, **params)
+                timings.append(time.perf_counter_ns() - started)
+            results[name] = statistics.median(timings) / 1e6
+    finally:
+        db.run("ROLLBACK")
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--env", default="bench")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--layouts", default="list:colour,hash:colour,hash:shop_id")
+    args = parser.parse_args()
+
+    results = {}
+    # The plain layout goes last, to leave the database as it usually is.
+    for layout in [*args.layouts.split(","), ""]:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            seed_db(args.env, partition_by=layout)
+        name = layout or "plain"
+        print(f"Seeded {name} in {time.perf_counter() - started:.1f}s")
+        results[name] = time_layout(args.iterations)
+
+    plain = results.pop("plain")
+    print(f"\n{'median ms (vs plain)':<28}{'plain':>10}" + "".join(f"{layout:>23}" for layout in results))
+    for name, plain_ms in plain.items():
+        cells = "".join(
+            f"{timings[name]:>14.2f} ({plain_ms / timings[name]:>5.2f}x)" for timings in results.values()
+        )
+        print(f"{name:<28}{plain_ms:>10.2f}{cells}")
+
+
+if __name__ == "__main__":
+    main()
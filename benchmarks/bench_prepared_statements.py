@@ -0,0 +1,74 @@
+'''Micro-benchmark of the treasures queries sent as f-string SQL built with
+`pg8000.native.literal` versus prepared statements from `db.statements`.
+
+Runs against the database configured in the environment (seed it first),
+inside a transaction that is rolled back, so writes leave no trace:
+
+    python -m benchmarks.bench_prepared_statements [--iterations 2000]
+'''
+from db.connection import connect_to_db
+from db.shop_stock import SELECT_SHOPS
+from db.statements import StatementRegistry
+from main import (
+    Colour, Order, SortBy, TreasureFilters, keyset_segments, select_treasures_query,
+    INSERT_TREASURE, UPDATE_TREASURE_PRICE, DELETE_TREASURE,
+)
+from pg8000.native import literal
+import argparse
+import statistics
+import time
+import re
+
+
+def inline(sql, **params):
+    '''Builds the SQL text the handlers used to send: every placeholder
+    replaced by a literal.'''
+    return re.sub(r"(?<!:):(\w+)", lambda match: literal(params[match.group(1)]), sql)
+
+
+def time_calls(call, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter_ns()
+        call()
+        timings.append(time.perf_counter_ns() - started)
+    return statistics.median(timings) / 1000
+
+
+def cases():
+    for sort_by in SortBy:
+        for order in Order:
+            for colour in [None, Colour.gold]:
+                predicate, order_by = keyset_segments(sort_by.value, order, None)[0]
+                sql = select_treasures_query(predicate, order_by, TreasureFilters(colour=colour).conditions())
+                name = f"list {sort_by.value} {order.value}{' colour' if colour else ''}"
+                yield name, sql, {"colour": colour.value if colour else None, "limit": 50}
+    yield "insert", INSERT_TREASURE, {
+        "treasure_name": "bench", "colour": "gold", "age": 1, "cost_at_auction": 1.5, "shop_id": 1
+    }
+    yield "update price", UPDATE_TREASURE_PRICE, {"cost_at_auction": 9.99, "treasure_id": 1}
+    yield "delete", DELETE_TREASURE, {"treasure_id": -1}
+    yield "shops", SELECT_SHOPS, {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    db = connect_to_db()
+    registry = StatementRegistry()
+    db.run("START TRANSACTION")
+    print(f"{'query':<36}{'literal SQL (us)':>18}{'prepared (us)':>16}{'speed-up':>10}")
+    try:
+        for name, sql, params in cases():
+            literal_us = time_calls(lambda: db.run(inline(sql, **params)), args.iterations)
+            prepared_us = time_calls(lambda: registry.run(db, sql, **params), args.iterations)
+            print(f"{name:<36}{literal_us:>18.1f}{prepared_us:>16.1f}{literal_us / prepared_us:>9.2f}x")
+    finally:
+        db.run("ROLLBACK")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+'''Benchmark of `GET /api/treasures/search` as `treasures` grows, against
+the unindexed substring scan that clients effectively did before.
+
+Tops `treasures` up to each size with synthetic names, inside a transaction
+that is rolled back, and times the search query through the full-text index
+and an `ILIKE '%...%'` scan for the same words. The scan grows with the
+table; the indexed search grows with the number of matches, which it has to
+rank, so selective queries stay nearly flat:
+
+    python -m benchmarks.bench_search [--sizes 10000 100000 1000000]
+'''
+from db.connection import connect_to_db
+from db.statements import StatementRegistry
+from main import search_treasures_query, search_tsquery, like_prefix
+import argparse
+import statistics
+import time
+
+SYNTHETIC_NAMES = """
+    'synthetic ' || (ARRAY['Antique', 'Gilded', 'Rare', 'Carved', 'Enamelled', 'Lost', 'Royal', 'Tiny'])[1 + n % 8]
+    || ' ' || (ARRAY['Teapot', 'Locket', 'Compass', 'Mirror', 'Vase', 'Clock', 'Brooch', 'Globe'])[1 + n / 8 % 8]
+    || ' ' || n
+"""
+
+SCAN_QUERY = """
+    SELECT treasures.treasure_id, treasures.treasure_name
+    FROM treasures
+    JOIN shops ON treasures.shop_id = shops.shop_id
+    WHERE treasures.treasure_name ILIKE :pattern
+    ORDER BY treasures.treasure_name, treasures.treasure_id
+    LIMIT :limit
+"""
+
+
+def time_calls(call, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter_ns()
+        call()
+        timings.append(time.perf_counter_ns() - started)
+    return statistics.median(timings) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--queries", nargs="+", default=["gilded compass 4242", "royal globe", "lost"])
+    args = parser.parse_args()
+
+    db = connect_to_db()
+    registry = StatementRegistry()
+    db.run("START TRANSACTION")
+    print(f"{'rows':>10}  {'query':<24}{'indexed (ms)':>14}{'ILIKE scan (ms)':>18}")
+    try:
+        for size in sorted(args.sizes):
+            db.run(f"""
+                INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
+                SELECT {SYNTHETIC_NAMES}, 'gold', n % 500, (n % 100000) / 100.0, 1 + n % 11
+                FROM generate_series(1, GREATEST(:size - (SELECT COUNT(*) FROM treasures), 0)) AS n
+            """, size=size)
+            db.run("ANALYZE treasures")
+            for q in args.queries:
+                params = {
+                    "tsquery": search_tsquery(q), "name": q.lower(), "name_prefix": like_prefix(q.lower()), "limit": 51
+                }
+                indexed_ms = time_calls(
+                    lambda: registry.run(db, search_treasures_query(), **params), args.iterations
+                )
+                pattern = "%" + "%".join(q.split()) + "%"
+                scan_ms = time_calls(
+                    lambda: registry.run(db, SCAN_QUERY, pattern=pattern, limit=51), args.iterations
+                )
+                print(f"{size:>10}  {q:<24}{indexed_ms:>14.2f}{scan_ms:>18.2f}")
+    finally:
+        db.run("ROLLBACK")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+'''Benchmark of the listing response encoding, without a database.
+
+Compares, for a synthetic listing of treasures rows as pg8000 returns them:
+- `fastapi`: the old path, a dict per row returned from the handler, then
+  FastAPI's `jsonable_encoder` and `JSONResponse` (standard `json`)
+- `objects`: `serialise.encode_rows` straight to bytes
+- `columns`: `serialise.encode_rows` with `?format=columns`
+
+Reports the median CPU time, the peak traced memory and the body size:
+
+    python -m benchmarks.bench_serialisation [--rows 100000] [--repeat 5]
+'''
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from serialise import ListingFormat, encode_rows, orjson
+import argparse
+import statistics
+import tracemalloc
+import time
+
+COLUMN_NAMES = ["treasure_id", "treasure_name", "colour", "age", "cost_at_auction", "shop_name"]
+COLOURS = ["turquoise", "mikado", "ivory", "onyx", "carmine", "cobalt", "magenta"]
+
+
+def synthetic_rows(count):
+    return [
+        [n, f"treasure-{n}", COLOURS[n % len(COLOURS)], n % 500, round(n % 100000 / 100, 2), f"shop-{n % 1000}"]
+        for n in range(count)
+    ]
+
+
+def fastapi_path(rows):
+    formatted_data = [dict(zip(COLUMN_NAMES, row)) for row in rows]
+    return JSONResponse(jsonable_encoder({"treasures": formatted_data, "next_cursor": None})).body
+
+
+def objects_path(rows):
+    return encode_rows("treasures", COLUMN_NAMES, rows, ListingFormat.objects, next_cursor=None)
+
+
+def columns_path(rows):
+    return encode_rows("treasures", COLUMN_NAMES, rows, ListingFormat.columns, next_cursor=None)
+
+
+def measure(encode, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.process_time()
+        body = encode(rows)
+        timings.append(time.process_time() - started)
+    tracemalloc.start()
+    encode(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.rows)
+    print(f"{args.rows} rows, encoder: {'orjson' if orjson else 'json'}")
+    print(f"{'path':<10}{'cpu (ms)':>12}{'peak memory (MiB)':>20}{'body (MiB)':>14}")
+    baseline = None
+    for name, encode in [("fastapi", fastapi_path), ("objects", objects_path), ("columns", columns_path)]:
+        cpu, peak, size = measure(encode, rows, args.repeat)
+        baseline = baseline or cpu
+        print(f"{name:<10}{cpu * 1000:>12.1f}{peak / 2**20:>20.1f}{size / 2**20:>14.1f}  ({baseline / cpu:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
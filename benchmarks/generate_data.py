@@ -0,0 +1,94 @@
+'''Generates a synthetic `shops.json` / `treasures.json` dataset in the format
+`seed_db` reads, at any scale from thousands to tens of millions of treasures.
+
+Colours and shops follow a Zipf-like distribution, so a few colours and shops
+hold most of the treasures, as in real catalogues. Output is deterministic
+for a given `--seed`, and rows are written as they are generated, so memory
+use does not depend on the size of the dataset:
+
+    python -m benchmarks.generate_data --treasures 1000000 --env bench
+    python -c "from db.seed import seed_db; seed_db('bench')"
+'''
+import argparse
+import itertools
+import json
+import os
+import random
+
+COLOURS = [
+    "turquoise", "mikado", "ivory", "onyx", "carmine", "cobalt", "magenta",
+    "gold", "azure", "silver", "khaki", "saffron", "burgundy",
+]
+ADJECTIVES = ["Antique", "Gilded", "Rare", "Carved", "Enamelled", "Lost", "Royal", "Tiny", "Ornate", "Faded"]
+NOUNS = ["Teapot", "Locket", "Compass", "Mirror", "Music Box", "Vase", "Clock", "Brooch", "Globe", "Lantern"]
+BATCH_SIZE = 10000
+
+
+def zipf_cum_weights(count, skew):
+    '''Cumulative weights for `random.choices` where the k-th value is
+    `1 / k ** skew` times as likely as the first.'''
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def write_json_array(path, key, rows):
+    '''Writes `{key: [...rows]}` one row at a time; returns the row count.'''
+    count = 0
+    with open(path, "w") as file:
+        file.write(f'{{\n  "{key}": [')
+        for row in rows:
+            file.write(",\n    " if count else "\n    ")
+            file.write(json.dumps(row))
+            count += 1
+        file.write("\n  ]\n}\n")
+    return count
+
+
+def generate_shops(count):
+    for n in range(count):
+        yield {"shop_name": f"shop-{n:07d}", "owner": f"owner-{n % 997}", "slogan": f"slogan-{n}"}
+
+
+def generate_treasures(rng, count, shop_names, skew):
+    colour_weights = zipf_cum_weights(len(COLOURS), skew)
+    shop_weights = zipf_cum_weights(len(shop_names), skew)
+    # Shuffle which shops are popular so that popularity is not tied to shop_id order.
+    shop_names = rng.sample(shop_names, len(shop_names))
+    produced = 0
+    while produced < count:
+        batch = min(BATCH_SIZE, count - produced)
+        colours = rng.choices(COLOURS, cum_weights=colour_weights, k=batch)
+        shops = rng.choices(shop_names, cum_weights=shop_weights, k=batch)
+        for colour, shop in zip(colours, shops):
+            produced += 1
+            yield {
+                "treasure_name": f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {produced}",
+                "colour": colour,
+                "age": int(rng.paretovariate(1.5) * 10) % 1000,
+                "cost_at_auction": f"{rng.lognormvariate(4, 1.5):.2f}",
+                "shop": shop,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--treasures", type=int, default=100000, help="number of treasures (default 100000)")
+    parser.add_argument("--shops", type=int, help="number of shops (default: one per 1000 treasures, at least 10)")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for colours and shops (default 1.1)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--env", default="bench", help="writes to data/<env>-data (default bench)")
+    args = parser.parse_args()
+
+    shop_count = args.shops or max(10, args.treasures // 1000)
+    directory = f"data/{args.env}-data"
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(args.seed)
+
+    shops = list(generate_shops(shop_count))
+    write_json_array(f"{directory}/shops.json", "shops", shops)
+    treasures = generate_treasures(rng, args.treasures, [shop["shop_name"] for shop in shops], args.skew)
+    treasure_count = write_json_array(f"{directory}/treasures.json", "treasures", treasures)
+    print(f"\U0001F4E6 Wrote {shop_count} shops and {treasure_count} treasures to {directory}/")
+
+
+if __name__ == "__main__":
+    main()
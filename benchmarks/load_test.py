@@ -0,0 +1,241 @@
+'''Load test of every endpoint of a running `Cat's Rare Treasures` server.
+
+Each scenario runs for a fixed duration at a fixed number of concurrent
+clients and records throughput and p50/p95/p99 latency. The JSON report
+also records the commit, the settings and the dataset size, so reports from
+different commits can be compared:
+
+    uvicorn main:app --workers 1 &
+    python -m benchmarks.load_test --concurrency 16 --duration 10 --output report.json
+    python -m benchmarks.load_test --compare baseline.json report.json
+
+Write scenarios modify the data; reseed the database between runs.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import httpx
+
+COLOURS = ["turquoise", "mikado", "ivory", "onyx", "carmine", "cobalt", "magenta",
+           "gold", "azure", "silver", "khaki", "saffron", "burgundy"]
+
+
+class Scenario:
+    '''A named request generator; `next_request(rng)` returns the
+    `(method, url, json body)` of the next request to send.'''
+
+    def __init__(self, name, next_request, expected_status=200):
+        self.name = name
+        self.next_request = next_request
+        self.expected_status = expected_status
+
+
+def build_scenarios(client, seed):
+    '''Builds the scenarios, fetching the ids and cursors they need up front.'''
+    listing = client.get("/api/treasures", params={"format": "columns"}).json()
+    treasure_ids = [row[0] for row in listing["rows"]]
+    shop_ids = [shop["shop_id"] for shop in client.get("/api/shops").json()["shops"]]
+    cursor = client.get("/api/treasures", params={"limit": 50}).json()["next_cursor"]
+    # A full name matches a handful of treasures; the first word of one, many.
+    names = [row[listing["columns"].index("treasure_name")] for row in listing["rows"]]
+    common_word = names[0].split()[0]
+    search_cursor = client.get(
+        "/api/treasures/search", params={"q": common_word, "limit": 50}
+    ).json()["next_cursor"]
+    rng = random.Random(seed)
+
+    def new_treasure(rng):
+        return {
+            "treasure_name": f"load-test-{rng.getrandbits(32)}",
+            "colour": rng.choice(COLOURS),
+            "age": rng.randrange(1000),
+            "cost_at_auction": round(rng.uniform(1, 5000), 2),
+            "shop_id": rng.choice(shop_ids),
+        }
+
+    # Treasures to delete are created up front so the delete scenarios never 404.
+    deletable = []
+    for _ in range(20):
+        created = client.post("/api/treasures/batch", json={"treasures": [new_treasure(rng) for _ in range(500)]})
+        deletable += [treasure["treasure_id"] for treasure in created.json()["treasures"]]
+    deletable_ids = iter(deletable)
+    deletable_lock = threading.Lock()
+
+    def take_ids(count):
+        with deletable_lock:
+            return list(itertools.islice(deletable_ids, count))
+
+    return [
+        Scenario("GET /api/treasures", lambda rng: ("GET", "/api/treasures", None)),
+        Scenario("GET /api/treasures sorted+colour", lambda rng: (
+            "GET", f"/api/treasures?sort_by=cost_at_auction&order=desc&colour={rng.choice(COLOURS)}", None)),
+        Scenario("GET /api/treasures limit=50", lambda rng: ("GET", "/api/treasures?limit=50", None)),
+        Scenario("GET /api/treasures limit=50 after", lambda rng: (
+            "GET", f"/api/treasures?limit=50&after={cursor}", None)),
+        Scenario("GET /api/treasures format=columns", lambda rng: ("GET", "/api/treasures?format=columns", None)),
+        Scenario("GET /api/treasures/export ndjson", lambda rng: ("GET", "/api/treasures/export?format=ndjson", None)),
+        Scenario("GET /api/treasures/export csv", lambda rng: ("GET", "/api/treasures/export?format=csv", None)),
+        Scenario("GET /api/treasures/facets", lambda rng: ("GET", "/api/treasures/facets", None)),
+        Scenario("GET /api/treasures/facets filtered", lambda rng: (
+            "GET", f"/api/treasures/facets?colour={rng.choice(COLOURS)}&max_age={rng.randrange(100, 1000)}"
+            f"&shop_id={rng.choice(shop_ids)}", None)),
+        Scenario("GET /api/treasures/search selective", lambda rng: (
+            "GET", f"/api/treasures/search?q={quote(rng.choice(names))}", None)),
+        Scenario("GET /api/treasures/search limit=50 after", lambda rng: (
+            "GET", f"/api/treasures/search?q={quote(common_word)}&limit=50"
+            + (f"&after={search_cursor}" if search_cursor else ""), None)),
+        Scenario("GET /api/shops", lambda rng: ("GET", "/api/shops", None)),
+        Scenario("GET /api/cache", lambda rng: ("GET", "/api/cache", None)),
+        Scenario("POST /api/treasures", lambda rng: ("POST", "/api/treasures", new_treasure(rng)), 201),
+        Scenario("POST /api/treasures/batch x100", lambda rng: (
+            "POST", "/api/treasures/batch", {"treasures": [new_treasure(rng) for _ in range(100)]}), 201),
+        Scenario("PATCH /api/treasures/{id}", lambda rng: (
+            "PATCH", f"/api/treasures/{rng.choice(treasure_ids)}", {"cost_at_auction": round(rng.uniform(1, 5000), 2)})),
+        Scenario("PATCH /api/treasures x100", lambda rng: ("PATCH", "/api/treasures", {"treasures": [
+            {"treasure_id": treasure_id, "cost_at_auction": round(rng.uniform(1, 5000), 2)}
+            for treasure_id in rng.sample(treasure_ids, min(100, len(treasure_ids)))
+        ]})),
+        Scenario("DELETE /api/treasures/{id}", lambda rng: (
+            "DELETE", f"/api/treasures/{next(iter(take_ids(1)), 0)}", None), 204),
+        Scenario("DELETE /api/treasures x10", lambda rng: (
+            "DELETE", "/api/treasures", {"treasure_ids": take_ids(10) or [0]}), 204),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_scenario(base_url, scenario, concurrency, duration, seed):
+    deadline = time.perf_counter() + duration
+
+    def client_loop(worker):
+        rng = random.Random(f"{seed}-{scenario.name}-{worker}")
+        latencies, errors = [], 0
+        with httpx.Client(base_url=base_url, timeout=60) as client:
+            while time.perf_counter() < deadline:
+                method, url, body = scenario.next_request(rng)
+                started = time.perf_counter()
+                response = client.request(method, url, json=body)
+                latencies.append(time.perf_counter() - started)
+                errors += response.status_code != scenario.expected_status
+        return latencies, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(client_loop, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for worker_latencies, _ in results for latency in worker_latencies)
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in results),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p95": round(percentile(latencies, 0.95), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "max": round(latencies[-1], 3),
+        } if latencies else None,
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True).stdout.strip())
+        return {"commit": commit, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def run(args):
+    with httpx.Client(base_url=args.base_url, timeout=60) as client:
+        shops = client.get("/api/shops").json()["shops"]
+        treasure_count = len(client.get("/api/treasures", params={"format": "columns"}).json()["rows"])
+        scenarios = build_scenarios(client, args.seed)
+
+    report = {
+        "meta": {
+            **git_revision(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "base_url": args.base_url,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "seed": args.seed,
+            "dataset": {"treasures": treasure_count, "shops": len(shops)},
+        },
+        "results": {},
+    }
+    for scenario in scenarios:
+        if args.only and not any(name in scenario.name for name in args.only):
+            continue
+        result = run_scenario(args.base_url, scenario, args.concurrency, args.duration, args.seed)
+        report["results"][scenario.name] = result
+        latency = result["latency_ms"] or {}
+        print(f"{scenario.name:<40}{result['throughput_rps']:>10.1f} rps  "
+              f"p50 {latency.get('p50')}ms  p95 {latency.get('p95')}ms  p99 {latency.get('p99')}ms  "
+              f"errors {result['errors']}")
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"\U0001F4C8 Report written to {args.output}")
+
+
+def compare(baseline_path, report_path, threshold):
+    '''Prints the change in throughput and p95 per scenario; returns 1 if any
+    scenario's p95 latency regressed by more than `threshold`.'''
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    with open(report_path) as file:
+        report = json.load(file)
+    for key in ["concurrency", "duration_s", "dataset"]:
+        if baseline["meta"].get(key) != report["meta"].get(key):
+            print(f"⚠️  {key} differs: {baseline['meta'].get(key)} vs {report['meta'].get(key)}")
+
+    regressed = False
+    print(f"{'scenario':<40}{'rps change':>12}{'p95 change':>12}")
+    for name, result in report["results"].items():
+        before = baseline["results"].get(name)
+        if not before or not before["latency_ms"] or not result["latency_ms"]:
+            continue
+        rps_change = result["throughput_rps"] / before["throughput_rps"] - 1
+        p95_change = result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1
+        flag = " \U0001F6A8" if p95_change > threshold else ""
+        regressed |= p95_change > threshold
+        print(f"{name:<40}{rps_change:>+11.1%}{p95_change:>+11.1%}{flag}")
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", nargs="*", help="run only scenarios whose name contains one of these")
+    parser.add_argument("--output", default="load_test_report.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "REPORT"))
+    parser.add_argument("--threshold", type=float, default=0.10, help="p95 regression that fails --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold))
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
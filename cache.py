@@ -0,0 +1,119 @@
+'''This module contains the in-process response cache for the
+read endpoints of the `Cat's Rare Treasures` FastAPI app.'''
+from collections import OrderedDict
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+load_dotenv()
+
+
+class ResponseCache:
+    '''A thread-safe LRU cache of serialised response bodies with a TTL and a
+    memory budget.
+
+    Readers take the current `generation` before they query the database and
+    hand it back to `put`; a write that commits in between calls `invalidate`,
+    which bumps the generation, so a response built from data read before the
+    write is never stored.
+    '''
+
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=30.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", 30)),
+        )
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_bytes > 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            body, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body, generation):
+        size = len(body) + self.ENTRY_OVERHEAD
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, time.monotonic() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self):
+        '''Drops every entry; called once a write to `treasures` has committed.'''
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def clear(self):
+        '''Drops every entry and resets the counters.'''
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key):
+        body, _ = self._entries.pop(key)
+        self._bytes -= len(body) + self.ENTRY_OVERHEAD
+
+
+response_cache = ResponseCache.from_env()
@@ -0,0 +1,178 @@
+'''This module compresses the responses of the `Cat's Rare Treasures`
+FastAPI app with the best content coding the client accepts.
+
+`CompressionMiddleware` negotiates zstd, brotli or gzip from the
+`Accept-Encoding` request header, preferring them in `COMPRESSION_ENCODINGS`
+order among those with the highest quality value. gzip is always available;
+brotli and zstd need the `brotli` and `zstandard` packages. Bodies smaller
+than `COMPRESSION_MIN_BYTES` are sent as they are, since compressing them
+costs more time than it saves on the wire. Streamed bodies, such as the
+exports, are compressed and flushed chunk by chunk.
+'''
+from metrics import metrics
+from starlette.datastructures import Headers, MutableHeaders
+import zlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", 1024))
+COMPRESSION_ENCODINGS = [
+    encoding.strip() for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if encoding.strip()
+]
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+class GzipCompressor:
+    '''`compress` returns the output so far, flushed so that the client can
+    decode everything sent; `finish` ends the stream.'''
+
+    def __init__(self, level=5):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, quality=5):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level=3):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+COMPRESSORS = {"gzip": GzipCompressor}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+
+
+def negotiate(accept_encoding: str, encodings: list):
+    '''Returns the content coding in `encodings` that `accept_encoding`
+    gives the highest quality value, the earliest of equals, or `None`.'''
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding.lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class CompressionMiddleware:
+    '''Compresses JSON, NDJSON and text responses of at least `minimum_size`
+    bytes, and every streamed one, with the negotiated content coding.'''
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_BYTES, encodings=COMPRESSION_ENCODINGS):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encodings = [encoding for encoding in encodings if encoding in COMPRESSORS]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressingSender(send, encoding, self.minimum_size).send)
+
+
+class CompressingSender:
+    '''Wraps an ASGI `send`, holding the response start back until the
+    first body chunk shows whether the response is worth compressing.'''
+
+    def __init__(self, send, encoding, minimum_size):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start = None
+        self.compressor = None
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        body, more_body = message.get("body", b""), message.get("more_body", False)
+        if self.start is not None:
+            headers = MutableHeaders(raw=list(self.start["headers"]))
+            start, self.start = {**self.start, "headers": headers.raw}, None
+            if not self._compressible(start["status"], headers):
+                await self._send(start)
+                await self._send(message)
+                return
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body and len(body) < self.minimum_size:
+                await self._send(start)
+                await self._send(message)
+                return
+            self.compressor = COMPRESSORS[self.encoding]()
+            headers["Content-Encoding"] = self.encoding
+            del headers["Content-Length"]
+            compressed = self.compressor.compress(body) if more_body else self.compressor.finish(body)
+            if not more_body:
+                headers["Content-Length"] = str(len(compressed))
+            await self._send(start)
+        elif self.compressor is None:
+            await self._send(message)
+            return
+        else:
+            compressed = self.compressor.compress(body) if more_body else self.compressor.finish(body)
+
+        metrics.inc("response_compression_bytes_total", len(body), encoding=self.encoding, stage="uncompressed")
+        metrics.inc("response_compression_bytes_total", len(compressed), encoding=self.encoding, stage="compressed")
+        await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+    @staticmethod
+    def _compressible(status, headers):
+        return (
+            status not in (204, 304)
+            and "content-encoding" not in headers
+            and headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+        )
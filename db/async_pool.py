@@ -0,0 +1,149 @@
+'''This module lets the `async def` handlers of the `Cat's Rare Treasures`
+FastAPI app use the blocking pg8000 connection pools without tying up
+Starlette's worker threadpool.
+
+`AsyncPool` runs database calls on its own executor, with one thread per
+concurrency slot. At most `max_concurrency` borrowed connections are in
+use at once. Up to `max_waiting` more requests queue for a slot, for at most
+`acquire_timeout` seconds. Beyond that `PoolTimeout` is raised at once,
+which the app answers with a 503, so a saturated database sheds load
+instead of building an unbounded queue.
+'''
+from db.connection import PoolTimeout
+from metrics import metrics
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager
+import asyncio
+import threading
+import time
+import weakref
+import os
+
+
+class AsyncConnection:
+    '''A borrowed connection whose calls run on the pool's executor, one at a time.'''
+
+    def __init__(self, conn, pool):
+        self.conn = conn
+        self.pool = pool
+        self.pending = None
+
+    @property
+    def columns(self):
+        return self.conn.columns
+
+    async def call(self, fn, *args, **kwargs):
+        '''Returns `fn(connection, *args, **kwargs)`, run on a worker thread.'''
+        self.pending = self.pool.submit(fn, self.conn, *args, **kwargs)
+        return await asyncio.wrap_future(self.pending)
+
+    async def run(self, sql, **params):
+        return await self.call(lambda conn: conn.run(sql, **params))
+
+
+def leave(borrow, pending, exc_info):
+    '''Exits `borrow` once `pending`, the last call made on its connection,
+    has finished: a cancelled request stops waiting for its query, but the
+    query still runs to the end on its thread.'''
+    if pending is not None:
+        wait([pending])
+    borrow.__exit__(*exc_info)
+
+
+class AsyncPool:
+    def __init__(self, max_concurrency=10, max_waiting=100, acquire_timeout=5.0):
+        if max_concurrency < 1 or max_waiting < 0:
+            raise ValueError("AsyncPool limits must satisfy max_concurrency >= 1 and max_waiting >= 0")
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.acquire_timeout = acquire_timeout
+        self.in_use = 0
+        self.waiting = 0
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # asyncio primitives belong to one event loop; the tests start several.
+        self._slots = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrency=int(os.getenv("PG_ASYNC_MAX_CONCURRENCY", os.getenv("PG_POOL_MAX_SIZE", 10))),
+            max_waiting=int(os.getenv("PG_ASYNC_MAX_WAITING", 100)),
+            acquire_timeout=float(os.getenv("PG_POOL_TIMEOUT", 5)),
+        )
+
+    def submit(self, fn, *args, **kwargs):
+        '''Starts `fn(*args, **kwargs)` on one of the pool's threads and returns its future.'''
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="db")
+            return self._executor.submit(fn, *args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        '''Returns `fn(*args, **kwargs)`, run on one of the pool's threads.'''
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    @asynccontextmanager
+    async def slot(self):
+        '''Holds one of the `max_concurrency` slots, or raises `PoolTimeout`
+        if too many requests are already queueing or none frees up in time.'''
+        slots = self._slots.setdefault(asyncio.get_running_loop(), asyncio.Semaphore(self.max_concurrency))
+        started = time.perf_counter()
+        if not slots.locked():
+            # Does not suspend, so nothing can take the free slot first.
+            await slots.acquire()
+        elif self.waiting >= self.max_waiting:
+            metrics.inc("db_async_rejections_total", reason="saturated")
+            raise PoolTimeout(f"{self.waiting} requests already waiting for a database slot")
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(slots.acquire(), self.acquire_timeout)
+            except asyncio.TimeoutError:
+                metrics.inc("db_async_rejections_total", reason="timeout")
+                raise PoolTimeout(f"No database slot available within {self.acquire_timeout}s") from None
+            finally:
+                self.waiting -= 1
+        metrics.observe("db_async_wait_duration_seconds", time.perf_counter() - started)
+        self.in_use += 1
+        try:
+            yield
+        finally:
+            self.in_use -= 1
+            slots.release()
+
+    @asynccontextmanager
+    async def connection(self, borrow):
+        '''Borrows a connection through `borrow`, a blocking context manager
+        such as `pool.connection()`, for the duration of the `async with`
+        block. Entering and leaving `borrow` also run on the executor, so
+        waiting on the underlying pool never blocks the event loop, and the
+        connection is given back even if the request is cancelled.'''
+        async with self.slot():
+            entering = self.submit(borrow.__enter__)
+            try:
+                conn = await asyncio.wrap_future(entering)
+            except asyncio.CancelledError:
+                entering.add_done_callback(
+                    lambda entered: entered.cancelled() or entered.exception()
+                    or self.submit(borrow.__exit__, None, None, None)
+                )
+                raise
+            connection = AsyncConnection(conn, self)
+            exc_info = (None, None, None)
+            try:
+                yield connection
+            except BaseException as exc:
+                exc_info = (type(exc), exc, exc.__traceback__)
+                raise
+            finally:
+                await asyncio.shield(asyncio.wrap_future(self.submit(leave, borrow, connection.pending, exc_info)))
+
+    def close(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+async_pool = AsyncPool.from_env()
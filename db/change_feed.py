@@ -0,0 +1,73 @@
+'''This module publishes the changes to `shops` and `treasures` on the
+`treasures_changed` PostgreSQL notification channel, which the in-process
+read model of the `Cat's Rare Treasures` FastAPI app listens to.
+
+Statement-level triggers send a JSON payload naming the table and, for
+`treasures`, the ids of the changed rows, in chunks that keep each payload
+well under PostgreSQL's 8000 byte limit. Notifications are delivered when
+the writing transaction commits, whichever client made it, and never for a
+rollback. A TRUNCATE sends no ids: listeners reload everything.
+'''
+
+
+CHANGE_FEED_CHANNEL = "treasures_changed"
+
+CHANGE_FEED_CHUNK_SIZE = 500
+
+CHANGE_FEED_DDL = [
+    f"""
+    CREATE OR REPLACE FUNCTION change_feed_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        ids JSON;
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object('table', TG_TABLE_NAME)::TEXT);
+        ELSIF TG_TABLE_NAME = 'shops' THEN
+            IF EXISTS (SELECT FROM changed_rows) THEN
+                PERFORM pg_notify(
+                    '{CHANGE_FEED_CHANNEL}', json_build_object('table', 'shops', 'ids', '[]'::JSON)::TEXT
+                );
+            END IF;
+        ELSE
+            FOR ids IN
+                SELECT json_agg(treasure_id)
+                FROM (
+                    SELECT treasure_id, (row_number() OVER () - 1) / {CHANGE_FEED_CHUNK_SIZE} AS chunk
+                    FROM changed_rows
+                ) AS numbered
+                GROUP BY chunk
+            LOOP
+                PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object('table', 'treasures', 'ids', ids)::TEXT);
+            END LOOP;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+] + [
+    f"""
+    CREATE TRIGGER {table}_change_feed_{event.lower()} AFTER {event} ON {table}
+    {transition}
+    FOR EACH STATEMENT EXECUTE FUNCTION change_feed_notify()
+    """
+    for table in ["shops", "treasures"]
+    for event, transition in [
+        ("INSERT", "REFERENCING NEW TABLE AS changed_rows"),
+        ("UPDATE", "REFERENCING NEW TABLE AS changed_rows"),
+        ("DELETE", "REFERENCING OLD TABLE AS changed_rows"),
+        ("TRUNCATE", ""),
+    ]
+]
+
+
+def create_change_feed(db):
+    '''Creates the `change_feed_notify` triggers. Expects the `shops` and
+    `treasures` tables to exist.'''
+    for statement in CHANGE_FEED_DDL:
+        db.run(statement)
+
+
+def notify_reload(db):
+    '''Tells listeners to reload everything once the current transaction
+    commits, e.g. after the tables have been recreated.'''
+    db.run("SELECT pg_notify(:channel, :payload)", channel=CHANGE_FEED_CHANNEL, payload='{"table": "treasures"}')
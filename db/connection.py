@@ -1,15 +1,310 @@
-from pg8000.native import Connection
+from pg8000.native import Connection, InterfaceError
+from metrics import metrics
+from contextlib import contextmanager
+from collections import deque
 from dotenv import load_dotenv
+import threading
+import socket
+import time
 import os
 
 load_dotenv()
 
 
-def connect_to_db():
-    return Connection(
+class InstrumentedConnection(Connection):
+    '''A pg8000 connection that records the time and row count of every
+    `run` against the SQL shape.'''
+
+    def run(self, sql, stream=None, types=None, **params):
+        started = time.perf_counter()
+        try:
+            rows = super().run(sql, stream=stream, types=types, **params)
+        except Exception:
+            metrics.record_query_error(sql)
+            raise
+        metrics.record_query(sql, params, time.perf_counter() - started, self.row_count)
+        return rows
+
+
+class SavepointConnection(InstrumentedConnection):
+    '''A connection that keeps all of its work inside one outer transaction,
+    so that `rollback_all` discards everything written through it.
+
+    `START TRANSACTION`, `COMMIT` and `ROLLBACK` issued by the app map onto
+    savepoints, so code that manages its own transactions runs unchanged.
+    Used by the tests through `ConnectionPool.pinned`.
+    '''
+
+    _depth = 0
+
+    def begin_outer(self):
+        super().run("START TRANSACTION")
+        self._depth = 0
+
+    def rollback_all(self):
+        super().run("ROLLBACK")
+        self._depth = 0
+
+    def checkout(self):
+        super().run("SAVEPOINT checkout")
+        self._depth = 0
+
+    def checkin(self):
+        '''Ends a borrow, undoing it if it left a transaction open or failed,
+        as returning a connection to the pool would.'''
+        if self._depth or self._transaction_status == b"E":
+            super().run("ROLLBACK TO SAVEPOINT checkout")
+        super().run("RELEASE SAVEPOINT checkout")
+        self._depth = 0
+
+    def run(self, sql, stream=None, types=None, **params):
+        command = " ".join(sql.split()).rstrip(";").upper()
+        if command.startswith(("START TRANSACTION", "BEGIN")):
+            self._depth += 1
+            return super().run(f"SAVEPOINT nested_{self._depth}")
+        if command in ("COMMIT", "END", "ROLLBACK"):
+            if self._depth:
+                if command == "ROLLBACK" or self._transaction_status == b"E":
+                    super().run(f"ROLLBACK TO SAVEPOINT nested_{self._depth}")
+                else:
+                    # Committing closes the transaction's cursors.
+                    super().run("CLOSE ALL")
+                super().run(f"RELEASE SAVEPOINT nested_{self._depth}")
+                self._depth -= 1
+            return None
+        return super().run(sql, stream=stream, types=types, **params)
+
+
+def connect_to_db(database=None, connection_class=InstrumentedConnection, host=None, port=None):
+    started = time.perf_counter()
+    conn = connection_class(
         user=os.getenv("PG_USER"),
         password=os.getenv("PG_PASSWORD"),
-        database=os.getenv("PG_DATABASE"),
-        host=os.getenv("PG_HOST"),
-        port=int(os.getenv("PG_PORT"))
+        database=database or os.getenv("PG_DATABASE"),
+        host=host or os.getenv("PG_HOST"),
+        port=int(port or os.getenv("PG_PORT"))
     )
+    # Like libpq, disable Nagle's algorithm: pg8000 flushes multi-message
+    # exchanges such as COPY in several small writes, which otherwise stall on
+    # delayed ACKs.
+    conn._usock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    metrics.observe("db_connect_duration_seconds", time.perf_counter() - started)
+    return conn
+
+
+class PoolTimeout(Exception):
+    '''Raised when no connection becomes available within the acquire timeout.'''
+
+
+class PoolClosed(Exception):
+    '''Raised when a connection is requested from a drained pool.'''
+
+
+class ConnectionPool:
+    '''A bounded, thread-safe pool of pg8000 connections.
+
+    Connections are created lazily up to `max_size`; `open` warms the pool up
+    to `min_size` and `close` drains it. Idle connections are reused most
+    recently used first, evicted once they have been idle for longer than
+    `max_idle` seconds (never below `min_size`), and checked with `SELECT 1`
+    before reuse if they have been idle for longer than `check_after` seconds.
+    '''
+
+    def __init__(self, connect=connect_to_db, min_size=1, max_size=10,
+                 acquire_timeout=5.0, max_idle=300.0, check_after=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._pinned = None
+        self._pinned_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, connect=connect_to_db):
+        return cls(
+            connect=connect,
+            min_size=int(os.getenv("PG_POOL_MIN_SIZE", 1)),
+            max_size=int(os.getenv("PG_POOL_MAX_SIZE", 10)),
+            acquire_timeout=float(os.getenv("PG_POOL_TIMEOUT", 5)),
+            max_idle=float(os.getenv("PG_POOL_MAX_IDLE", 300)),
+            check_after=float(os.getenv("PG_POOL_CHECK_AFTER", 30)),
+        )
+
+    @property
+    def size(self):
+        return self._size + (self._pinned is not None)
+
+    @property
+    def idle(self):
+        return len(self._idle) + (self._pinned is not None and not self._pinned_lock.locked())
+
+    def open(self):
+        '''Re-opens a drained pool and warms it up to `min_size` connections.'''
+        with self._cond:
+            self._closed = False
+            missing = self.min_size - self._size
+            self._size += max(missing, 0)
+        for _ in range(missing):
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def close(self):
+        '''Drains the pool: idle connections are closed now, borrowed ones on release.'''
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def acquire(self):
+        started = time.perf_counter()
+        if self._pinned is not None:
+            return self._acquire_pinned(started)
+        deadline = time.monotonic() + self.acquire_timeout
+        evicted = []
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolClosed("Connection pool has been closed")
+                evicted += self._evict_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.inc("db_pool_timeouts_total")
+                    raise PoolTimeout(
+                        f"No connection available within {self.acquire_timeout}s (max_size={self.max_size})"
+                    )
+                self._cond.wait(remaining)
+
+        for stale in evicted:
+            self._close_quietly(stale)
+
+        if conn is not None and time.monotonic() - last_used > self.check_after and not self._is_healthy(conn):
+            self._close_quietly(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        metrics.observe("db_pool_wait_duration_seconds", time.perf_counter() - started)
+        return conn
+
+    def release(self, conn, discard=False):
+        if conn is self._pinned:
+            try:
+                conn.checkin()
+            finally:
+                self._pinned_lock.release()
+            return
+        if not discard and conn._transaction_status != b"I":
+            try:
+                conn.run("ROLLBACK")
+            except Exception:
+                discard = True
+        with self._cond:
+            if discard or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._close_quietly(conn)
+
+    @contextmanager
+    def connection(self):
+        '''Borrows a connection for the duration of the `with` block.
+
+        Connections that failed at the network level are discarded instead
+        of being returned to the pool.
+        '''
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except InterfaceError:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    @contextmanager
+    def pinned(self, conn):
+        '''Hands out `conn`, a `SavepointConnection`, from every `acquire` until
+        the block exits, to one borrower at a time and with each borrow in its
+        own savepoint. Lets the tests run the app inside a transaction that
+        they roll back.'''
+        self._pinned = conn
+        try:
+            yield conn
+        finally:
+            self._pinned = None
+
+    def _acquire_pinned(self, started):
+        if not self._pinned_lock.acquire(timeout=self.acquire_timeout):
+            metrics.inc("db_pool_timeouts_total")
+            raise PoolTimeout(f"Pinned connection not released within {self.acquire_timeout}s")
+        try:
+            self._pinned.checkout()
+        except BaseException:
+            self._pinned_lock.release()
+            raise
+        metrics.observe("db_pool_wait_duration_seconds", time.perf_counter() - started)
+        return self._pinned
+
+    def _evict_idle(self):
+        evicted = []
+        cutoff = time.monotonic() - self.max_idle
+        while self._idle and self._size > self.min_size and self._idle[0][1] < cutoff:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            evicted.append(conn)
+        return evicted
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.run("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+pool = ConnectionPool.from_env()
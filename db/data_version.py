@@ -0,0 +1,58 @@
+'''This module maintains the `data_version` counter, which the read
+endpoints of the `Cat's Rare Treasures` FastAPI app turn into ETags.
+
+Statement-level triggers on `shops` and `treasures` bump the counter in the
+writing transaction, so it changes exactly when a write commits, whichever
+client made it. The counter starts from the creation time in milliseconds,
+so versions keep increasing across reseeds. Writes that match no rows leave
+it alone.
+'''
+
+
+DATA_VERSION_DDL = [
+    """
+    CREATE TABLE data_version (
+        singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+        version BIGINT NOT NULL
+    )
+    """,
+    """
+    INSERT INTO data_version (version)
+    VALUES (CAST(EXTRACT(EPOCH FROM clock_timestamp()) * 1000 AS BIGINT))
+    """,
+    """
+    CREATE OR REPLACE FUNCTION data_version_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        -- TRUNCATE triggers have no transition table to look at.
+        IF TG_OP = 'TRUNCATE' THEN
+            UPDATE data_version SET version = version + 1;
+        ELSIF EXISTS (SELECT FROM changed_rows) THEN
+            UPDATE data_version SET version = version + 1;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+] + [
+    f"""
+    CREATE TRIGGER {table}_data_version_{event.lower()} AFTER {event} ON {table}
+    {transition}
+    FOR EACH STATEMENT EXECUTE FUNCTION data_version_bump()
+    """
+    for table in ["shops", "treasures"]
+    for event, transition in [
+        ("INSERT", "REFERENCING NEW TABLE AS changed_rows"),
+        ("UPDATE", "REFERENCING NEW TABLE AS changed_rows"),
+        ("DELETE", "REFERENCING OLD TABLE AS changed_rows"),
+        ("TRUNCATE", ""),
+    ]
+]
+
+SELECT_DATA_VERSION = "SELECT version FROM data_version;"
+
+
+def create_data_version(db):
+    '''Creates `data_version` and its triggers. Expects the `shops` and
+    `treasures` tables to exist.'''
+    for statement in DATA_VERSION_DDL:
+        db.run(statement)
@@ -0,0 +1,93 @@
+'''This module lays `treasures` out as a partitioned table for large
+catalogues of the `Cat's Rare Treasures` FastAPI app.
+
+`seed_db` creates a plain table unless it is given a layout, by default
+from the `TREASURES_PARTITION_BY` environment variable:
+
+    list:colour       one partition per colour in the data, plus a default
+                      one for new colours and treasures without one
+    hash:colour[:N]   N partitions by the hash of the colour (default 8)
+    hash:shop_id[:N]  N partitions by the hash of the shop
+
+A filter on the partition column then only reads the partitions that can
+hold matching rows. Shops are too many for a partition each: every
+partition and its indexes take a lock when the table is dropped or scanned
+in full, and a few thousand exhaust `max_locks_per_transaction`.
+
+Indexes created on `treasures` are created on every partition. With
+`list:colour` each partition holds a single colour, so the indexes that
+lead with `colour` are left out. A unique key on a partitioned table
+has to include the partition column, so `treasure_id` is only unique
+together with it; the `treasure_id` sequence keeps ids unique in practice.
+'''
+import os
+import re
+
+
+PARTITION_LAYOUTS = {"list": ("colour",), "hash": ("colour", "shop_id")}
+DEFAULT_HASH_PARTITIONS = 8
+
+
+def sql_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+class Partitioning:
+    def __init__(self, method, column, partitions=DEFAULT_HASH_PARTITIONS):
+        if column not in PARTITION_LAYOUTS.get(method, ()) or partitions < 1:
+            raise ValueError(
+                "treasures can be partitioned by list on colour or by hash on colour or shop_id, "
+                "into at least one partition"
+            )
+        self.method = method
+        self.column = column
+        self.partitions = partitions
+
+    @classmethod
+    def parse(cls, spec):
+        '''Returns the layout named by `spec`, e.g. `hash:shop_id:16`, or
+        `None` for an empty one.'''
+        if not spec:
+            return None
+        method, _, rest = spec.strip().lower().partition(":")
+        column, _, partitions = rest.partition(":")
+        if partitions and method != "hash":
+            raise ValueError(f"Only hash partitioning takes a number of partitions: {spec}")
+        try:
+            return cls(method, column, int(partitions or DEFAULT_HASH_PARTITIONS))
+        except ValueError as exc:
+            raise ValueError(f"Invalid TREASURES_PARTITION_BY {spec!r}: {exc}") from None
+
+    @classmethod
+    def from_env(cls):
+        return cls.parse(os.getenv("TREASURES_PARTITION_BY"))
+
+    def __str__(self):
+        if self.method == "hash":
+            return f"hash:{self.column}:{self.partitions}"
+        return f"list:{self.column}"
+
+    @property
+    def clause(self):
+        return f"PARTITION BY {self.method.upper()} ({self.column})"
+
+    def create_partitions(self, db, colours=()):
+        '''Creates the partitions of `treasures`: one per colour in `colours`
+        plus a default one for a list layout, `self.partitions` for hash.'''
+        if self.method == "hash":
+            for remainder in range(self.partitions):
+                db.run(
+                    f"CREATE TABLE treasures_p{remainder} PARTITION OF treasures "
+                    f"FOR VALUES WITH (MODULUS {self.partitions}, REMAINDER {remainder})"
+                )
+            return
+        for number, colour in enumerate(colours):
+            db.run(f"CREATE TABLE treasures_p{number} PARTITION OF treasures FOR VALUES IN ({sql_literal(colour)})")
+        db.run("CREATE TABLE treasures_default PARTITION OF treasures DEFAULT")
+
+    def indexes(self, indexes):
+        '''Returns the `CREATE INDEX` statements in `indexes` that are worth
+        creating on every partition.'''
+        if self.method == "hash":
+            return list(indexes)
+        return [index for index in indexes if not re.search(rf"ON treasures (USING \w+ )?\({self.column}\b", index)]
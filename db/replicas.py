@@ -0,0 +1,130 @@
+'''This module routes the read queries of the `Cat's Rare Treasures` FastAPI
+app to read replicas, when any are configured.
+
+`PG_REPLICAS` lists the replicas as comma-separated `host[:port][/database]`
+entries; the port and database default to `PG_PORT` and `PG_DATABASE`, and
+the credentials are the primary's. Each replica gets its own connection
+pool. Reads go to the least busy healthy replica, taking turns between
+equally busy ones, and fall back to the primary when there is none. A
+replica that fails to connect is skipped for `PG_REPLICA_RETRY_AFTER`
+seconds.
+'''
+from db.connection import ConnectionPool, connect_to_db, pool, PoolTimeout
+from metrics import metrics
+from pg8000.native import InterfaceError
+from contextlib import contextmanager
+from functools import partial
+import itertools
+import threading
+import time
+import os
+
+
+def parse_replicas(spec: str) -> list:
+    '''Parses `PG_REPLICAS` into `(host, port, database)` tuples.'''
+    replicas = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(","))):
+        address, _, database = entry.partition("/")
+        host, _, port = address.partition(":")
+        replicas.append((host, int(port or os.getenv("PG_PORT")), database or os.getenv("PG_DATABASE")))
+    return replicas
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    @property
+    def in_use(self):
+        return self.pool.size - self.pool.idle
+
+
+class ReplicaSet:
+    '''Hands out connections to the `primary` pool or to one of `replicas`.'''
+
+    def __init__(self, primary, replicas=(), retry_after=10.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, primary=pool):
+        replicas = [
+            Replica(f"{host}:{port}/{database}", ConnectionPool.from_env(
+                connect=partial(connect_to_db, host=host, port=port, database=database)
+            ))
+            for host, port, database in parse_replicas(os.getenv("PG_REPLICAS", ""))
+        ]
+        return cls(primary, replicas, retry_after=float(os.getenv("PG_REPLICA_RETRY_AFTER", 10)))
+
+    def open(self):
+        for replica in self.replicas:
+            try:
+                replica.pool.open()
+            except Exception as exc:
+                self.mark_unhealthy(replica, exc)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.pool.close()
+
+    def mark_unhealthy(self, replica, exc):
+        print(f"\U0001F6A8 Replica {replica.name} unavailable, reading from the primary: {exc}")
+        replica.unhealthy_until = time.monotonic() + self.retry_after
+        metrics.inc("db_replica_failures_total", replica=replica.name)
+
+    def choose(self):
+        '''Returns the least busy healthy replica, or `None`.'''
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        with self._lock:
+            start = next(self._turn) % len(healthy)
+        rotated = healthy[start:] + healthy[:start]
+        return min(rotated, key=lambda replica: replica.in_use)
+
+    def acquire_read(self, primary=False):
+        '''Returns `(pool, connection)` for a read, from a replica unless
+        `primary` or none is available.'''
+        replica = None if primary else self.choose()
+        if replica is not None:
+            try:
+                return replica.pool, replica.pool.acquire()
+            except PoolTimeout:
+                metrics.inc("db_replica_fallbacks_total", reason="busy")
+            except Exception as exc:
+                self.mark_unhealthy(replica, exc)
+                metrics.inc("db_replica_fallbacks_total", reason="unhealthy")
+        return self.primary, self.primary.acquire()
+
+    def release(self, owner, conn, discard=False):
+        if discard and owner is not self.primary:
+            replica = next(replica for replica in self.replicas if replica.pool is owner)
+            self.mark_unhealthy(replica, "connection lost")
+        owner.release(conn, discard=discard)
+
+    @contextmanager
+    def connection(self, primary=False):
+        '''Borrows a connection for reads, from the primary if `primary`.
+        Connections that failed at the network level are discarded, and
+        their replica is skipped for a while.'''
+        owner, conn = self.acquire_read(primary)
+        discard = False
+        try:
+            yield conn
+        except InterfaceError:
+            discard = True
+            raise
+        finally:
+            self.release(owner, conn, discard=discard)
+
+
+replicas = ReplicaSet.from_env()
@@ -1,10 +1,15 @@
 '''This module contains the logic to seed the development databases
-for the `Cat's Rare Treasures` FastAPI app.'''
+for the `Cat's Rare Treasures` FastAPI app.
+
+    python db/run_seed.py [--incremental]
+
+`--incremental` applies only the rows that differ from the data files.'''
 from seed import seed_db
+import sys
 
 
 try:
-    seed_db('test')
+    seed_db('test', incremental='--incremental' in sys.argv[1:])
 except Exception as e:
     print(e)
     raise e
@@ -1,10 +1,212 @@
 from db.connection import connect_to_db
+from db.shop_stock import create_shop_stock
+from db.data_version import create_data_version
+from db.change_feed import create_change_feed, notify_reload
+from db.partitioning import Partitioning
+import hashlib
 import json
+import time
+import re
 
 
-def seed_db(env='test'):
-    print("\U0001FAB4", "Seeding Database...")
+TREASURES_INDEXES = [
+    # Foreign key, join to `shops` and the `shop_id` filter, in each sort order;
+    # the `cost_at_auction` one also gives the `shop_stock` recomputation an
+    # index-only scan.
+    "CREATE INDEX treasures_shop_id_cost_at_auction_idx ON treasures (shop_id, cost_at_auction, treasure_id)",
+    "CREATE INDEX treasures_shop_id_age_idx ON treasures (shop_id, age, treasure_id)",
+    "CREATE INDEX treasures_shop_id_treasure_name_idx ON treasures (shop_id, treasure_name, treasure_id)",
+    # `ORDER BY <sort column>, treasure_id` and its keyset pagination
+    # predicate, and the `age` and `cost_at_auction` range filters.
+    "CREATE INDEX treasures_age_idx ON treasures (age, treasure_id)",
+    "CREATE INDEX treasures_cost_at_auction_idx ON treasures (cost_at_auction, treasure_id)",
+    "CREATE INDEX treasures_treasure_name_idx ON treasures (treasure_name, treasure_id)",
+    # The same, filtered by `colour`.
+    "CREATE INDEX treasures_colour_age_idx ON treasures (colour, age, treasure_id)",
+    "CREATE INDEX treasures_colour_cost_at_auction_idx ON treasures (colour, cost_at_auction, treasure_id)",
+    "CREATE INDEX treasures_colour_treasure_name_idx ON treasures (colour, treasure_name, treasure_id)",
+    # Word-prefix name search.
+    "CREATE INDEX treasures_treasure_name_search_idx ON treasures USING GIN (to_tsvector('simple', treasure_name))",
+]
+
+
+def create_treasures_indexes(db, partitioning=None):
+    indexes = partitioning.indexes(TREASURES_INDEXES) if partitioning else TREASURES_INDEXES
+    for index in indexes:
+        db.run(index)
+    db.run("ANALYZE treasures")
+    return len(indexes)
+
+
+def iter_json_array(path, key, chunk_size=1 << 16):
+    '''Yields the items of the top-level `key` array of a JSON file one at a
+    time, reading the file in chunks instead of loading it whole.'''
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as file:
+        buffer = ''
+        start = -1
+        while start == -1:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise ValueError(f'No "{key}" array found in {path}')
+            buffer += chunk
+            match = re.search(rf'"{re.escape(key)}"\s*:\s*\[', buffer)
+            start = match.end() if match else -1
+        position = start
+        exhausted = False
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                chunk = file.read(chunk_size)
+                exhausted = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield item
+            position = end
+
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_field(value):
+    if value is None:
+        return '\\N'
+    return str(value).translate(COPY_ESCAPES)
+
+
+def iter_copy_chunks(rows, rows_per_chunk=5000):
+    '''Encodes tuples in the `COPY ... FROM STDIN` text format, a few thousand
+    rows per chunk.'''
+    lines = []
+    for row in rows:
+        lines.append('\t'.join(map(copy_field, row)))
+        if len(lines) == rows_per_chunk:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def copy_rows(db, table, columns, rows):
+    '''Streams `rows` into `table` with `COPY FROM STDIN`; returns the row count.'''
+    db.run(f'COPY {table} ({", ".join(columns)}) FROM STDIN', stream=iter_copy_chunks(rows))
+    return db.row_count
+
+
+def report_load(table, row_count, seconds):
+    rate = row_count / seconds if seconds else float('inf')
+    print(
+        f'\U0001F4BE Successfully seeded {row_count} rows to `{table}` \
+table in the database in {seconds:.2f}s ({rate:,.0f} rows/sec). \U0001F44D')
+
+
+SEED_STATE_DDL = """
+    CREATE TABLE seed_state (
+        singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+        env TEXT NOT NULL,
+        shops_sha256 TEXT NOT NULL,
+        treasures_sha256 TEXT NOT NULL,
+        partition_by TEXT,
+        data_version BIGINT NOT NULL
+    )
+"""
+
+RECORD_SEED_STATE = """
+    INSERT INTO seed_state (env, shops_sha256, treasures_sha256, partition_by, data_version)
+    SELECT :env, :shops, :treasures, CAST(:partition_by AS TEXT), version FROM data_version
+    ON CONFLICT (singleton) DO UPDATE SET
+        env = EXCLUDED.env,
+        shops_sha256 = EXCLUDED.shops_sha256,
+        treasures_sha256 = EXCLUDED.treasures_sha256,
+        partition_by = EXCLUDED.partition_by,
+        data_version = EXCLUDED.data_version
+"""
+
+SELECT_SEED_STATE = """
+    SELECT seed_state.env, seed_state.shops_sha256, seed_state.treasures_sha256,
+        seed_state.data_version = data_version.version
+    FROM seed_state, data_version
+"""
+
+SEEDED_TABLES = ('shops', 'treasures', 'shop_stock', 'data_version', 'seed_state')
+
+
+def data_path(env, key):
+    return f'data/{env}-data/{key}.json'
+
+
+def file_sha256(path):
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def iter_shop_rows(env):
+    for row in iter_json_array(data_path(env, 'shops'), 'shops'):
+        yield row['shop_name'], row['owner'], row['slogan']
+
+
+def iter_treasure_rows(env):
+    '''Yields `(treasure_name, colour, age, cost_at_auction, shop_name)`;
+    a full seed gives each treasure its position in the file as `treasure_id`.'''
+    for row in iter_json_array(data_path(env, 'treasures'), 'treasures'):
+        yield (
+            row.get('treasure_name'),
+            row.get('colour'),
+            row.get('age'),
+            row.get('cost_at_auction'),
+            row.get('shop'),
+        )
+
+
+def seed_db(env='test', incremental=False, partition_by=None):
+    '''Seeds the `shops` and `treasures` tables from the JSON files in
+    `data/<env>-data`, in a single transaction.
+
+    By default the tables are dropped and rebuilt. With `incremental=True`
+    only the differences between the files and the tables are applied, and
+    nothing is done at all if neither the files nor the tables have changed
+    since the last seed; see `apply_seed_diff`.
+
+    `partition_by` lays `treasures` out as a partitioned table, e.g.
+    `'list:colour'` (see `db.partitioning`); it defaults to the
+    `TREASURES_PARTITION_BY` environment variable, and `''` forces a plain
+    table. An incremental seed asking for another layout rebuilds the tables.
+    '''
+    partitioning = Partitioning.from_env() if partition_by is None else Partitioning.parse(partition_by)
     db = connect_to_db()
+    if incremental and has_seeded_tables(db, partitioning):
+        apply_seed_diff(db, env, partitioning)
+    else:
+        rebuild_tables(db, env, partitioning)
+    db.close()
+
+
+def has_seeded_tables(db, partitioning=None):
+    '''Whether the seeded tables exist, with `treasures` laid out as
+    `partitioning`.'''
+    if not all(db.run("SELECT to_regclass(:table) IS NOT NULL", table=table)[0][0] for table in SEEDED_TABLES):
+        return False
+    return db.run("SELECT partition_by FROM seed_state") == [[str(partitioning) if partitioning else None]]
+
+
+def rebuild_tables(db, env, partitioning=None):
+    '''Drops and rebuilds the tables. Rows are streamed from the files and
+    bulk loaded with `COPY`; the foreign key and the indexes are only
+    created once the data is in.'''
+    print("\U0001FAB4", "Seeding Database..." + (f" (treasures partitioned by {partitioning})" if partitioning else ""))
+    hashes = {key: file_sha256(data_path(env, key)) for key in ('shops', 'treasures')}
+    db.run("START TRANSACTION")
+    db.run("DROP TABLE if exists seed_state")
+    db.run("DROP TABLE if exists shop_stock")
+    db.run("DROP TABLE if exists data_version")
     db.run("DROP TABLE if exists treasures")
     db.run("DROP TABLE if exists shops")
 
@@ -16,68 +218,237 @@ def seed_db(env='test'):
         slogan VARCHAR (256)\
         )'
     )
+    if partitioning is None:
+        db.run(
+            'CREATE TABLE treasures (\
+            treasure_id SERIAL PRIMARY KEY,\
+            treasure_name VARCHAR(256) NOT NULL,\
+            colour VARCHAR (42),\
+            age INT,\
+            cost_at_auction FLOAT(2),\
+            shop_id INT\
+            )'
+        )
+    else:
+        # The partition column may be NULL, so it cannot be part of a
+        # primary key; a unique key allows NULLs.
+        db.run(
+            f'CREATE TABLE treasures (\
+            treasure_id SERIAL NOT NULL,\
+            treasure_name VARCHAR(256) NOT NULL,\
+            colour VARCHAR (42),\
+            age INT,\
+            cost_at_auction FLOAT(2),\
+            shop_id INT,\
+            CONSTRAINT treasures_treasure_id_key UNIQUE (treasure_id, {partitioning.column})\
+            ) {partitioning.clause}'
+        )
+        colours = ()
+        if partitioning.method == 'list':
+            colours = sorted({row[1] for row in iter_treasure_rows(env)} - {None})
+        partitioning.create_partitions(db, colours)
+
+    started = time.perf_counter()
+    row_count = copy_rows(db, 'shops', ('shop_name', 'owner', 'slogan'), iter_shop_rows(env))
+    report_load('shops', row_count, time.perf_counter() - started)
+
+    SHOPS = db.run('SELECT shop_id, shop_name FROM shops')
+    SHOP_IDS = {shop[1]: shop[0] for shop in SHOPS}
+
+    started = time.perf_counter()
+    treasure_rows = (
+        (*row[:4], None if row[4] is None else SHOP_IDS[row[4]])
+        for row in iter_treasure_rows(env)
+    )
+    row_count = copy_rows(
+        db, 'treasures', ('treasure_name', 'colour', 'age', 'cost_at_auction', 'shop_id'), treasure_rows
+    )
+    report_load('treasures', row_count, time.perf_counter() - started)
+
+    started = time.perf_counter()
     db.run(
-        'CREATE TABLE treasures (\
-        treasure_id SERIAL PRIMARY KEY,\
+        'ALTER TABLE treasures ADD CONSTRAINT treasures_shop_id_fkey \
+        FOREIGN KEY (shop_id) REFERENCES shops(shop_id)'
+    )
+    index_count = create_treasures_indexes(db, partitioning)
+    create_shop_stock(db)
+    create_data_version(db)
+    create_change_feed(db)
+    notify_reload(db)
+    db.run("ANALYZE shops")
+    db.run(SEED_STATE_DDL)
+    db.run(RECORD_SEED_STATE, env=env, partition_by=partitioning and str(partitioning), **hashes)
+    db.run("COMMIT")
+    print(
+        f'\U0001F5C2 Created the foreign key, {index_count} indexes \
+and the `shop_stock` summary on `treasures` in {time.perf_counter() - started:.2f}s.')
+
+
+# Treasures have no key in the files, and their names are not unique, so they
+# are matched on their content: a row of `treasures` with the same name, colour,
+# age, price and shop as one in the file is unchanged, duplicates being paired
+# in `treasure_id` and file order. Of the rest, treasures with the same name and
+# shop are the same treasure edited, and keep their `treasure_id`.
+MATCH_TREASURES = [
+    """
+    CREATE TEMPORARY TABLE seed_current ON COMMIT DROP AS
+    SELECT treasures.treasure_id,
+        ROW(treasures.treasure_name, treasures.colour, treasures.age, treasures.cost_at_auction, shops.shop_name)::TEXT
+            AS content,
+        ROW(treasures.treasure_name, shops.shop_name)::TEXT AS identity
+    FROM treasures
+    LEFT JOIN shops ON shops.shop_id = treasures.shop_id
+    """,
+    """
+    CREATE TEMPORARY TABLE seed_matches ON COMMIT DROP AS
+    SELECT current.treasure_id, seed.position, TRUE AS unchanged
+    FROM (
+        SELECT position, content, row_number() OVER (PARTITION BY content ORDER BY position) AS occurrence
+        FROM (
+            SELECT position, ROW(treasure_name, colour, age, cost_at_auction, shop_name)::TEXT AS content
+            FROM seed_treasures
+        ) AS seed
+    ) AS seed
+    JOIN (
+        SELECT treasure_id, content, row_number() OVER (PARTITION BY content ORDER BY treasure_id) AS occurrence
+        FROM seed_current
+    ) AS current USING (content, occurrence)
+    """,
+    """
+    INSERT INTO seed_matches (treasure_id, position, unchanged)
+    SELECT current.treasure_id, seed.position, FALSE
+    FROM (
+        SELECT position, identity, row_number() OVER (PARTITION BY identity ORDER BY position) AS occurrence
+        FROM (SELECT position, ROW(treasure_name, shop_name)::TEXT AS identity FROM seed_treasures) AS seed
+        WHERE NOT EXISTS (SELECT FROM seed_matches WHERE seed_matches.position = seed.position)
+    ) AS seed
+    JOIN (
+        SELECT treasure_id, identity, row_number() OVER (PARTITION BY identity ORDER BY treasure_id) AS occurrence
+        FROM seed_current
+        WHERE NOT EXISTS (SELECT FROM seed_matches WHERE seed_matches.treasure_id = seed_current.treasure_id)
+    ) AS current USING (identity, occurrence)
+    """,
+    "ANALYZE seed_matches",
+]
+
+# The diff is applied in this order so that the foreign key holds after every
+# statement: shops are upserted before treasures move to them, and removed
+# once no treasure refers to them any more. Shops are matched by name, and
+# treasures are matched by `MATCH_TREASURES` once the shops are in.
+SEED_DIFF = [
+    ('shops', 'updated', """
+        UPDATE shops SET owner = seed.owner, slogan = seed.slogan
+        FROM seed_shops AS seed
+        WHERE shops.shop_name = seed.shop_name
+            AND (shops.owner, shops.slogan) IS DISTINCT FROM (seed.owner, seed.slogan)
+    """),
+    ('shops', 'inserted', """
+        INSERT INTO shops (shop_name, owner, slogan)
+        SELECT shop_name, owner, slogan FROM seed_shops AS seed
+        WHERE NOT EXISTS (SELECT FROM shops WHERE shops.shop_name = seed.shop_name)
+        ORDER BY seed.position
+    """),
+    *((None, None, statement) for statement in MATCH_TREASURES),
+    ('treasures', 'deleted', """
+        DELETE FROM treasures
+        WHERE NOT EXISTS (SELECT FROM seed_matches WHERE seed_matches.treasure_id = treasures.treasure_id)
+    """),
+    ('treasures', 'updated', """
+        UPDATE treasures SET
+            treasure_name = seed.treasure_name,
+            colour = seed.colour,
+            age = seed.age,
+            cost_at_auction = seed.cost_at_auction,
+            shop_id = shops.shop_id
+        FROM seed_matches AS matched
+        JOIN seed_treasures AS seed ON seed.position = matched.position
+        LEFT JOIN shops ON shops.shop_name = seed.shop_name
+        WHERE treasures.treasure_id = matched.treasure_id AND NOT matched.unchanged
+    """),
+    ('treasures', 'inserted', """
+        INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
+        SELECT seed.treasure_name, seed.colour, seed.age, seed.cost_at_auction, shops.shop_id
+        FROM seed_treasures AS seed
+        LEFT JOIN shops ON shops.shop_name = seed.shop_name
+        WHERE NOT EXISTS (SELECT FROM seed_matches WHERE seed_matches.position = seed.position)
+        ORDER BY seed.position
+    """),
+    ('shops', 'deleted', """
+        DELETE FROM shops
+        WHERE NOT EXISTS (SELECT FROM seed_shops AS seed WHERE seed.shop_name = shops.shop_name)
+    """),
+]
+
+
+def apply_seed_diff(db, env, partitioning=None):
+    '''Brings the seeded tables in line with the files by applying only the
+    rows that differ, in one transaction.
+
+    The files are hashed and compared with those recorded by the last seed;
+    if they match and no write has bumped `data_version` since, there is
+    nothing to do. Otherwise the files are copied into staging tables and
+    diffed against `shops` and `treasures`, so rows that have not changed
+    are left alone, edited treasures keep their `treasure_id`, new ones get
+    the next ids, and writes made since the last seed are reverted. The
+    `shop_stock`, `data_version` and change feed triggers see the changes
+    like any other write.
+    '''
+    started = time.perf_counter()
+    hashes = {key: file_sha256(data_path(env, key)) for key in ('shops', 'treasures')}
+    state = db.run(SELECT_SEED_STATE)
+    if state and state[0] == [env, hashes['shops'], hashes['treasures'], True]:
+        print(f'\u2705 The database already matches `data/{env}-data`; nothing to seed.')
+        return
+
+    print("\U0001FAB4", "Seeding Database incrementally...")
+    db.run("START TRANSACTION")
+    # Writers wait until the diff commits; readers carry on.
+    db.run("LOCK TABLE shops, treasures IN SHARE ROW EXCLUSIVE MODE")
+    db.run(
+        'CREATE TEMPORARY TABLE seed_shops (\
+        position INT NOT NULL, \
+        shop_name VARCHAR(42) PRIMARY KEY, \
+        owner VARCHAR(42), \
+        slogan VARCHAR (256)\
+        ) ON COMMIT DROP'
+    )
+    db.run(
+        'CREATE TEMPORARY TABLE seed_treasures (\
+        position INT PRIMARY KEY,\
         treasure_name VARCHAR(256) NOT NULL,\
         colour VARCHAR (42),\
         age INT,\
         cost_at_auction FLOAT(2),\
-        shop_id INT REFERENCES shops(shop_id)\
-        )'
+        shop_name VARCHAR(42)\
+        ) ON COMMIT DROP'
     )
+    copy_rows(
+        db, 'seed_shops', ('position', 'shop_name', 'owner', 'slogan'),
+        ((position, *row) for position, row in enumerate(iter_shop_rows(env), start=1))
+    )
+    copy_rows(
+        db, 'seed_treasures', ('position', 'treasure_name', 'colour', 'age', 'cost_at_auction', 'shop_name'),
+        ((position, *row) for position, row in enumerate(iter_treasure_rows(env), start=1))
+    )
+    db.run("ANALYZE seed_shops, seed_treasures")
+    unknown = db.run("""
+        SELECT DISTINCT shop_name FROM seed_treasures AS seed
+        WHERE shop_name IS NOT NULL
+            AND NOT EXISTS (SELECT FROM seed_shops WHERE seed_shops.shop_name = seed.shop_name)
+    """)
+    if unknown:
+        db.run("ROLLBACK")
+        raise ValueError(f'Treasures in data/{env}-data refer to unknown shops: {sorted(row[0] for row in unknown)}')
 
-    with open(f'data/{env}-data/shops.json', 'r') as file:
-        SHOPS_DATA = json.load(file)
-        ROWS = SHOPS_DATA['shops']
-        row_count = 0
-        for row in ROWS:
-            db.run(
-                'INSERT INTO shops (shop_name, owner, slogan)\
-                VALUES (:shop_name, :owner, :slogan)',
-                shop_name=row['shop_name'],
-                owner=row['owner'],
-                slogan=row['slogan']
-            )
-            row_count += 1
-        print(
-            f'\U0001F4BE Successfully seeded {row_count} rows to \
-`shops` table in the database. \U0001F44D')
-
-    SHOPS = db.run('SELECT * FROM shops')
-    SHOP_IDS = {shop[1]: shop[0] for shop in SHOPS}
-
-    with open(f'data/{env}-data/treasures.json', 'r') as file:
-        TREASURES_DATA = json.load(file)
-        ROWS = TREASURES_DATA['treasures']
-        row_count = 0
-        for row in ROWS:
-            ROW_VALUES = {
-                "treasure_name": row['treasure_name']
-                if 'treasure_name' in row else None,
-                "colour": row['colour']
-                if 'colour' in row else None,
-                "age": row['age']
-                if 'age' in row else None,
-                "cost_at_auction": row['cost_at_auction']
-                if 'cost_at_auction' in row else None,
-                "shop_id": SHOP_IDS[row['shop']] if 'shop' in row else None,
-            }
-            db.run(
-                'INSERT INTO treasures (treasure_name, colour, age, \
-                cost_at_auction, shop_id)\
-                VALUES (:treasure_name, :colour, :age,:cost_at_auction, \
-                :shop_id)',
-                treasure_name=ROW_VALUES['treasure_name'],
-                colour=ROW_VALUES['colour'],
-                age=ROW_VALUES['age'],
-                cost_at_auction=ROW_VALUES['cost_at_auction'],
-                shop_id=ROW_VALUES['shop_id']
-            )
-
-            row_count += 1
+    changes = {}
+    for table, change, statement in SEED_DIFF:
+        db.run(statement)
+        if change is not None:
+            changes.setdefault(table, {})[change] = db.row_count
+    db.run(RECORD_SEED_STATE, env=env, partition_by=partitioning and str(partitioning), **hashes)
+    db.run("COMMIT")
+    for table, counts in changes.items():
         print(
-            f'\U0001F4BE Successfully seeded {row_count} rows to `treasures` \
-table in the database. \U0001F44D')
-
-    db.close()
+            f'\U0001F501 Applied the changes to `{table}`: {counts["inserted"]} inserted, \
+{counts["updated"]} updated and {counts["deleted"]} deleted rows.')
+    print(f'\U0001F5C2 Seeded incrementally in {time.perf_counter() - started:.2f}s.')
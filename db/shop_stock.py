@@ -0,0 +1,165 @@
+'''This module maintains the `shop_stock` summary table, which holds each
+shop's stock value and treasure count for `GET /api/shops`.
+
+Statement-level triggers on `treasures` apply the net change of every
+INSERT, UPDATE and DELETE in the writing transaction, so the summary is
+always consistent with `treasures` and a write of many rows costs one
+upsert per affected shop. `check_shop_stock` recomputes the aggregate from
+scratch and reports (and optionally repairs) any drift:
+
+    python -m db.shop_stock [--repair]
+'''
+from db.connection import connect_to_db
+import sys
+
+
+SHOP_STOCK_DDL = [
+    """
+    CREATE TABLE shop_stock (
+        shop_id INT PRIMARY KEY REFERENCES shops(shop_id) ON DELETE CASCADE,
+        stock_value NUMERIC NOT NULL DEFAULT 0,
+        treasure_count INT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION shop_stock_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO shop_stock AS stock (shop_id, stock_value, treasure_count)
+            SELECT shop_id, -COALESCE(SUM(cost_at_auction::NUMERIC), 0), -COUNT(*)
+            FROM old_treasures
+            WHERE shop_id IS NOT NULL
+            GROUP BY shop_id
+            ORDER BY shop_id
+            ON CONFLICT (shop_id) DO UPDATE SET
+                stock_value = stock.stock_value + EXCLUDED.stock_value,
+                treasure_count = stock.treasure_count + EXCLUDED.treasure_count;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO shop_stock AS stock (shop_id, stock_value, treasure_count)
+            SELECT shop_id, COALESCE(SUM(cost_at_auction::NUMERIC), 0), COUNT(*)
+            FROM new_treasures
+            WHERE shop_id IS NOT NULL
+            GROUP BY shop_id
+            ORDER BY shop_id
+            ON CONFLICT (shop_id) DO UPDATE SET
+                stock_value = stock.stock_value + EXCLUDED.stock_value,
+                treasure_count = stock.treasure_count + EXCLUDED.treasure_count;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER shop_stock_insert AFTER INSERT ON treasures
+    REFERENCING NEW TABLE AS new_treasures
+    FOR EACH STATEMENT EXECUTE FUNCTION shop_stock_apply()
+    """,
+    """
+    CREATE TRIGGER shop_stock_update AFTER UPDATE ON treasures
+    REFERENCING OLD TABLE AS old_treasures NEW TABLE AS new_treasures
+    FOR EACH STATEMENT EXECUTE FUNCTION shop_stock_apply()
+    """,
+    """
+    CREATE TRIGGER shop_stock_delete AFTER DELETE ON treasures
+    REFERENCING OLD TABLE AS old_treasures
+    FOR EACH STATEMENT EXECUTE FUNCTION shop_stock_apply()
+    """,
+]
+
+SHOP_COLUMNS = {
+    "shop_id": "shops.shop_id",
+    "shop_name": "shops.shop_name",
+    "slogan": "shops.slogan",
+    "stock_value": "CAST(shop_stock.stock_value AS FLOAT8) AS stock_value",
+}
+
+
+def select_shops_query(columns=tuple(SHOP_COLUMNS)) -> str:
+    '''Returns the `GET /api/shops` listing, shops that hold at least one
+    treasure, selecting only `columns`.'''
+    return f"""
+    SELECT 
+        {", ".join(SHOP_COLUMNS[column] for column in columns)}
+    FROM shops
+    JOIN shop_stock ON shops.shop_id = shop_stock.shop_id
+    WHERE shop_stock.treasure_count > 0
+    ORDER by shops.shop_id;
+"""
+
+SELECT_SHOPS = select_shops_query()
+
+ACTUAL_SHOP_STOCK = """
+    SELECT shops.shop_id,
+        COALESCE(SUM(treasures.cost_at_auction::NUMERIC), 0) AS stock_value,
+        COUNT(treasures.treasure_id) AS treasure_count
+    FROM shops
+    LEFT JOIN treasures ON shops.shop_id = treasures.shop_id
+    GROUP BY shops.shop_id
+"""
+
+
+def create_shop_stock(db):
+    '''Creates `shop_stock` and its triggers, populated from the current
+    `treasures`. Expects the `treasures` and `shops` tables to exist.'''
+    for statement in SHOP_STOCK_DDL:
+        db.run(statement)
+    db.run(f"INSERT INTO shop_stock (shop_id, stock_value, treasure_count) {ACTUAL_SHOP_STOCK}")
+
+
+def check_shop_stock(db, repair=False):
+    '''Recomputes every shop's aggregate from `treasures` and returns a dict
+    per shop whose stored `shop_stock` row differs; with `repair=True` the
+    stored rows are corrected in the same transaction.'''
+    db.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    if repair:
+        # Block writers so that the repaired rows cannot miss a concurrent change.
+        db.run("LOCK TABLE treasures IN SHARE MODE")
+    drift = db.run(f"""
+        SELECT actual.shop_id,
+            stock.stock_value, actual.stock_value,
+            stock.treasure_count, actual.treasure_count
+        FROM ({ACTUAL_SHOP_STOCK}) AS actual
+        LEFT JOIN shop_stock AS stock ON actual.shop_id = stock.shop_id
+        WHERE COALESCE(stock.stock_value, 0) <> actual.stock_value
+            OR COALESCE(stock.treasure_count, 0) <> actual.treasure_count
+        ORDER BY actual.shop_id
+    """)
+    if repair and drift:
+        db.run(f"""
+            INSERT INTO shop_stock AS stock (shop_id, stock_value, treasure_count)
+            {ACTUAL_SHOP_STOCK}
+            ON CONFLICT (shop_id) DO UPDATE SET
+                stock_value = EXCLUDED.stock_value,
+                treasure_count = EXCLUDED.treasure_count
+        """)
+    db.run("COMMIT")
+    return [
+        {
+            "shop_id": shop_id,
+            "stored_stock_value": stored_value,
+            "actual_stock_value": actual_value,
+            "stored_treasure_count": stored_count,
+            "actual_treasure_count": actual_count,
+        }
+        for shop_id, stored_value, actual_value, stored_count, actual_count in drift
+    ]
+
+
+if __name__ == "__main__":
+    db = connect_to_db()
+    try:
+        drift = check_shop_stock(db, repair="--repair" in sys.argv[1:])
+    finally:
+        db.close()
+    for row in drift:
+        print(
+            f'\U0001F6A8 shop {row["shop_id"]}: stored {row["stored_stock_value"]} '
+            f'({row["stored_treasure_count"]} treasures), '
+            f'actual {row["actual_stock_value"]} ({row["actual_treasure_count"]} treasures)'
+        )
+    if not drift:
+        print('\U00002705 shop_stock is consistent with treasures.')
+    elif "--repair" in sys.argv[1:]:
+        print(f'\U0001F527 Repaired {len(drift)} shop_stock rows.')
+    sys.exit(1 if drift and "--repair" not in sys.argv[1:] else 0)
@@ -0,0 +1,60 @@
+'''This module contains the registry of server-side prepared statements used
+by the `Cat's Rare Treasures` FastAPI app.
+
+Queries are written once per shape, with `:name` placeholders for every
+value, and prepared the first time a connection runs them. Later runs on
+the same connection only bind parameters, so PostgreSQL skips parsing and
+can reuse its plan, and the client never builds SQL text per request.
+'''
+from collections import OrderedDict
+from metrics import metrics
+import threading
+import time
+import weakref
+
+
+class StatementRegistry:
+    '''Maps each connection to its prepared statements, keyed by SQL text.
+
+    At most `max_per_connection` statements are kept prepared per
+    connection; the least recently used one is deallocated beyond that.
+    Entries disappear with their connection.
+    '''
+
+    def __init__(self, max_per_connection=128):
+        self.max_per_connection = max_per_connection
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def prepared(self, db, sql):
+        with self._lock:
+            statements = self._prepared.setdefault(db, OrderedDict())
+        statement = statements.get(sql)
+        if statement is not None:
+            statements.move_to_end(sql)
+            return statement
+        statement = db.prepare(sql)
+        statements[sql] = statement
+        if len(statements) > self.max_per_connection:
+            _, evicted = statements.popitem(last=False)
+            evicted.close()
+        return statement
+
+    def run(self, db, sql, **params):
+        '''Runs `sql` on `db` as a prepared statement; returns the rows and the
+        column names.'''
+        statement = self.prepared(db, sql)
+        started = time.perf_counter()
+        try:
+            rows = statement.run(**params)
+        except Exception:
+            metrics.record_query_error(sql)
+            raise
+        metrics.record_query(sql, params, time.perf_counter() - started, statement._context.row_count)
+        return rows, [c["name"] for c in statement.columns or ()]
+
+    def count(self, db):
+        return len(self._prepared.get(db, ()))
+
+
+statements = StatementRegistry()
@@ -1,12 +1,85 @@
 '''This module is the entrypoint for the `Cat's Rare Treasures` FastAPI app.'''
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Depends, Request, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
+from collections import Counter
 from enum import Enum
-from db.connection import connect_to_db
-from pg8000.native import DatabaseError, identifier, literal
+from typing import Annotated
+from db.connection import pool, PoolTimeout
+from db.replicas import replicas
+from db.async_pool import async_pool
+from read_model import read_model, float4
+from write_coalescer import WriteCoalescer
+from cache import response_cache
+from metrics import metrics, RequestMetricsMiddleware
+from compression import CompressionMiddleware
+from serialise import ListingFormat, dumps, encode_rows
+from db.statements import statements
+from db.data_version import SELECT_DATA_VERSION
+from db.shop_stock import SHOP_COLUMNS, select_shops_query
+from pg8000.native import DatabaseError
+import math
+import time
+import re
+import hashlib
+import os
+import base64
+import json
+import csv
+import io
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pool.open()
+    replicas.open()
+    read_model.start()
+    yield
+    read_model.stop()
+    await treasure_writes.drain()
+    async_pool.close()
+    replicas.close()
+    pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
+app.add_middleware(CompressionMiddleware)
+
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 1000))
+STICKY_READS_SECONDS = float(os.getenv("PG_REPLICA_STICKY_SECONDS", 5))
+PRIMARY_READS_COOKIE = "primary_reads_until"
+
+
+async def read_your_writes(response: Response):
+    '''Sends the client's reads to the primary for `STICKY_READS_SECONDS`
+    after a write, so that replica or read model lag never hides its own
+    writes.'''
+    if (replicas.replicas or read_model.enabled) and STICKY_READS_SECONDS > 0:
+        response.set_cookie(
+            PRIMARY_READS_COOKIE, f"{time.time() + STICKY_READS_SECONDS:.3f}",
+            max_age=math.ceil(STICKY_READS_SECONDS), httponly=True, samesite="lax",
+        )
+
+
+def reads_from_primary(request: Request) -> bool:
+    try:
+        return float(request.cookies.get(PRIMARY_READS_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def reads_from_read_model(request: Request) -> bool:
+    return read_model.ready and not reads_from_primary(request)
+
+
+def read_connection(request: Request):
+    '''Borrows a connection for a GET handler: from a replica when any is
+    configured, or from the primary after a recent write by this client.
+    Handlers enter it through `async_pool.connection`.'''
+    return replicas.connection(primary=reads_from_primary(request))
 
 
 class SortBy(Enum):
@@ -14,6 +87,12 @@ class SortBy(Enum):
     cost_at_auction = "cost_at_auction"
     treasure_name = "treasure_name"
 
+SORT_COLUMN_TYPES = {
+    "age": "INT",
+    "cost_at_auction": "REAL",
+    "treasure_name": "VARCHAR",
+}
+
 class Order(Enum):
     asc = "asc"
     desc = "desc"
@@ -33,135 +112,919 @@ class Colour(Enum):
     saffron = "saffron"
     burgundy = "burgundy"
 
-@app.get("/api/treasures")
-def get_all_treasures(sort_by: SortBy = SortBy.age, order: Order = Order.asc, colour: Colour = None):
-    
-    db = None
+def encode_payload(values: list) -> str:
+    payload = json.dumps(values, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
 
+def decode_payload(cursor: str) -> list:
     try:
-        db = connect_to_db()
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except ValueError:
+        values = None
+    if type(values) != list:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def encode_cursor(sort_by: SortBy, order: Order, sort_value, treasure_id: int) -> str:
+    return encode_payload([sort_by.value, order.value, sort_value, treasure_id])
+
+
+INT4_RANGE = range(-2 ** 31, 2 ** 31)
+
+
+def valid_sort_value(sort_by: SortBy, value) -> bool:
+    '''Whether `value` casts to the type of the `sort_by` column, so that a
+    tampered cursor is a 400 rather than a database error.'''
+    if value is None:
+        return sort_by != SortBy.treasure_name
+    if sort_by == SortBy.age:
+        return type(value) == int and value in INT4_RANGE
+    if sort_by == SortBy.cost_at_auction:
+        if type(value) not in (int, float) or abs(value) > 2 ** 128:
+            return False
+        # As a `REAL`, it must neither overflow to infinity nor underflow to zero.
+        real = float4(value)
+        return math.isfinite(real) and (real != 0 or value == 0)
+    return type(value) == str
+
+
+def decode_cursor(cursor: str, sort_by: SortBy, order: Order):
+    '''Returns the `(sort_value, treasure_id)` pair encoded in a cursor issued
+    for the same `sort_by` and `order`, or raises a 400.'''
+    values = decode_payload(cursor)
+    valid = (
+        len(values) == 4
+        and values[0] == sort_by.value and values[1] == order.value
+        and type(values[3]) == int and values[3] in INT4_RANGE
+        and valid_sort_value(sort_by, values[2])
+    )
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values[2], values[3]
+
+
+def keyset_segments(column: str, order: Order, after):
+    '''Returns the `(predicate, order_by)` pairs that, run in turn, list the rows
+    following `after` in `ORDER BY column, treasure_id` (both in `order`).
+    Predicates take the cursor as the `:after_value` and `:after_id` parameters.
+
+    PostgreSQL sorts NULLs last ascending and first descending, and row
+    comparisons never match NULLs, so a page that crosses between NULL and
+    non-NULL sort values continues in a second, still index-friendly, segment.
+    Cursor values are cast to the column type so that `cost_at_auction` is
+    compared as a `REAL` rather than widened to double precision.
+    '''
+    col = f"treasures.{column}"
+    after_value = f"CAST(:after_value AS {SORT_COLUMN_TYPES[column]})"
+    if order == Order.asc:
+        if after is None:
+            return [(None, f"{col} ASC, treasures.treasure_id ASC")]
+        if after[0] is None:
+            return [(f"{col} IS NULL AND treasures.treasure_id > :after_id", "treasures.treasure_id ASC")]
+        return [
+            (f"({col}, treasures.treasure_id) > ({after_value}, :after_id)", f"{col} ASC, treasures.treasure_id ASC"),
+            (f"{col} IS NULL", "treasures.treasure_id ASC"),
+        ]
+
+    if after is None:
+        return [(None, f"{col} DESC, treasures.treasure_id DESC")]
+    if after[0] is None:
+        return [
+            (f"{col} IS NULL AND treasures.treasure_id < :after_id", "treasures.treasure_id DESC"),
+            (f"{col} IS NOT NULL", f"{col} DESC, treasures.treasure_id DESC"),
+        ]
+    return [(f"({col}, treasures.treasure_id) < ({after_value}, :after_id)", f"{col} DESC, treasures.treasure_id DESC")]
+
+
+class TreasureFilters:
+    '''The treasure filters shared by the listing, export and facets
+    endpoints. `conditions` renders them as SQL on `treasures` with `:name`
+    placeholders, one query shape per combination of filters, so that each
+    combination is planned for the indexes that serve it.'''
+
+    def __init__(
+        self,
+        colour: Colour = None,
+        min_age: int = None,
+        max_age: int = None,
+        min_cost: float = None,
+        max_cost: float = None,
+        shop_id: Annotated[list[int] | None, Query()] = None,
+    ):
+        for name, low, high in [("age", min_age, max_age), ("cost", min_cost, max_cost)]:
+            if low is not None and high is not None and low > high:
+                raise HTTPException(status_code=422, detail=f"min_{name} must not be greater than max_{name}")
+        self.colour = colour.value if colour else None
+        self.min_age = min_age
+        self.max_age = max_age
+        self.min_cost = min_cost
+        self.max_cost = max_cost
+        self.shop_ids = sorted(set(shop_id)) if shop_id else None
+
+    def conditions(self) -> list:
+        conditions = []
+        if self.colour is not None:
+            conditions.append("treasures.colour = :colour")
+        if self.min_age is not None:
+            conditions.append("treasures.age >= :min_age")
+        if self.max_age is not None:
+            conditions.append("treasures.age <= :max_age")
+        # Bounds are compared as REAL, like the column, so the index on it applies.
+        if self.min_cost is not None:
+            conditions.append("treasures.cost_at_auction >= CAST(:min_cost AS REAL)")
+        if self.max_cost is not None:
+            conditions.append("treasures.cost_at_auction <= CAST(:max_cost AS REAL)")
+        if self.shop_ids is not None:
+            conditions.append("treasures.shop_id = ANY(CAST(:shop_ids AS INT[]))")
+        return conditions
+
+    def params(self) -> dict:
+        return {
+            "colour": self.colour, "min_age": self.min_age, "max_age": self.max_age,
+            "min_cost": self.min_cost, "max_cost": self.max_cost, "shop_ids": self.shop_ids,
+        }
+
+    def cache_key(self) -> tuple:
+        return (
+            self.colour, self.min_age, self.max_age, self.min_cost, self.max_cost,
+            tuple(self.shop_ids) if self.shop_ids else None,
+        )
+
+
+TREASURE_COLUMNS = {
+    "treasure_id": "treasures.treasure_id",
+    "treasure_name": "treasures.treasure_name",
+    "colour": "treasures.colour",
+    "age": "treasures.age",
+    "cost_at_auction": "treasures.cost_at_auction",
+    "shop_name": "shops.shop_name",
+}
+
+
+def select_treasures_query(
+    predicate: str, order_by: str, conditions: list = (), columns: tuple = tuple(TREASURE_COLUMNS)
+) -> str:
+    '''Returns one query shape of the treasures listing, selecting only
+    `columns`; it takes the parameters of `conditions` and `:limit` (`None`
+    for no limit).'''
+    conditions = ([predicate] if predicate else []) + list(conditions)
+    if "shop_name" in columns:
+        join = "JOIN shops ON treasures.shop_id = shops.shop_id"
+    else:
+        # Equivalent to the join, as `shop_id` is a foreign key.
+        join = ""
+        conditions.append("treasures.shop_id IS NOT NULL")
+
+    return f"""
+        SELECT 
+            {", ".join(TREASURE_COLUMNS[column] for column in columns)}
+        FROM treasures
+        {join}
+        {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        ORDER BY {order_by}
+        LIMIT :limit
+    """
 
-        select_query = f"""
-            SELECT 
+
+def listing_fields(columns: list):
+    '''Returns a dependency that parses the `fields` query parameter, a
+    comma-separated subset of `columns`, into a tuple in `columns` order, or
+    `None` when absent.'''
+    def fields_param(
+        fields: str = Query(None, description=f"Comma-separated subset of: {', '.join(columns)}"),
+    ):
+        if fields is None:
+            return None
+        requested = {field.strip() for field in fields.split(",")} - {""}
+        unknown = sorted(requested - set(columns))
+        if not requested or unknown:
+            raise HTTPException(
+                status_code=422,
+                detail=f"fields must be a comma-separated list of: {', '.join(columns)}"
+                + (f"; unknown: {', '.join(unknown)}" if unknown else ""),
+            )
+        return tuple(column for column in columns if column in requested)
+    return fields_param
+
+
+def project(column_names: list, rows: list, fields: tuple):
+    '''Returns `(fields, rows)` keeping only the `fields` columns of `rows`.'''
+    if fields is None or tuple(column_names) == fields:
+        return column_names, rows
+    indexes = [column_names.index(field) for field in fields]
+    return list(fields), [[row[index] for index in indexes] for row in rows]
+
+
+def data_version(db) -> int:
+    rows, _ = statements.run(db, SELECT_DATA_VERSION)
+    return rows[0][0]
+
+
+def make_etag(version: int, cache_key: tuple) -> str:
+    '''A weak ETag for the response to `cache_key` at data `version`.'''
+    digest = hashlib.blake2b(repr(cache_key).encode(), digest_size=8).hexdigest()
+    return f'W/"{version}-{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def json_response(body: bytes, etag: str) -> Response:
+    return Response(content=body, media_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def cached_response(version: int, request: Request, cache_key: tuple):
+    '''Returns the ETag for `cache_key` at data `version` and, if the request
+    can be answered without querying, the 304 or cached response. Read the
+    version first, so that a body built afterwards is never older than its
+    ETag.'''
+    etag = make_etag(version, cache_key)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return etag, not_modified(etag)
+    cached_body = response_cache.get((cache_key, version))
+    if cached_body is not None:
+        return etag, json_response(cached_body, etag)
+    return etag, None
+
+
+@app.get("/api/treasures")
+async def get_all_treasures(
+    request: Request,
+    sort_by: SortBy = SortBy.age,
+    order: Order = Order.asc,
+    filters: TreasureFilters = Depends(),
+    limit: int = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: str = None,
+    listing_format: ListingFormat = Query(ListingFormat.objects, alias="format"),
+    fields: tuple = Depends(listing_fields(list(TREASURE_COLUMNS))),
+):
+    '''Lists treasures; `fields` narrows the columns, in the query itself.'''
+    after_key = decode_cursor(after, sort_by, order) if after else None
+
+    cache_key = (
+        "treasures", sort_by.value, order.value, filters.cache_key(), limit, after, listing_format.value, fields
+    )
+    columns = tuple(TREASURE_COLUMNS)
+    if fields:
+        # A page needs its last row's sort value and id for the next cursor.
+        needed = set(fields) | ({sort_by.value, "treasure_id"} if limit else set())
+        columns = tuple(column for column in TREASURE_COLUMNS if column in needed)
+    params = filters.params()
+    if after_key:
+        params["after_value"], params["after_id"] = after_key
+
+    if reads_from_read_model(request):
+        version = read_model.version
+        etag, response = cached_response(version, request, cache_key)
+        if response is not None:
+            return response
+        generation = response_cache.generation
+
+        # Off the event loop: the snapshot is locked while a refresh applies.
+        column_names, treasures_data = await async_pool.run(
+            read_model.treasures, sort_by.value, order == Order.desc, filters, after_key, limit + 1 if limit else None
+        )
+    else:
+        async with async_pool.connection(read_connection(request)) as db:
+            version = await db.call(data_version)
+            etag, response = cached_response(version, request, cache_key)
+            if response is not None:
+                return response
+            generation = response_cache.generation
+
+            treasures_data = []
+            for predicate, order_by in keyset_segments(sort_by.value, order, after_key):
+                select_query = select_treasures_query(predicate, order_by, filters.conditions(), columns)
+                rows, column_names = await db.call(
+                    statements.run, select_query, limit=limit + 1 - len(treasures_data) if limit else None, **params
+                )
+                treasures_data += rows
+                if limit and len(treasures_data) > limit:
+                    break
+
+    next_cursor = None
+    if limit and len(treasures_data) > limit:
+        treasures_data = treasures_data[:limit]
+        last = dict(zip(column_names, treasures_data[-1]))
+        next_cursor = encode_cursor(sort_by, order, last[sort_by.value], last["treasure_id"])
+    column_names, treasures_data = project(column_names, treasures_data, fields)
+
+    with metrics.time("response_encode_duration_seconds", key="treasures"):
+        body = encode_rows("treasures", column_names, treasures_data, listing_format, next_cursor=next_cursor)
+    response_cache.put((cache_key, version), body, generation)
+    return json_response(body, etag)
+
+
+SEARCH_WORD = re.compile(r"[^\W_]+")
+
+def search_tsquery(q: str) -> str:
+    '''The `tsquery` text matching names with a word starting with each word
+    of `q`; only letters and digits are kept, so it is always valid.'''
+    return " & ".join(f"{word}:*" for word in SEARCH_WORD.findall(q.lower()))
+
+
+def like_prefix(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def search_treasures_query(after: bool = False) -> str:
+    '''Returns the search query; it takes the `:tsquery`, `:name` (the
+    lowercased search text), `:name_prefix` and `:limit` parameters, and
+    `:after_rank`, `:after_name` and `:after_id` if `after`.
+
+    Matches come from the full-text index on `treasure_name` and are ranked
+    exact name first, then names starting with the search text, then the rest,
+    each by name. The rank is returned as the last column.
+    '''
+    return f"""
+        SELECT * FROM (
+            SELECT
                 treasures.treasure_id, treasures.treasure_name, treasures.colour,
-                treasures.age, treasures.cost_at_auction, shops.shop_name
+                treasures.age, treasures.cost_at_auction, shops.shop_name,
+                CASE
+                    WHEN lower(treasures.treasure_name) = :name THEN 0
+                    WHEN lower(treasures.treasure_name) LIKE :name_prefix THEN 1
+                    ELSE 2
+                END AS search_rank
             FROM treasures
             JOIN shops ON treasures.shop_id = shops.shop_id
-        """
+            WHERE to_tsvector('simple', treasures.treasure_name) @@ to_tsquery('simple', :tsquery)
+        ) AS matches
+        {"WHERE (search_rank, treasure_name, treasure_id) > (:after_rank, CAST(:after_name AS VARCHAR), :after_id)"
+         if after else ""}
+        ORDER BY search_rank, treasure_name, treasure_id
+        LIMIT :limit
+    """
+
+
+@app.get("/api/treasures/search")
+async def search_treasures(
+    request: Request,
+    q: str = Query(min_length=1, max_length=256),
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    after: str = None,
+    listing_format: ListingFormat = Query(ListingFormat.objects, alias="format"),
+):
+    '''Finds treasures with a word in their name starting with each word of
+    `q`, case-insensitively: "gold comp" finds "Golden Compass".'''
+    tsquery = search_tsquery(q)
+    params = {"tsquery": tsquery, "name": q.lower(), "name_prefix": like_prefix(q.lower()), "limit": limit + 1}
+    if after:
+        values = decode_payload(after)
+        if not (
+            len(values) == 4 and values[0] == tsquery and type(values[1]) == int
+            and type(values[2]) == str and type(values[3]) == int
+        ):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        params["after_rank"], params["after_name"], params["after_id"] = values[1:]
+
+    if not tsquery:
+        return Response(content=encode_rows("treasures", [], [], listing_format, next_cursor=None),
+                        media_type="application/json")
+
+    cache_key = ("search", tsquery, q.lower(), limit, after, listing_format.value)
+    async with async_pool.connection(read_connection(request)) as db:
+        version = await db.call(data_version)
+        etag, response = cached_response(version, request, cache_key)
+        if response is not None:
+            return response
+        generation = response_cache.generation
+        rows, column_names = await db.call(statements.run, search_treasures_query(after=after is not None), **params)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_payload([tsquery, last[-1], last[1], last[0]])
+
+    body = encode_rows(
+        "treasures", column_names[:-1], [row[:-1] for row in rows], listing_format, next_cursor=next_cursor
+    )
+    response_cache.put((cache_key, version), body, generation)
+    return json_response(body, etag)
 
-        if colour:
-            select_query += f"""WHERE colour = {literal(colour.value)}"""
 
-        select_query += f"""ORDER BY treasures.{identifier(sort_by.value)} {identifier(order.value)};"""
+class ExportFormat(Enum):
+    ndjson = "ndjson"
+    csv = "csv"
 
-        treasures_data = db.run(sql=select_query)
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+
+EXPORT_CHUNK_SIZE = 1000
+
+
+def encode_export_chunk(export_format: ExportFormat, column_names: list, rows: list) -> bytes:
+    if export_format == ExportFormat.ndjson:
+        return b"".join(dumps(dict(zip(column_names, row))) + b"\n" for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+async def stream_export(request: Request, select_query: str, params: dict, export_format: ExportFormat):
+    '''Yields the export a chunk at a time from a server-side cursor over
+    `select_query`, holding a read connection until it finishes or is closed.'''
+    async with async_pool.connection(read_connection(request)) as db:
+        await db.run("START TRANSACTION READ ONLY")
+        await db.run(f"DECLARE treasures_export NO SCROLL CURSOR FOR {select_query}", limit=None, **params)
+        rows = await db.run(f"FETCH FORWARD {EXPORT_CHUNK_SIZE} FROM treasures_export")
         column_names = [c["name"] for c in db.columns]
-        formatted_data = [dict(zip(column_names, treasure)) for treasure in treasures_data]
-        return {"treasures": formatted_data}
-    finally:
-        if db:
-            db.close()
+        if export_format == ExportFormat.csv:
+            yield encode_export_chunk(export_format, column_names, [column_names])
+        while rows:
+            yield encode_export_chunk(export_format, column_names, rows)
+            rows = await db.run(f"FETCH FORWARD {EXPORT_CHUNK_SIZE} FROM treasures_export")
+        await db.run("COMMIT")
+
+
+async def prepend(first_chunk: bytes, chunks):
+    yield first_chunk
+    async for chunk in chunks:
+        yield chunk
+
+
+@app.get("/api/treasures/export")
+async def export_treasures(
+    request: Request,
+    export_format: ExportFormat = Query(ExportFormat.ndjson, alias="format"),
+    sort_by: SortBy = SortBy.age,
+    order: Order = Order.asc,
+    filters: TreasureFilters = Depends(),
+):
+    '''Streams every treasure matching the filters as NDJSON or CSV.
+
+    Rows are fetched from a server-side cursor `EXPORT_CHUNK_SIZE` at a time
+    and encoded chunk by chunk, so memory use does not grow with the table.
+    '''
+    predicate, order_by = keyset_segments(sort_by.value, order, None)[0]
+    select_query = select_treasures_query(predicate, order_by, filters.conditions())
+
+    # Starting the generator now makes a saturated pool or the first FETCH
+    # fail before the response does. From here on the generator owns the
+    # connection, which goes back to the pool when it is closed or collected,
+    # even if the response is never sent.
+    chunks = stream_export(request, select_query, filters.params(), export_format)
+    first_chunk = await anext(chunks, b"")
+
+    return StreamingResponse(
+        prepend(first_chunk, chunks),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename=treasures.{export_format.value}"},
+    )
+
+
+MAX_FACET_BUCKETS = 100
+
+def select_facets_query(conditions: list = ()) -> str:
+    '''Returns the facets query for the given filter conditions; it takes the
+    `:buckets` parameter and those of `conditions`.
+
+    Every facet comes out of one grouping-sets aggregate over the filtered
+    rows: one row per colour, per shop and per histogram bucket, plus a grand
+    total row carrying the count and the `age` and `cost_at_auction` ranges.
+    Histogram buckets split each range into `:buckets` equal widths.
+    '''
+    def bucket(column, low, high):
+        return f"""CASE
+            WHEN {column} IS NULL THEN NULL
+            WHEN {high} = {low} THEN 1
+            ELSE LEAST(width_bucket({column}, {low}, {high}, CAST(:buckets AS INT)), CAST(:buckets AS INT))
+        END"""
+
+    return f"""
+        WITH filtered AS MATERIALIZED (
+            SELECT colour, shop_id, age, cost_at_auction
+            FROM treasures
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        ),
+        bounds AS (
+            SELECT MIN(age) AS min_age, MAX(age) AS max_age,
+                MIN(cost_at_auction) AS min_cost, MAX(cost_at_auction) AS max_cost
+            FROM filtered
+        ),
+        bucketed AS (
+            SELECT colour, shop_id,
+                {bucket("age", "min_age", "max_age")} AS age_bucket,
+                {bucket("cost_at_auction", "min_cost", "max_cost")} AS cost_bucket
+            FROM filtered CROSS JOIN bounds
+        )
+        SELECT
+            CASE
+                WHEN GROUPING(colour) = 0 THEN 'colour'
+                WHEN GROUPING(shop_id) = 0 THEN 'shop_id'
+                WHEN GROUPING(age_bucket) = 0 THEN 'age'
+                WHEN GROUPING(cost_bucket) = 0 THEN 'cost_at_auction'
+                ELSE 'total'
+            END AS facet,
+            colour, shop_id, age_bucket, cost_bucket, COUNT(*) AS count,
+            (SELECT ARRAY[min_age, max_age] FROM bounds) AS age_range,
+            (SELECT ARRAY[min_cost, max_cost] FROM bounds) AS cost_range
+        FROM bucketed
+        GROUP BY GROUPING SETS ((colour), (shop_id), (age_bucket), (cost_bucket), ())
+    """
+
+
+def histogram(value_range: list, buckets: int, counts: dict) -> list:
+    '''Lists `buckets` equal-width buckets over `value_range` with their
+    counts, plus a bucket without bounds for NULL values if there are any.'''
+    low, high = value_range
+    if low is None:
+        return [{"lower": None, "upper": None, "count": counts[None]}] if None in counts else []
+    width = (high - low) / buckets
+    result = [
+        {"lower": round(low + i * width, 2), "upper": round(low + (i + 1) * width, 2), "count": counts.get(i + 1, 0)}
+        for i in range(buckets)
+    ]
+    if None in counts:
+        result.append({"lower": None, "upper": None, "count": counts[None]})
+    return result
+
+
+@app.get("/api/treasures/facets")
+async def get_treasure_facets(
+    request: Request,
+    filters: TreasureFilters = Depends(),
+    buckets: int = Query(10, ge=1, le=MAX_FACET_BUCKETS),
+):
+    '''Returns the treasure count per colour and per shop, and histograms of
+    `age` and `cost_at_auction`, for the treasures matching the filters.'''
+    cache_key = ("facets", filters.cache_key(), buckets)
+
+    async with async_pool.connection(read_connection(request)) as db:
+        version = await db.call(data_version)
+        etag, response = cached_response(version, request, cache_key)
+        if response is not None:
+            return response
+        generation = response_cache.generation
+
+        rows, _ = await db.call(
+            statements.run, select_facets_query(filters.conditions()), buckets=buckets, **filters.params()
+        )
+
+    facets = {"colour": [], "shop_id": []}
+    age_counts, cost_counts = {}, {}
+    for facet, row_colour, row_shop_id, age_bucket, cost_bucket, count, age_range, cost_range in rows:
+        if facet == "colour":
+            facets["colour"].append({"colour": row_colour, "count": count})
+        elif facet == "shop_id":
+            facets["shop_id"].append({"shop_id": row_shop_id, "count": count})
+        elif facet == "age":
+            age_counts[age_bucket] = count
+        elif facet == "cost_at_auction":
+            cost_counts[cost_bucket] = count
+        else:
+            total = count
+    for key in ["colour", "shop_id"]:
+        facets[key].sort(key=lambda value: (-value["count"], value[key] is None, value[key] or 0))
+    facets["age"] = histogram(age_range, buckets, age_counts)
+    facets["cost_at_auction"] = histogram(cost_range, buckets, cost_counts)
+
+    body = dumps({"total": total, "facets": facets})
+    response_cache.put((cache_key, version), body, generation)
+    return json_response(body, etag)
 
 
 class NewTreasure(BaseModel):
-    treasure_name: str
-    colour: str
+    # The lengths of the `VARCHAR` columns.
+    treasure_name: str = Field(max_length=256)
+    colour: str = Field(max_length=42)
     age: int
     cost_at_auction: float
     shop_id: int
 
-@app.post("/api/treasures", status_code=201)
-def add_new_treasure(new_treasure: NewTreasure):
-    db = None
+INSERT_TREASURE = """
+    INSERT INTO treasures
+        (treasure_name, colour, age, cost_at_auction, shop_id)
+    VALUES
+        (:treasure_name, :colour, :age, :cost_at_auction, :shop_id)
+    RETURNING *;
+"""
 
-    try:
-        db = connect_to_db()
-
-        insert_query = f"""
-            INSERT INTO treasures
-                (treasure_name, colour, age, cost_at_auction, shop_id)
-            VALUES
-                ({literal(new_treasure.treasure_name)}, {literal(new_treasure.colour)}, {literal(new_treasure.age)},
-                {literal(new_treasure.cost_at_auction)}, {literal(new_treasure.shop_id)})
-            RETURNING *;
-        """
-
-        treasure_data = db.run(sql=insert_query)[0]
-        column_names = [c["name"] for c in db.columns]
-        formatted_data = dict(zip(column_names, treasure_data))
+
+def insert_treasure(db, new_treasure: NewTreasure) -> dict:
+    treasure_data, column_names = statements.run(
+        db, INSERT_TREASURE,
+        treasure_name=new_treasure.treasure_name,
+        colour=new_treasure.colour,
+        age=new_treasure.age,
+        cost_at_auction=new_treasure.cost_at_auction,
+        shop_id=new_treasure.shop_id,
+    )
+    return dict(zip(column_names, treasure_data[0]))
+
+@app.post("/api/treasures", status_code=201, dependencies=[Depends(read_your_writes)])
+async def add_new_treasure(new_treasure: NewTreasure):
+    if treasure_writes.enabled:
+        return {"treasure": await treasure_writes.submit(new_treasure)}
+    async with async_pool.connection(pool.connection()) as db:
+        formatted_data = await db.call(insert_treasure, new_treasure)
+        response_cache.invalidate()
         return {"treasure": formatted_data}
-    finally:
-        if db:
-            db.close()
+
+
+class NewTreasureBatch(BaseModel):
+    treasures: list[NewTreasure] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+SELECT_SHOP_IDS = """
+    SELECT shop_id FROM shops WHERE shop_id = ANY(CAST(:shop_ids AS INT[])) FOR KEY SHARE;
+"""
+
+INSERT_TREASURES = """
+    INSERT INTO treasures
+        (treasure_name, colour, age, cost_at_auction, shop_id)
+    SELECT treasure_name, colour, age, cost_at_auction, shop_id
+    FROM unnest(
+        CAST(:treasure_names AS VARCHAR[]), CAST(:colours AS VARCHAR[]), CAST(:ages AS INT[]),
+        CAST(:costs_at_auction AS FLOAT8[]), CAST(:shop_ids AS INT[])
+    ) WITH ORDINALITY AS batch (treasure_name, colour, age, cost_at_auction, shop_id, position)
+    ORDER BY position
+    RETURNING *;
+"""
+
+
+def insert_treasures(db, new_treasures: list) -> list:
+    '''Inserts `new_treasures` with a single statement in one transaction and
+    returns the created rows in input order.
+
+    Items referencing a shop that does not exist are reported together as a
+    422 naming each failing item, and nothing is inserted.
+    '''
+    db.run("START TRANSACTION")
+    shop_ids = [new_treasure.shop_id for new_treasure in new_treasures]
+    known_shop_ids, _ = statements.run(db, SELECT_SHOP_IDS, shop_ids=list(set(shop_ids)))
+    known_shop_ids = {row[0] for row in known_shop_ids}
+    errors = [
+        {
+            "type": "foreign_key",
+            "loc": ["body", "treasures", position, "shop_id"],
+            "msg": f"No shop found with given ID: {shop_id}",
+            "input": shop_id,
+        }
+        for position, shop_id in enumerate(shop_ids) if shop_id not in known_shop_ids
+    ]
+    if errors:
+        db.run("ROLLBACK")
+        raise HTTPException(status_code=422, detail=errors)
+
+    treasures_data, column_names = statements.run(
+        db, INSERT_TREASURES,
+        treasure_names=[new_treasure.treasure_name for new_treasure in new_treasures],
+        colours=[new_treasure.colour for new_treasure in new_treasures],
+        ages=[new_treasure.age for new_treasure in new_treasures],
+        costs_at_auction=[new_treasure.cost_at_auction for new_treasure in new_treasures],
+        shop_ids=shop_ids,
+    )
+    db.run("COMMIT")
+    response_cache.invalidate()
+    # Serial ids are drawn in insertion order, which follows `position`.
+    treasures_data.sort(key=lambda row: row[column_names.index("treasure_id")])
+    return [dict(zip(column_names, treasure)) for treasure in treasures_data]
+
+async def insert_coalesced_treasures(new_treasures: list) -> list:
+    '''Inserts the treasures of concurrent `POST /api/treasures` requests with
+    one statement in one transaction, and returns each request's row.
+
+    If the statement fails, e.g. because one of the treasures names a shop
+    that does not exist, the treasures are inserted one at a time instead,
+    so that each request gets its own row or its own error.
+    '''
+    async with async_pool.connection(pool.connection()) as db:
+        await db.run("START TRANSACTION")
+        try:
+            treasures_data, column_names = await db.call(
+                statements.run, INSERT_TREASURES,
+                treasure_names=[new_treasure.treasure_name for new_treasure in new_treasures],
+                colours=[new_treasure.colour for new_treasure in new_treasures],
+                ages=[new_treasure.age for new_treasure in new_treasures],
+                costs_at_auction=[new_treasure.cost_at_auction for new_treasure in new_treasures],
+                shop_ids=[new_treasure.shop_id for new_treasure in new_treasures],
+            )
+            await db.run("COMMIT")
+        except DatabaseError:
+            await db.run("ROLLBACK")
+            metrics.inc("write_coalesce_fallbacks_total")
+            results = []
+            for new_treasure in new_treasures:
+                await db.run("START TRANSACTION")
+                try:
+                    results.append(await db.call(insert_treasure, new_treasure))
+                    await db.run("COMMIT")
+                except DatabaseError as exc:
+                    await db.run("ROLLBACK")
+                    results.append(exc)
+            response_cache.invalidate()
+            return results
+    response_cache.invalidate()
+    # Serial ids are drawn in insertion order, which follows `position`.
+    treasures_data.sort(key=lambda row: row[column_names.index("treasure_id")])
+    return [dict(zip(column_names, treasure)) for treasure in treasures_data]
+
+treasure_writes = WriteCoalescer.from_env(insert_coalesced_treasures)
+
+@app.post("/api/treasures/batch", status_code=201, dependencies=[Depends(read_your_writes)])
+async def add_new_treasures(new_treasure_batch: NewTreasureBatch):
+    async with async_pool.connection(pool.connection()) as db:
+        return {"treasures": await db.call(insert_treasures, new_treasure_batch.treasures)}
 
 
 class UpdatedTreasurePrice(BaseModel):
     cost_at_auction: float = Field(gt=0)
 
-@app.patch("/api/treasures/{treasure_id}")
-def update_treasure_price(treasure_id: int, updated_treasure_price: UpdatedTreasurePrice):
-    db = None
-    try:
-        db = connect_to_db()
-
-        update_query = f"""
-            UPDATE treasures
-            SET cost_at_auction = {literal(updated_treasure_price.cost_at_auction)}
-            WHERE treasure_id = {literal(treasure_id)}
-            RETURNING *;
-        """
+UPDATE_TREASURE_PRICE = """
+    UPDATE treasures
+    SET cost_at_auction = :cost_at_auction
+    WHERE treasure_id = :treasure_id
+    RETURNING *;
+"""
 
-        treasure_data = db.run(sql=update_query)[0]
-        column_names = [c["name"] for c in db.columns]
-        formatted_data = dict(zip(column_names, treasure_data))
+@app.patch("/api/treasures/{treasure_id}", dependencies=[Depends(read_your_writes)])
+async def update_treasure_price(treasure_id: int, updated_treasure_price: UpdatedTreasurePrice):
+    async with async_pool.connection(pool.connection()) as db:
+        treasure_data, column_names = await db.call(
+            statements.run, UPDATE_TREASURE_PRICE,
+            cost_at_auction=updated_treasure_price.cost_at_auction,
+            treasure_id=treasure_id,
+        )
+        if not treasure_data:
+            raise HTTPException(status_code=404, detail=f"No treasure found with given ID: {treasure_id}")
+        response_cache.invalidate()
+        formatted_data = dict(zip(column_names, treasure_data[0]))
         return {"treasure": formatted_data}
-    except IndexError:
-        raise HTTPException(status_code=404, detail=f"No treasure found with given ID: {treasure_id}")
-    finally:    
-        if db:
-            db.close()
 
 
-@app.delete("/api/treasures/{treasure_id}", status_code=204)
-def delete_treasure(treasure_id: int):
-    db = None
-    try:
-        db = connect_to_db()
+DELETE_TREASURE = """DELETE FROM treasures WHERE treasure_id = :treasure_id RETURNING treasure_id;"""
 
-        query_return = db.run(f"""DELETE FROM treasures WHERE treasure_id = {literal(treasure_id)} RETURNING *;""")
+@app.delete("/api/treasures/{treasure_id}", status_code=204, dependencies=[Depends(read_your_writes)])
+async def delete_treasure(treasure_id: int):
+    async with async_pool.connection(pool.connection()) as db:
+        query_return, _ = await db.call(statements.run, DELETE_TREASURE, treasure_id=treasure_id)
 
         if not query_return:
             raise HTTPException(status_code=404, detail=f"No treasure found with given ID: {treasure_id}")
-    finally:
-        if db:
-            db.close()
+        response_cache.invalidate()
+
+
+class TreasurePriceUpdate(UpdatedTreasurePrice):
+    treasure_id: int
+
+class TreasurePriceUpdates(BaseModel):
+    treasures: list[TreasurePriceUpdate] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+UPDATE_TREASURE_PRICES = """
+    UPDATE treasures
+    SET cost_at_auction = updates.cost_at_auction
+    FROM unnest(CAST(:treasure_ids AS INT[]), CAST(:costs_at_auction AS FLOAT8[]))
+        AS updates (treasure_id, cost_at_auction)
+    WHERE treasures.treasure_id = updates.treasure_id
+    RETURNING treasures.*;
+"""
+
+
+def raise_if_not_found(requested_ids: list, found_ids: set):
+    missing_ids = [treasure_id for treasure_id in requested_ids if treasure_id not in found_ids]
+    if missing_ids:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No treasures found with given IDs: {', '.join(map(str, missing_ids))}"
+        )
+
+
+@app.patch("/api/treasures", dependencies=[Depends(read_your_writes)])
+async def update_treasure_prices(treasure_price_updates: TreasurePriceUpdates):
+    '''Updates many prices with one statement; if any ID does not exist nothing
+    is updated and the missing IDs are reported with a 404.'''
+    treasure_ids = [update.treasure_id for update in treasure_price_updates.treasures]
+    duplicate_ids = sorted(treasure_id for treasure_id, count in Counter(treasure_ids).items() if count > 1)
+    if duplicate_ids:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Treasure IDs must be unique, repeated: {', '.join(map(str, duplicate_ids))}"
+        )
+
+    async with async_pool.connection(pool.connection()) as db:
+        await db.run("START TRANSACTION")
+        treasures_data, column_names = await db.call(
+            statements.run, UPDATE_TREASURE_PRICES,
+            treasure_ids=treasure_ids,
+            costs_at_auction=[update.cost_at_auction for update in treasure_price_updates.treasures],
+        )
+        treasures_by_id = {treasure[column_names.index("treasure_id")]: treasure for treasure in treasures_data}
+        try:
+            raise_if_not_found(treasure_ids, treasures_by_id.keys())
+        except HTTPException:
+            await db.run("ROLLBACK")
+            raise
+        await db.run("COMMIT")
+        response_cache.invalidate()
+
+    formatted_data = [dict(zip(column_names, treasures_by_id[treasure_id])) for treasure_id in treasure_ids]
+    return {"treasures": formatted_data}
+
+
+class TreasureIds(BaseModel):
+    treasure_ids: list[int] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+DELETE_TREASURES = """
+    DELETE FROM treasures WHERE treasure_id = ANY(CAST(:treasure_ids AS INT[])) RETURNING treasure_id;
+"""
+
+@app.delete("/api/treasures", status_code=204, dependencies=[Depends(read_your_writes)])
+async def delete_treasures(treasure_ids: TreasureIds):
+    '''Deletes many treasures with one statement; if any ID does not exist
+    nothing is deleted and the missing IDs are reported with a 404.'''
+    requested_ids = list(dict.fromkeys(treasure_ids.treasure_ids))
+    async with async_pool.connection(pool.connection()) as db:
+        await db.run("START TRANSACTION")
+        query_return, _ = await db.call(statements.run, DELETE_TREASURES, treasure_ids=requested_ids)
+        try:
+            raise_if_not_found(requested_ids, {row[0] for row in query_return})
+        except HTTPException:
+            await db.run("ROLLBACK")
+            raise
+        await db.run("COMMIT")
+        response_cache.invalidate()
 
 
 @app.get("/api/shops")
-def get_all_shops():
-    db = None
-    try:
-        db = connect_to_db()
-
-        select_query = f"""
-            SELECT 
-                shops.shop_id, shops.shop_name, shops.slogan, SUM(treasures.cost_at_auction) AS stock_value
-            FROM shops
-            JOIN treasures ON shops.shop_id = treasures.shop_id
-            GROUP BY shops.shop_id
-            ORDER by shops.shop_id;
-        """
-
-        shops_data = db.run(sql=select_query)
-        column_names = [c["name"] for c in db.columns]
-        formatted_data = [dict(zip(column_names, shop)) for shop in shops_data]
-        return {"shops": formatted_data}
-    finally:
-        if db:
-            db.close()
+async def get_all_shops(
+    request: Request,
+    listing_format: ListingFormat = Query(ListingFormat.objects, alias="format"),
+    fields: tuple = Depends(listing_fields(list(SHOP_COLUMNS))),
+):
+    cache_key = ("shops", listing_format.value, fields)
+
+    if reads_from_read_model(request):
+        snapshot = read_model.snapshot
+        version = snapshot.version
+        etag, response = cached_response(version, request, cache_key)
+        if response is not None:
+            return response
+        generation = response_cache.generation
+
+        column_names, shops_data = snapshot.shops
+    else:
+        async with async_pool.connection(read_connection(request)) as db:
+            version = await db.call(data_version)
+            etag, response = cached_response(version, request, cache_key)
+            if response is not None:
+                return response
+            generation = response_cache.generation
+
+            shops_data, column_names = await db.call(statements.run, select_shops_query(fields or tuple(SHOP_COLUMNS)))
+    column_names, shops_data = project(column_names, shops_data, fields)
+
+    with metrics.time("response_encode_duration_seconds", key="shops"):
+        body = encode_rows("shops", column_names, shops_data, listing_format)
+    response_cache.put((cache_key, version), body, generation)
+    return json_response(body, etag)
+
+
+@app.get("/api/cache")
+async def get_cache_stats():
+    return {"cache": response_cache.stats()}
+
+
+@app.get("/api/read-model")
+async def get_read_model_stats():
+    return {"read_model": read_model.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    cache_stats = response_cache.stats()
+    for event in ["hits", "misses", "evictions", "expirations", "invalidations"]:
+        metrics.set("response_cache_events_total", cache_stats[event], event=event)
+    metrics.set("response_cache_entries", cache_stats["entries"])
+    metrics.set("response_cache_bytes", cache_stats["bytes"])
+    metrics.set("db_pool_connections", pool.idle, state="idle")
+    metrics.set("db_pool_connections", pool.size - pool.idle, state="in_use")
+    metrics.set("db_async_slots", async_pool.in_use, state="in_use")
+    metrics.set("db_async_slots", async_pool.waiting, state="waiting")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.exception_handler(DatabaseError)
 def handle_db_error(request: Request, exc: DatabaseError):
     print(exc)
-    raise HTTPException(status_code=500, detail="Server error: logged for investigation")
\ No newline at end of file
+    raise HTTPException(status_code=500, detail="Server error: logged for investigation")
+
+
+@app.exception_handler(PoolTimeout)
+def handle_pool_timeout(request: Request, exc: PoolTimeout):
+    print(exc)
+    return JSONResponse(status_code=503, content={"detail": "Service unavailable: database is busy, please retry"})
\ No newline at end of file
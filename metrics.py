@@ -0,0 +1,216 @@
+'''This module contains the request and query instrumentation of the
+`Cat's Rare Treasures` FastAPI app, exposed on `GET /metrics` in the
+Prometheus text format.
+
+Requests are timed per route template by `RequestMetricsMiddleware`, and
+every query is timed per SQL shape (the statement text with its `:name`
+placeholders, whitespace collapsed) by the database layer, together with
+its row count, connection wait and connect times. Queries slower than
+`SLOW_QUERY_MS` are logged with their parameters.
+'''
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import bisect
+import logging
+import threading
+import time
+import os
+
+load_dotenv()
+
+slow_query_log = logging.getLogger("cats_rare_treasures.slow_query")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+METRIC_FAMILIES = {
+    "http_requests_total": ("counter", "HTTP requests by route template and status"),
+    "http_request_duration_seconds": ("histogram", "Time from request start to the last response byte"),
+    "response_encode_duration_seconds": ("histogram", "Time spent encoding response bodies"),
+    "db_query_duration_seconds": ("histogram", "Query execution time by SQL shape"),
+    "db_query_rows_total": ("counter", "Rows returned or affected by SQL shape"),
+    "db_query_errors_total": ("counter", "Queries that raised by SQL shape"),
+    "db_slow_queries_total": ("counter", "Queries slower than SLOW_QUERY_MS by SQL shape"),
+    "db_connect_duration_seconds": ("histogram", "Time taken to open a database connection"),
+    "db_pool_wait_duration_seconds": ("histogram", "Time spent waiting for a pooled connection"),
+    "db_pool_timeouts_total": ("counter", "Connection requests that timed out"),
+    "db_pool_connections": ("gauge", "Pooled connections by state"),
+    "db_async_slots": ("gauge", "Requests holding or queueing for a database slot of the async pool"),
+    "db_async_wait_duration_seconds": ("histogram", "Time spent queueing for a database slot of the async pool"),
+    "db_async_rejections_total": ("counter", "Requests answered with a 503 because the async pool was saturated"),
+    "write_coalesce_batch_size": ("histogram", "Treasures inserted together by the write coalescer"),
+    "write_coalesce_queue_duration_seconds": ("histogram", "Time a coalesced write waited for its batch to start"),
+    "write_coalesce_fallbacks_total": ("counter", "Coalesced batches retried item by item after the batch insert failed"),
+    "db_replica_failures_total": ("counter", "Replicas marked unhealthy after failing to connect"),
+    "db_replica_fallbacks_total": ("counter", "Reads sent to the primary because the chosen replica was busy or down"),
+    "response_compression_bytes_total": ("counter", "Response body bytes before and after compression by content coding"),
+    "response_cache_events_total": ("counter", "Response cache hits, misses, evictions, expirations and invalidations"),
+    "response_cache_entries": ("gauge", "Entries in the response cache"),
+    "response_cache_bytes": ("gauge", "Estimated memory held by the response cache"),
+    "read_model_rows": ("gauge", "Treasures held by the in-process read model"),
+    "read_model_bytes": ("gauge", "Estimated memory held by the in-process read model"),
+    "read_model_refreshes_total": ("counter", "Read model reloads and incremental refreshes from the change feed"),
+}
+
+
+def query_shape(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    '''Cumulative-bucket histogram of observations, as Prometheus expects.'''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield "_bucket", (("le", format_value(bound)),), cumulative
+        yield "_sum", (), self.sum
+        yield "_count", (), self.count
+
+
+class MetricsRegistry:
+    '''A thread-safe store of labelled counters, gauges and histograms for the
+    families in `METRIC_FAMILIES`.
+
+    Queries taking at least `slow_query_seconds` are logged to the
+    `cats_rare_treasures.slow_query` logger; `None` disables the log.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, slow_query_seconds=None):
+        self.buckets = buckets
+        self.slow_query_seconds = slow_query_seconds
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        slow_query_ms = os.getenv("SLOW_QUERY_MS")
+        return cls(slow_query_seconds=float(slow_query_ms) / 1000 if slow_query_ms else None)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = Histogram(buckets or self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def record_query(self, sql, params, seconds, rows):
+        shape = query_shape(sql)
+        self.observe("db_query_duration_seconds", seconds, query=shape)
+        self.inc("db_query_rows_total", max(rows, 0), query=shape)
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            self.inc("db_slow_queries_total", query=shape)
+            slow_query_log.warning(
+                "\U0001F422 Slow query (%.1fms, %d rows): %s params=%.500r", seconds * 1000, rows, shape, params
+            )
+
+    def record_query_error(self, sql):
+        self.inc("db_query_errors_total", query=query_shape(sql))
+
+    def get(self, name, **labels):
+        '''Returns the current value of a counter or gauge, or the histogram.'''
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> str:
+        with self._lock:
+            families = {}
+            for (name, labels), value in self._values.items():
+                samples = value.samples() if isinstance(value, Histogram) else [("", (), value)]
+                families.setdefault(name, []).extend(
+                    f"{name}{suffix}{format_labels(labels + extra)} {format_value(sample)}"
+                    for suffix, extra, sample in samples
+                )
+        lines = []
+        for name in sorted(families):
+            kind, description = METRIC_FAMILIES.get(name, ("untyped", name))
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", *families[name]]
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetricsMiddleware:
+    '''ASGI middleware recording the count and duration of every request by
+    method, route template and status. Durations run until the last body
+    chunk is sent, so streamed responses are timed in full.'''
+
+    def __init__(self, app, registry=None):
+        self.app = app
+        self.registry = registry or metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_and_record(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            route = scope.get("route")
+            # Unmatched paths share one label so that scanners cannot grow the series.
+            path = route.path if route is not None else "unmatched"
+            self.registry.inc("http_requests_total", method=scope["method"], route=path, status=status)
+            self.registry.observe(
+                "http_request_duration_seconds", time.perf_counter() - started, method=scope["method"], route=path
+            )
+
+
+metrics = MetricsRegistry.from_env()
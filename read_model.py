@@ -0,0 +1,560 @@
+'''This module contains the in-process read model of the `Cat's Rare
+Treasures` FastAPI app: a columnar snapshot of `treasures` joined with their
+shops, from which `GET /api/treasures` and `GET /api/shops` are answered
+without querying PostgreSQL.
+
+It is off unless `READ_MODEL=1`. On startup the snapshot is loaded in one
+repeatable-read transaction, after subscribing to the change feed (see
+`db/change_feed.py`). A background thread then applies each batch of
+notifications by re-reading only the changed treasures, and falls back to a
+full reload after a TRUNCATE or if notifications were dropped. Until the
+snapshot is loaded, or while the feed is disconnected, requests are served
+from the database.
+
+Each column is a typed `array`, or a list for names; every sort column has
+a permutation of the row slots in `ORDER BY column, treasure_id` order, and
+every colour a bitmap of its slots. `cost_at_auction` is held in single
+precision like the `REAL` column, so that sorting and range filters compare
+exactly as PostgreSQL does. Names are ordered by code point, which matches
+the database only when its default collation is a libc "C", "POSIX" or
+"C.UTF-8" locale; the read model stays off otherwise.
+'''
+from db.connection import connect_to_db
+from db.change_feed import CHANGE_FEED_CHANNEL
+from db.data_version import SELECT_DATA_VERSION
+from db.shop_stock import SELECT_SHOPS
+from metrics import metrics
+from array import array
+from contextlib import contextmanager
+import bisect
+import json
+import re
+import select
+import struct
+import sys
+import threading
+import os
+
+
+SORT_COLUMNS = ["age", "cost_at_auction", "treasure_name"]
+
+SELECT_SNAPSHOT_TREASURES = """
+    SELECT
+        treasures.treasure_id, treasures.treasure_name, treasures.colour,
+        treasures.age, treasures.cost_at_auction, treasures.shop_id
+    FROM treasures
+    JOIN shops ON treasures.shop_id = shops.shop_id
+"""
+
+SELECT_SHOP_NAMES = "SELECT shop_id, shop_name FROM shops;"
+
+# `datlocprovider` only exists from PostgreSQL 15; before it, every database
+# collates with libc.
+SELECT_COLLATION = """
+    SELECT datcollate, COALESCE(to_jsonb(pg_database) ->> 'datlocprovider', 'c')
+    FROM pg_database WHERE datname = current_database();
+"""
+
+CODE_POINT_COLLATIONS = {"C", "POSIX", "C.UTF-8", "C.utf8"}
+
+LOCALE_PROVIDERS = {"c": "libc", "i": "ICU", "b": "builtin"}
+
+COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+COPY_ESCAPE = re.compile(r"\\(.)")
+
+
+def float4(value: float) -> float:
+    '''Rounds `value` to single precision, as casting it to `REAL` does.'''
+    try:
+        return struct.unpack("f", struct.pack("f", value))[0]
+    except OverflowError:
+        return float("inf") if value > 0 else float("-inf")
+
+
+def float4_output(value: float) -> float:
+    '''The shortest decimal that rounds to the single precision `value`,
+    which is how PostgreSQL, and so the database path, outputs a `REAL`.'''
+    for digits in range(1, 10):
+        shortest = float(f"{value:.{digits}g}")
+        if float4(shortest) == value:
+            return shortest
+    return value
+
+
+def copy_field(field: str):
+    '''Decodes a field of the `COPY ... TO STDOUT` text format.'''
+    if field == "\\N":
+        return None
+    if "\\" in field:
+        return COPY_ESCAPE.sub(lambda match: COPY_ESCAPES.get(match[1], match[1]), field)
+    return field
+
+
+def snapshot_row(fields: list) -> tuple:
+    '''Converts the text fields of a `SELECT_SNAPSHOT_TREASURES` row.'''
+    treasure_id, treasure_name, colour, age, cost_at_auction, shop_id = map(copy_field, fields)
+    return (
+        int(treasure_id), treasure_name, colour,
+        None if age is None else int(age),
+        None if cost_at_auction is None else float4(float(cost_at_auction)),
+        int(shop_id),
+    )
+
+
+class CopyReader:
+    '''A stream for `COPY ... TO STDOUT` in the text format that hands the
+    fields of each row to `on_row`.'''
+
+    def __init__(self, on_row):
+        self.on_row = on_row
+        self.pending = b""
+
+    def write(self, data):
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.on_row(line.decode().split("\t"))
+
+
+class Bitmap:
+    '''A set of row slots, one bit per slot.'''
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def __contains__(self, slot):
+        byte = slot >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] >> (slot & 7) & 1)
+
+    def add(self, slot):
+        byte = slot >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (slot & 7)
+
+    def discard(self, slot):
+        byte = slot >> 3
+        if byte < len(self.bits):
+            self.bits[byte] &= ~(1 << (slot & 7)) & 0xFF
+
+
+class Snapshot:
+    '''The treasures and shops listings at data `version`.
+
+    Rows live in slots; the slots of deleted treasures are reused. Sort keys
+    are `(is NULL, value, treasure_id)` tuples, so that NULLs sort last
+    ascending and first descending, as in PostgreSQL.
+    '''
+
+    def __init__(self, version=None):
+        self.version = version
+        self.treasure_id = array("i")
+        self.treasure_name = []
+        self.colour = array("H")
+        self.age = array("i")
+        self.cost_at_auction = array("f")
+        self.shop_id = array("i")
+        self.nulls = {"age": Bitmap(), "cost_at_auction": Bitmap()}
+        self.colour_names = [None]
+        self.colour_codes = {None: 0}
+        self.colour_slots = {}
+        self.slots = {}
+        self.free = []
+        self.order = {column: array("i") for column in SORT_COLUMNS}
+        self.shop_names = {}
+        self.shops = ([], [])
+        self.name_bytes = 0
+
+    def sort_key(self, column):
+        if column == "treasure_name":
+            names, ids = self.treasure_name, self.treasure_id
+            return lambda slot: (False, names[slot], ids[slot])
+        values, nulls, ids = getattr(self, column), self.nulls[column], self.treasure_id
+        return lambda slot: (slot in nulls, values[slot], ids[slot])
+
+    def cursor_key(self, column, after):
+        '''The sort key of the cursor `(sort_value, treasure_id)`.'''
+        value, treasure_id = after
+        if value is None:
+            return (True, "" if column == "treasure_name" else 0, treasure_id)
+        if column == "cost_at_auction":
+            value = float4(value)
+        return (False, value, treasure_id)
+
+    def load(self, rows):
+        '''Fills an empty snapshot with `rows`.'''
+        for row in rows:
+            self.append(row)
+        self.sort()
+
+    def append(self, row):
+        '''Adds a row in a new slot without indexing it; call `sort` once all
+        are in.'''
+        treasure_id, treasure_name, colour, age, cost_at_auction, shop_id = row
+        slot = len(self.treasure_id)
+        self.treasure_id.append(treasure_id)
+        self.treasure_name.append(treasure_name)
+        self.name_bytes += sys.getsizeof(treasure_name)
+        self.colour.append(self._colour_code(colour))
+        if colour is not None:
+            self.colour_slots[colour].add(slot)
+        if age is None:
+            self.nulls["age"].add(slot)
+        self.age.append(age or 0)
+        if cost_at_auction is None:
+            self.nulls["cost_at_auction"].add(slot)
+        self.cost_at_auction.append(cost_at_auction or 0.0)
+        self.shop_id.append(shop_id)
+        self.slots[treasure_id] = slot
+        return slot
+
+    def sort(self):
+        # Stable sorts of the slots in id order, by value alone, avoid
+        # building a key tuple per row.
+        by_id = sorted(self.slots.values(), key=self.treasure_id.__getitem__)
+        for column in SORT_COLUMNS:
+            values = getattr(self, column)
+            nulls = self.nulls.get(column, Bitmap())
+            if not any(nulls.bits):
+                self.order[column] = array("i", sorted(by_id, key=values.__getitem__))
+                continue
+            order = array("i", sorted((slot for slot in by_id if slot not in nulls), key=values.__getitem__))
+            order.extend(slot for slot in by_id if slot in nulls)
+            self.order[column] = order
+
+    def upsert(self, row):
+        slot = self.slots.get(row[0])
+        if slot is not None:
+            self._unindex(slot)
+            self._store(slot, row)
+        elif self.free:
+            slot = self.free.pop()
+            self._store(slot, row)
+        else:
+            slot = self.append(row)
+        for column in SORT_COLUMNS:
+            bisect.insort(self.order[column], slot, key=self.sort_key(column))
+
+    def delete(self, treasure_id):
+        slot = self.slots.pop(treasure_id, None)
+        if slot is not None:
+            self._unindex(slot)
+            self.name_bytes -= sys.getsizeof(self.treasure_name[slot]) - sys.getsizeof(None)
+            self.treasure_name[slot] = None
+            self.free.append(slot)
+
+    def treasures(self, sort_by, descending, filters, after=None, limit=None):
+        '''Returns the column names and the first `limit` rows after the
+        cursor `after` of the listing, like the database path.'''
+        order, key = self.order[sort_by], self.sort_key(sort_by)
+        if after is None:
+            positions = range(len(order) - 1, -1, -1) if descending else range(len(order))
+        elif descending:
+            positions = range(bisect.bisect_left(order, self.cursor_key(sort_by, after), key=key) - 1, -1, -1)
+        else:
+            positions = range(bisect.bisect_right(order, self.cursor_key(sort_by, after), key=key), len(order))
+
+        matches = self._filter(filters)
+        rows = []
+        for position in positions:
+            slot = order[position]
+            if matches is None or matches(slot):
+                rows.append(self._row(slot))
+                if limit is not None and len(rows) >= limit:
+                    break
+        return ["treasure_id", "treasure_name", "colour", "age", "cost_at_auction", "shop_name"], rows
+
+    def nbytes(self):
+        '''Estimated memory held by the snapshot.'''
+        arrays = [self.treasure_id, self.colour, self.age, self.cost_at_auction, self.shop_id, *self.order.values()]
+        bitmaps = [*self.nulls.values(), *self.colour_slots.values()]
+        return (
+            sum(len(column) * column.itemsize for column in arrays)
+            + sum(len(bitmap.bits) for bitmap in bitmaps)
+            + sys.getsizeof(self.treasure_name) + self.name_bytes
+            + sys.getsizeof(self.slots) + sys.getsizeof(self.free)
+            + sum(sys.getsizeof(row) for row in self.shops[1])
+        )
+
+    def _colour_code(self, colour):
+        code = self.colour_codes.get(colour)
+        if code is None:
+            code = self.colour_codes[colour] = len(self.colour_names)
+            self.colour_names.append(colour)
+            self.colour_slots[colour] = Bitmap()
+        return code
+
+    def _store(self, slot, row):
+        treasure_id, treasure_name, colour, age, cost_at_auction, shop_id = row
+        self.name_bytes += sys.getsizeof(treasure_name) - sys.getsizeof(self.treasure_name[slot])
+        self.treasure_id[slot] = treasure_id
+        self.treasure_name[slot] = treasure_name
+        self.colour[slot] = self._colour_code(colour)
+        if colour is not None:
+            self.colour_slots[colour].add(slot)
+        for column, value in [("age", age), ("cost_at_auction", cost_at_auction)]:
+            if value is None:
+                self.nulls[column].add(slot)
+                getattr(self, column)[slot] = 0
+            else:
+                self.nulls[column].discard(slot)
+                getattr(self, column)[slot] = value
+        self.shop_id[slot] = shop_id
+        self.slots[treasure_id] = slot
+
+    def _unindex(self, slot):
+        for column in SORT_COLUMNS:
+            order, key = self.order[column], self.sort_key(column)
+            del order[bisect.bisect_left(order, key(slot), key=key)]
+        colour = self.colour_names[self.colour[slot]]
+        if colour is not None:
+            self.colour_slots[colour].discard(slot)
+
+    def _filter(self, filters):
+        '''Returns a predicate on slots for `filters`, or `None` for all rows.'''
+        checks = []
+        if filters.colour is not None:
+            colour_slots = self.colour_slots.get(filters.colour, Bitmap())
+            checks.append(lambda slot: slot in colour_slots)
+        for column, low, high in [
+            ("age", filters.min_age, filters.max_age),
+            ("cost_at_auction", filters.min_cost, filters.max_cost),
+        ]:
+            if low is None and high is None:
+                continue
+            if column == "cost_at_auction":
+                low, high = (None if bound is None else float4(bound) for bound in (low, high))
+            values, nulls = getattr(self, column), self.nulls[column]
+            checks.append(lambda slot, values=values, nulls=nulls, low=low, high=high: (
+                slot not in nulls
+                and (low is None or values[slot] >= low)
+                and (high is None or values[slot] <= high)
+            ))
+        if filters.shop_ids is not None:
+            shop_ids = set(filters.shop_ids)
+            checks.append(lambda slot: self.shop_id[slot] in shop_ids)
+        if not checks:
+            return None
+        return lambda slot: all(check(slot) for check in checks)
+
+    def _row(self, slot):
+        return [
+            self.treasure_id[slot],
+            self.treasure_name[slot],
+            self.colour_names[self.colour[slot]],
+            None if slot in self.nulls["age"] else self.age[slot],
+            None if slot in self.nulls["cost_at_auction"] else float4_output(self.cost_at_auction[slot]),
+            self.shop_names[self.shop_id[slot]],
+        ]
+
+
+class ReadModel:
+    '''Keeps a `Snapshot` current from the change feed, on its own
+    connection and thread.'''
+
+    def __init__(self, enabled=False, poll_interval=1.0, connect=connect_to_db):
+        self.enabled = enabled
+        self.poll_interval = poll_interval
+        self.connect = connect
+        self.snapshot = None
+        self.ready = False
+        self._conn = None
+        self._lock = threading.Lock()
+        self._feed_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.getenv("READ_MODEL", "0") == "1",
+            poll_interval=float(os.getenv("READ_MODEL_POLL_SECONDS", 1)),
+        )
+
+    def start(self):
+        '''Loads the snapshot and starts following the change feed.'''
+        if not self.enabled:
+            return
+        self._stopping.clear()
+        try:
+            self._subscribe()
+        except Exception as exc:
+            self._disconnect(exc)
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._follow, name="read-model", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._feed_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self.ready = False
+
+    @contextmanager
+    def reading(self):
+        '''Holds the snapshot still while a response is built from it.'''
+        with self._lock:
+            yield self.snapshot
+
+    @property
+    def version(self):
+        snapshot = self.snapshot
+        return snapshot.version if snapshot else None
+
+    def treasures(self, sort_by, descending, filters, after=None, limit=None):
+        '''Returns a listing page from the current snapshot, as `Snapshot.treasures`.'''
+        with self.reading() as snapshot:
+            return snapshot.treasures(sort_by, descending, filters, after, limit)
+
+    def reload(self):
+        '''Replaces the snapshot with a fresh copy of the database.'''
+        with self._feed_lock:
+            db = self._conn
+            db.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            try:
+                snapshot = Snapshot(db.run(SELECT_DATA_VERSION)[0][0])
+                snapshot.shop_names = dict(db.run(SELECT_SHOP_NAMES))
+                shop_rows = db.run(SELECT_SHOPS)
+                snapshot.shops = ([column["name"] for column in db.columns], shop_rows)
+                reader = CopyReader(lambda fields: snapshot.append(snapshot_row(fields)))
+                db.run(f"COPY ({SELECT_SNAPSHOT_TREASURES}) TO STDOUT", stream=reader)
+                snapshot.sort()
+            finally:
+                db.run("COMMIT")
+        with self._lock:
+            self.snapshot = snapshot
+            self.ready = True
+        metrics.inc("read_model_refreshes_total", kind="reload")
+        self._report()
+        print(
+            f"\U0001F4E6 Loaded {len(snapshot.slots):,} treasures into the read model "
+            f"({snapshot.nbytes() / 2 ** 20:.1f} MiB) at version {snapshot.version}."
+        )
+
+    def refresh(self):
+        '''Applies the notifications received so far; returns whether there
+        were any.'''
+        with self._feed_lock:
+            db = self._conn
+            changed_ids, full_reload, changed_rows = set(), False, None
+            # A write that commits after the notifications are drained but
+            # before the changed rows are re-read is counted in `version`, yet
+            # its notification only arrives afterwards. Drain again after each
+            # re-read until nothing new has arrived, so that `version` is only
+            # published once every change it counts is in the snapshot.
+            while True:
+                db.run("SELECT 1")
+                # pg8000 keeps the last `maxlen` notifications only.
+                full_reload = full_reload or len(db.notifications) == db.notifications.maxlen
+                received = False
+                while db.notifications:
+                    _, channel, payload = db.notifications.popleft()
+                    if channel != CHANGE_FEED_CHANNEL:
+                        continue
+                    change = json.loads(payload)
+                    received = True
+                    if change.get("ids") is None:
+                        full_reload = True
+                    else:
+                        changed_ids.update(change["ids"])
+                if not received or full_reload:
+                    break
+                db.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                try:
+                    version = db.run(SELECT_DATA_VERSION)[0][0]
+                    shop_names = dict(db.run(SELECT_SHOP_NAMES))
+                    shop_rows = db.run(SELECT_SHOPS)
+                    shop_columns = [column["name"] for column in db.columns]
+                    changed_rows = [
+                        (*row[:4], None if row[4] is None else float4(row[4]), row[5])
+                        for row in db.run(
+                            f"{SELECT_SNAPSHOT_TREASURES} WHERE treasures.treasure_id = ANY(CAST(:ids AS INT[]))",
+                            ids=sorted(changed_ids),
+                        )
+                    ] if changed_ids else []
+                finally:
+                    db.run("COMMIT")
+        if full_reload:
+            self.reload()
+            return True
+        if changed_rows is None:
+            return False
+
+        with self._lock:
+            snapshot = self.snapshot
+            for row in changed_rows:
+                snapshot.upsert(row)
+            for treasure_id in changed_ids - {row[0] for row in changed_rows}:
+                snapshot.delete(treasure_id)
+            snapshot.shop_names = shop_names
+            snapshot.shops = (shop_columns, shop_rows)
+            snapshot.version = version
+        metrics.inc("read_model_refreshes_total", kind="incremental")
+        self._report()
+        return True
+
+    def stats(self):
+        with self._lock:
+            snapshot = self.snapshot
+            return {
+                "enabled": self.enabled,
+                "ready": self.ready,
+                "version": snapshot.version if snapshot else None,
+                "rows": len(snapshot.slots) if snapshot else 0,
+                "bytes": snapshot.nbytes() if snapshot else 0,
+            }
+
+    def _subscribe(self):
+        db = self.connect()
+        collation, provider = db.run(SELECT_COLLATION)[0]
+        if provider != "c" or collation not in CODE_POINT_COLLATIONS:
+            db.close()
+            print(
+                f"\U0001F6A8 Read model disabled: names sort under the {collation!r} collation of the "
+                f"{LOCALE_PROVIDERS.get(provider, provider)} locale provider, not by code point."
+            )
+            self.enabled = False
+            return
+        db.run(f"LISTEN {CHANGE_FEED_CHANNEL}")
+        with self._feed_lock:
+            self._conn = db
+        self.reload()
+
+    def _follow(self):
+        while not self._stopping.is_set():
+            try:
+                if self._conn is None:
+                    self._subscribe()
+                # pg8000 only reads notifications while running a statement,
+                # so wait for the socket to become readable before draining.
+                select.select([self._conn._usock], [], [], self.poll_interval)
+                self.refresh()
+            except Exception as exc:
+                self._disconnect(exc)
+                self._stopping.wait(self.poll_interval)
+
+    def _disconnect(self, exc):
+        print(f"\U0001F6A8 Read model lost the change feed, serving from the database: {exc}")
+        self.ready = False
+        with self._feed_lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+
+    def _report(self):
+        with self._lock:
+            metrics.set("read_model_rows", len(self.snapshot.slots))
+            metrics.set("read_model_bytes", self.snapshot.nbytes())
+
+
+read_model = ReadModel.from_env()
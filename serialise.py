@@ -0,0 +1,35 @@
+'''This module contains the JSON encoding used by the listing endpoints of
+the `Cat's Rare Treasures` FastAPI app.
+
+Rows go straight from the driver's row lists to bytes in one call to a fast
+encoder (orjson when installed, the standard library otherwise), bypassing
+FastAPI's `jsonable_encoder` pass over the response. The columnar format
+skips the per-row dicts altogether.
+'''
+from enum import Enum
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ListingFormat(Enum):
+    objects = "objects"
+    columns = "columns"
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_rows(key: str, column_names: list, rows: list, listing_format=ListingFormat.objects, **extra) -> bytes:
+    '''Encodes `rows` either as `{key: [{column: value}, ...]}` or, for the
+    columnar format, as `{"columns": [...], "rows": [[...], ...]}`; `extra`
+    fields are added alongside.'''
+    if listing_format == ListingFormat.columns:
+        return dumps({"columns": column_names, "rows": rows, **extra})
+    return dumps({key: [dict(zip(column_names, row)) for row in rows], **extra})
@@ -0,0 +1,112 @@
+'''This module contains the database fixtures shared by the test suites of
+the `Cat's Rare Treasures` FastAPI app.
+
+The test database is seeded once per session. Tests that use
+`db_transaction` then run, together with every connection the app borrows
+from `pool`, inside one transaction that is rolled back afterwards. Under
+pytest-xdist each worker gets its own database, cloned from the seeded test
+database with `CREATE DATABASE ... TEMPLATE`:
+
+    pytest -n auto
+'''
+from db.connection import ConnectionPool, connect_to_db, pool, SavepointConnection
+from db.seed import seed_db
+from cache import response_cache
+import os
+import pytest
+
+
+# Sequences are not transactional, so they are restarted from the seeded rows
+# rather than rolled back.
+RESET_SEQUENCES = [
+    "SELECT setval(pg_get_serial_sequence('shops', 'shop_id'), MAX(shop_id)) FROM shops",
+    "SELECT setval(pg_get_serial_sequence('treasures', 'treasure_id'), MAX(treasure_id)) FROM treasures",
+]
+
+
+@pytest.fixture(scope="session", autouse=True)
+def test_database():
+    '''Seeds the test database; under pytest-xdist, points `PG_DATABASE` at a
+    clone of it for this worker.'''
+    template = os.environ["PG_DATABASE"]
+    worker = os.getenv("PYTEST_XDIST_WORKER")
+    admin = connect_to_db(database="postgres")
+    # Workers take turns: a database cannot be cloned while it is being seeded.
+    admin.run("SELECT pg_advisory_lock(hashtext(:template))", template=template)
+    try:
+        seed_db(env='test')
+        if worker:
+            database = f"{template}_{worker}"
+            admin.run(f'DROP DATABASE IF EXISTS "{database}"')
+            admin.run(f'CREATE DATABASE "{database}" TEMPLATE "{template}"')
+            os.environ["PG_DATABASE"] = database
+    finally:
+        admin.run("SELECT pg_advisory_unlock(hashtext(:template))", template=template)
+
+    yield os.environ["PG_DATABASE"]
+
+    pool.close()
+    if worker:
+        os.environ["PG_DATABASE"] = template
+        admin.run(f'DROP DATABASE IF EXISTS "{database}" WITH (FORCE)')
+    admin.close()
+
+
+@pytest.fixture(scope="session")
+def savepoint_connection(test_database):
+    conn = connect_to_db(connection_class=SavepointConnection)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture()
+def db_transaction(savepoint_connection):
+    '''Runs the test inside a transaction that is rolled back afterwards,
+    with `pool` handing out the same connection to the app.'''
+    for statement in RESET_SEQUENCES:
+        savepoint_connection.run(statement)
+    response_cache.clear()
+    savepoint_connection.begin_outer()
+    with pool.pinned(savepoint_connection):
+        yield savepoint_connection
+    savepoint_connection.rollback_all()
+
+
+@pytest.fixture(scope="module")
+def seeded_copy(test_database):
+    '''Returns a function that creates a seeded copy of the test database,
+    named `<test database>_<suffix>`, for tests that commit or need a second
+    database. The copies are dropped after the module.'''
+    admin = connect_to_db(database="postgres")
+    databases = []
+
+    def seeded_copy(suffix):
+        database = f"{test_database}_{suffix}"
+        admin.run(f'DROP DATABASE IF EXISTS "{database}"')
+        admin.run(f'CREATE DATABASE "{database}"')
+        databases.append(database)
+        os.environ["PG_DATABASE"] = database
+        try:
+            seed_db(env='test')
+        finally:
+            os.environ["PG_DATABASE"] = test_database
+        return database
+
+    yield seeded_copy
+    for database in databases:
+        admin.run(f'DROP DATABASE IF EXISTS "{database}" WITH (FORCE)')
+    admin.close()
+
+
+@pytest.fixture()
+def make_pool():
+    '''Returns a function that creates a `ConnectionPool`, closed after the test.'''
+    pools = []
+
+    def make_pool(**settings):
+        pools.append(ConnectionPool(**settings))
+        return pools[-1]
+
+    yield make_pool
+    for test_pool in pools:
+        test_pool.close()
@@ -0,0 +1,127 @@
+'''This module contains the test suite for the async data-access layer
+used by the `Cat's Rare Treasures` FastAPI app.'''
+from main import app
+import main
+from db.async_pool import AsyncPool
+from db.connection import PoolTimeout
+from fastapi.routing import APIRoute
+from metrics import metrics
+from pg8000.native import DatabaseError
+import asyncio
+import inspect
+import time
+import httpx
+import pytest
+
+
+@pytest.fixture()
+def test_pool(make_pool):
+    return make_pool(min_size=0, max_size=2, acquire_timeout=1)
+
+
+@pytest.fixture()
+def async_pool():
+    async_pool = AsyncPool(max_concurrency=2, max_waiting=1, acquire_timeout=0.2)
+    yield async_pool
+    async_pool.close()
+
+
+class TestAsyncPool:
+    def test_runs_queries_on_borrowed_connections(self, test_pool, async_pool):
+        async def scenario():
+            async with async_pool.connection(test_pool.connection()) as db:
+                assert async_pool.in_use == 1
+                return await db.run("SELECT CAST(:value AS INT) AS value", value=7), db.columns[0]["name"]
+
+        assert asyncio.run(scenario()) == ([[7]], "value")
+        assert async_pool.in_use == 0
+        assert test_pool.size == test_pool.idle == 1
+
+    def test_saturated_pool_rejects_at_once(self, test_pool, async_pool):
+        """
+        Test verifies, with both slots held and the one queue place taken:
+        - the next request fails with PoolTimeout without waiting
+        - the queued request times out after acquire_timeout
+        """
+        rejections = metrics.get("db_async_rejections_total", reason="saturated") or 0
+
+        async def scenario():
+            release = asyncio.Event()
+
+            async def hold():
+                async with async_pool.slot():
+                    await release.wait()
+
+            holders = [asyncio.create_task(hold()) for _ in range(2)]
+            await asyncio.sleep(0)
+            queued = asyncio.create_task(async_pool.slot().__aenter__())
+            await asyncio.sleep(0)
+            assert async_pool.waiting == 1
+
+            started = time.perf_counter()
+            with pytest.raises(PoolTimeout):
+                async with async_pool.slot():
+                    pass
+            assert time.perf_counter() - started < 0.05
+
+            with pytest.raises(PoolTimeout):
+                await queued
+            release.set()
+            await asyncio.gather(*holders)
+
+        asyncio.run(scenario())
+        assert metrics.get("db_async_rejections_total", reason="saturated") == rejections + 1
+        assert async_pool.in_use == async_pool.waiting == 0
+
+    def test_errors_give_the_connection_back(self, test_pool, async_pool):
+        async def scenario():
+            with pytest.raises(DatabaseError):
+                async with async_pool.connection(test_pool.connection()) as db:
+                    await db.run("START TRANSACTION")
+                    await db.run("SELECT * FROM no_such_table")
+
+        asyncio.run(scenario())
+        assert test_pool.size == test_pool.idle == 1
+        with test_pool.connection() as db:
+            assert db.run("SELECT 1") == [[1]]
+
+    def test_cancelled_request_gives_the_connection_back_after_its_query(self, test_pool, async_pool):
+        async def scenario():
+            async def slow_query():
+                async with async_pool.connection(test_pool.connection()) as db:
+                    await db.run("SELECT pg_sleep(0.3)")
+
+            task = asyncio.create_task(slow_query())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(scenario())
+        deadline = time.monotonic() + 2
+        while test_pool.idle != 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert test_pool.size == test_pool.idle == 1
+
+
+@pytest.mark.usefixtures("db_transaction")
+class TestAsyncHandlers:
+    def test_handlers_are_coroutines(self):
+        endpoints = [route.endpoint for route in app.routes if isinstance(route, APIRoute)]
+        assert endpoints and all(inspect.iscoroutinefunction(endpoint) for endpoint in endpoints)
+
+    def test_503_when_database_slots_are_saturated(self, monkeypatch):
+        monkeypatch.setattr(main, "async_pool", AsyncPool(max_concurrency=1, max_waiting=0))
+
+        async def scenario():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                async with main.async_pool.slot():
+                    busy = await client.get("/api/treasures")
+                return busy, await client.get("/api/treasures")
+
+        busy, served = asyncio.run(scenario())
+        main.async_pool.close()
+        assert busy.status_code == 503
+        assert busy.json() == {"detail": "Service unavailable: database is busy, please retry"}
+        assert served.status_code == 200
@@ -0,0 +1,54 @@
+'''This module contains the test suite for the response cache
+used by the `Cat's Rare Treasures` FastAPI app.'''
+from cache import ResponseCache
+import time
+
+
+class TestResponseCache:
+    def test_get_returns_stored_body(self):
+        cache = ResponseCache(max_bytes=10_000, ttl=60)
+        cache.put("key", b"body", cache.generation)
+        assert cache.get("key") == b"body"
+        assert cache.get("other") is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_least_recently_used_entries_are_evicted_over_budget(self):
+        cache = ResponseCache(max_bytes=3 * (ResponseCache.ENTRY_OVERHEAD + 10), ttl=60)
+        for key in ["a", "b", "c"]:
+            cache.put(key, b"x" * 10, cache.generation)
+        cache.get("a")
+        cache.put("d", b"x" * 10, cache.generation)
+        assert cache.get("b") is None
+        assert cache.get("a") == cache.get("c") == cache.get("d") == b"x" * 10
+        assert cache.evictions == 1
+        assert cache.stats()["bytes"] <= cache.max_bytes
+
+    def test_bodies_larger_than_budget_are_not_stored(self):
+        cache = ResponseCache(max_bytes=1000, ttl=60)
+        cache.put("key", b"x" * 1000, cache.generation)
+        assert cache.get("key") is None
+        assert cache.stats()["entries"] == 0
+
+    def test_entries_expire_after_ttl(self):
+        cache = ResponseCache(max_bytes=10_000, ttl=0.05)
+        cache.put("key", b"body", cache.generation)
+        time.sleep(0.06)
+        assert cache.get("key") is None
+        assert cache.expirations == 1
+
+    def test_invalidate_drops_entries_and_rejects_stale_puts(self):
+        cache = ResponseCache(max_bytes=10_000, ttl=60)
+        cache.put("key", b"old", cache.generation)
+        generation = cache.generation
+        cache.invalidate()
+        cache.put("other", b"read before the write", generation)
+        assert cache.get("key") is None
+        assert cache.get("other") is None
+        cache.put("key", b"new", cache.generation)
+        assert cache.get("key") == b"new"
+
+    def test_zero_ttl_disables_cache(self):
+        cache = ResponseCache(max_bytes=10_000, ttl=0)
+        cache.put("key", b"body", cache.generation)
+        assert cache.get("key") is None
+        assert cache.misses == 0
@@ -2,15 +2,16 @@
 `Cat's Rare Treasures` FastAPI app.'''
 from fastapi.testclient import TestClient
 from main import app
-from db.seed import seed_db
+import main
+from db.connection import pool
+from metrics import query_shape
 import pytest
+import json
+import csv
+import io
 
 
-@pytest.fixture(autouse=True)
-def reset_db():
-    seed_db(env='test')
-    yield
-    seed_db(env='test')
+pytestmark = pytest.mark.usefixtures("db_transaction")
 
 @pytest.fixture()
 def client():
@@ -97,6 +98,100 @@ class TestGetAllTreasures:
             assert type(treasure["cost_at_auction"]) == float
             assert type(treasure["shop_name"]) == str
         
+    def test_200_returns_treasures_filtered_by_age_and_cost_ranges(self, client):
+        treasures = client.get("/api/treasures?min_age=13&max_age=77").json()["treasures"]
+        assert len(treasures) == 14
+        assert all(13 <= treasure["age"] <= 77 for treasure in treasures)
+
+        treasures = client.get("/api/treasures?min_cost=6.99&max_cost=60.99").json()["treasures"]
+        assert len(treasures) == 13
+        assert all(6.99 <= treasure["cost_at_auction"] <= 60.99 for treasure in treasures)
+
+        treasures = client.get("/api/treasures?min_age=200").json()["treasures"]
+        assert [treasure["age"] for treasure in treasures] == [200, 234, 504, 10865]
+
+    def test_200_returns_treasures_filtered_by_shops(self, client):
+        treasures = client.get("/api/treasures?shop_id=3").json()["treasures"]
+        assert [treasure["shop_name"] for treasure in treasures] == ["shop-e"] * 3
+
+        treasures = client.get("/api/treasures?shop_id=3&shop_id=7&shop_id=3").json()["treasures"]
+        assert sorted(treasure["shop_name"] for treasure in treasures) == ["shop-e"] * 3 + ["shop-i"] * 2
+
+    def test_200_combines_filters_with_sort(self, client):
+        """
+        Test verifies:
+        - every filter applies at once
+        - results keep the requested sort order
+        """
+        response = client.get(
+            "/api/treasures?sort_by=cost_at_auction&order=desc&min_age=10&max_age=100&max_cost=100"
+            "&shop_id=2&shop_id=4&shop_id=7&shop_id=10"
+        )
+        assert response.status_code == 200
+        treasures = response.json()["treasures"]
+        assert [(treasure["shop_name"], treasure["cost_at_auction"]) for treasure in treasures] == [
+            ("shop-f", 48.99), ("shop-k", 41.99), ("shop-i", 23.99), ("shop-k", 18.99), ("shop-d", 6.99),
+            ("shop-f", 5.99),
+        ]
+
+    def test_200_pages_through_treasures_with_limit_and_cursor(self, client):
+        """
+        Test verifies, for every sort column, order and with/without filters:
+        - pages hold at most `limit` treasures
+        - following `next_cursor` visits every treasure exactly once, in the unpaginated order
+        - the last page has no `next_cursor`
+        """
+        for sort_by in ["age", "cost_at_auction", "treasure_name"]:
+            for order in ["asc", "desc"]:
+                for colour_filter in ["", "&colour=gold", "&min_age=13&max_cost=100&shop_id=1&shop_id=6"]:
+                    query = f"/api/treasures?sort_by={sort_by}&order={order}{colour_filter}"
+                    expected = client.get(query).json()["treasures"]
+
+                    pages = []
+                    response = client.get(f"{query}&limit=4").json()
+                    pages.append(response["treasures"])
+                    while response["next_cursor"]:
+                        response = client.get(f"{query}&limit=4&after={response['next_cursor']}").json()
+                        pages.append(response["treasures"])
+
+                    assert all(len(page) <= 4 for page in pages)
+                    assert [treasure for page in pages for treasure in page] == expected
+
+    def test_200_pages_through_treasures_with_null_sort_values(self, client):
+        with pool.connection() as db:
+            db.run("UPDATE treasures SET age = NULL WHERE treasure_id IN (2, 5, 11)")
+
+        for order in ["asc", "desc"]:
+            expected = client.get(f"/api/treasures?order={order}").json()["treasures"]
+            treasures = []
+            cursor = ""
+            while True:
+                response = client.get(f"/api/treasures?order={order}&limit=2{cursor}").json()
+                treasures += response["treasures"]
+                if not response["next_cursor"]:
+                    break
+                cursor = f"&after={response['next_cursor']}"
+            assert treasures == expected
+
+    def test_200_next_cursor_is_none_without_limit(self, client):
+        response = client.get("/api/treasures")
+        assert response.status_code == 200
+        assert response.json()["next_cursor"] is None
+
+    def test_200_returns_columnar_format(self, client):
+        """
+        Test verifies:
+        - `format=columns` returns the column names once and each treasure as a list
+        - rows carry the same values, in the same order, as the default format
+        """
+        expected = client.get("/api/treasures?colour=gold&limit=1").json()
+        response = client.get("/api/treasures?colour=gold&limit=1&format=columns")
+        assert response.status_code == 200
+        body = response.json()
+        assert body["columns"] == ["treasure_id", "treasure_name", "colour", "age", "cost_at_auction", "shop_name"]
+        assert [dict(zip(body["columns"], row)) for row in body["rows"]] == expected["treasures"]
+        assert body["next_cursor"] == expected["next_cursor"]
+
     """
     Error handling considerations for GET "/api/treasures" are tested below:
     
@@ -113,7 +208,7 @@ class TestGetAllTreasures:
     Method does not exist; 405 handled by FastAPI
     """
     def test_405_if_method_does_not_exist(self, client):
-        response = client.patch("/api/treasures")
+        response = client.put("/api/treasures")
         assert response.status_code == 405
         assert response.json() == {
             "detail": "Method Not Allowed"
@@ -152,6 +247,104 @@ class TestGetAllTreasures:
         response = client.get("/api/treasures?colour=notacolour")
         assert response.status_code == 422
 
+    """
+    Range bounds or shop ids invalid; 422 handled by FastAPI, custom 422 implemented for inverted ranges
+    """
+    def test_422_if_filters_not_allowed(self, client):
+        for query in ["min_age=old", "max_cost=free", "shop_id=one"]:
+            response = client.get(f"/api/treasures?{query}")
+            assert response.status_code == 422
+
+    def test_422_if_range_is_inverted(self, client):
+        response = client.get("/api/treasures?min_age=100&max_age=10")
+        assert response.status_code == 422
+        assert response.json() == {"detail": "min_age must not be greater than max_age"}
+
+        response = client.get("/api/treasures?min_cost=20.5&max_cost=20")
+        assert response.status_code == 422
+        assert response.json() == {"detail": "min_cost must not be greater than max_cost"}
+
+    """
+    Limit out of range / cursor invalid or issued for another sort; 422 handled by FastAPI, custom 400 implemented
+    """
+    def test_422_if_limit_not_allowed(self, client):
+        response = client.get("/api/treasures?limit=0")
+        assert response.status_code == 422
+
+        response = client.get("/api/treasures?limit=notanumber")
+        assert response.status_code == 422
+
+    def test_400_if_cursor_is_invalid(self, client):
+        response = client.get("/api/treasures?limit=2&after=notacursor")
+        assert response.status_code == 400
+        assert response.json() == {
+            "detail": "Invalid cursor"
+        }
+
+        cursor = client.get("/api/treasures?limit=2").json()["next_cursor"]
+        response = client.get(f"/api/treasures?sort_by=treasure_name&limit=2&after={cursor}")
+        assert response.status_code == 400
+
+    def test_400_if_cursor_value_does_not_fit_the_sort_column(self, client):
+        for sort_by, value in [
+            ("age", "abc"), ("age", 1.5), ("age", 1e300), ("age", 2 ** 31), ("age", True),
+            ("cost_at_auction", "abc"), ("cost_at_auction", 1e300), ("cost_at_auction", 1e-300),
+            ("cost_at_auction", 10 ** 400), ("treasure_name", 3), ("treasure_name", None),
+        ]:
+            cursor = main.encode_payload([sort_by, "asc", value, 3])
+            response = client.get(f"/api/treasures?sort_by={sort_by}&after={cursor}")
+            assert response.status_code == 400, (sort_by, value)
+            assert response.json() == {"detail": "Invalid cursor"}
+
+        cursor = main.encode_payload(["age", "asc", 1, 2 ** 31])
+        assert client.get(f"/api/treasures?after={cursor}").status_code == 400
+
+        for sort_by, value in [("age", None), ("cost_at_auction", 3), ("cost_at_auction", 0)]:
+            cursor = main.encode_payload([sort_by, "asc", value, 3])
+            assert client.get(f"/api/treasures?sort_by={sort_by}&after={cursor}").status_code == 200
+
+    def test_200_returns_only_requested_fields(self, client):
+        """
+        Test verifies:
+        - only the requested fields are returned, in column order
+        - the query itself selects only those columns, without joining shops
+        - the rows match the full listing
+        """
+        expected = client.get("/api/treasures?sort_by=cost_at_auction").json()["treasures"]
+        main.metrics.reset()
+        response = client.get("/api/treasures?sort_by=cost_at_auction&fields=cost_at_auction,treasure_id")
+        assert response.status_code == 200
+        assert response.json()["treasures"] == [
+            {"treasure_id": treasure["treasure_id"], "cost_at_auction": treasure["cost_at_auction"]}
+            for treasure in expected
+        ]
+        shapes = [line for line in client.get("/metrics").text.splitlines()
+                  if line.startswith("db_query_duration_seconds_count") and "FROM treasures" in line]
+        assert len(shapes) == 1
+        assert "SELECT treasures.treasure_id, treasures.cost_at_auction FROM treasures WHERE" in shapes[0]
+        assert "JOIN" not in shapes[0]
+
+    def test_200_fields_with_pages_and_columnar_format(self, client):
+        expected = client.get("/api/treasures?sort_by=age&order=desc").json()["treasures"]
+        query = "/api/treasures?sort_by=age&order=desc&limit=10&fields=shop_name&format=columns"
+        pages, after = [], ""
+        while True:
+            body = client.get(f"{query}{after}").json()
+            assert body["columns"] == ["shop_name"]
+            pages += [row[0] for row in body["rows"]]
+            if not body["next_cursor"]:
+                break
+            after = f"&after={body['next_cursor']}"
+        assert pages == [treasure["shop_name"] for treasure in expected]
+
+    def test_422_if_fields_are_unknown_or_empty(self, client):
+        response = client.get("/api/treasures?fields=treasure_id,price")
+        assert response.status_code == 422
+        assert response.json()["detail"].endswith("; unknown: price")
+
+        response = client.get("/api/treasures?fields=,")
+        assert response.status_code == 422
+
     """
     db error; custom 500 implemented
     """
@@ -401,6 +594,24 @@ class TestGetAllShops:
         assert shops[0]["stock_value"] == 2421.98
         assert shops[1]["stock_value"] == 1015.98
 
+    def test_200_returns_columnar_format(self, client):
+        expected = client.get("/api/shops").json()["shops"]
+        body = client.get("/api/shops?format=columns").json()
+        assert body["columns"] == ["shop_id", "shop_name", "slogan", "stock_value"]
+        assert [dict(zip(body["columns"], row)) for row in body["rows"]] == expected
+
+    def test_422_if_format_not_allowed(self, client):
+        response = client.get("/api/shops?format=table")
+        assert response.status_code == 422
+
+    def test_200_returns_only_requested_fields(self, client):
+        expected = client.get("/api/shops").json()["shops"]
+        response = client.get("/api/shops?fields=stock_value,shop_id")
+        assert response.json()["shops"] == [
+            {"shop_id": shop["shop_id"], "stock_value": shop["stock_value"]} for shop in expected
+        ]
+        assert client.get("/api/shops?fields=owner").status_code == 422
+
     """
     Error handling considerations for the GET /api/shops endpoint are tested below:
     """
@@ -416,4 +627,558 @@ class TestGetAllShops:
     """
     def test_405_if_method_not_allowed(self, client):
         response = client.delete("/api/shops")
-        assert response.status_code == 405
\ No newline at end of file
+        assert response.status_code == 405
+
+
+class TestResponseCache:
+    def test_repeated_reads_are_served_from_cache(self, client):
+        """
+        Test verifies:
+        - a repeated read with the same validated parameters is a cache hit
+        - the cached response is identical to the original
+        - different parameters are cached separately
+        """
+        first = client.get("/api/treasures?sort_by=age")
+        second = client.get("/api/treasures")
+        client.get("/api/treasures?colour=gold")
+        client.get("/api/shops")
+        client.get("/api/shops")
+        assert second.status_code == 200
+        assert second.json() == first.json()
+        stats = client.get("/api/cache").json()["cache"]
+        assert stats["hits"] == 2
+        assert stats["misses"] == 3
+        assert stats["entries"] == 3
+
+    def test_writes_invalidate_cached_listings(self, client):
+        """
+        Test verifies that reads after each successful write reflect the write
+        """
+        client.get("/api/treasures")
+        client.get("/api/shops")
+
+        client.post("/api/treasures", json={
+            "treasure_name": "new-treasure",
+            "colour": "saffron",
+            "age": 30,
+            "cost_at_auction": 70.99,
+            "shop_id": 1
+        })
+        treasures = client.get("/api/treasures").json()["treasures"]
+        assert any(treasure["treasure_id"] == 27 for treasure in treasures)
+        assert client.get("/api/shops").json()["shops"][0]["stock_value"] == 2492.97
+
+        client.patch("/api/treasures/27", json={"cost_at_auction": 10})
+        treasures = client.get("/api/treasures").json()["treasures"]
+        assert [t["cost_at_auction"] for t in treasures if t["treasure_id"] == 27] == [10]
+
+        client.delete("/api/treasures/27")
+        treasures = client.get("/api/treasures").json()["treasures"]
+        assert not any(treasure["treasure_id"] == 27 for treasure in treasures)
+        assert client.get("/api/shops").json()["shops"][0]["stock_value"] == 2421.98
+        assert client.get("/api/cache").json()["cache"]["invalidations"] == 3
+
+    def test_failed_writes_keep_cached_listings(self, client):
+        client.get("/api/treasures")
+        client.patch("/api/treasures/500", json={"cost_at_auction": 15})
+        client.delete("/api/treasures/500")
+        client.get("/api/treasures")
+        stats = client.get("/api/cache").json()["cache"]
+        assert stats["invalidations"] == 0
+        assert stats["hits"] == 1
+
+
+class TestGetTreasureFacets:
+    def test_200_returns_counts_matching_listing(self, client):
+        """
+        Test verifies:
+        - status code
+        - total and per-colour / per-shop counts agree with GET /api/treasures
+        - counts are sorted by count descending
+        - histograms have the requested number of buckets covering every treasure
+        """
+        response = client.get("/api/treasures/facets?buckets=5")
+        assert response.status_code == 200
+        body = response.json()
+        facets = body["facets"]
+        treasures = client.get("/api/treasures").json()["treasures"]
+        assert body["total"] == len(treasures) == 26
+
+        for colour_count in facets["colour"]:
+            assert colour_count["count"] == len([t for t in treasures if t["colour"] == colour_count["colour"]])
+        assert sum(colour_count["count"] for colour_count in facets["colour"]) == 26
+        assert [shop["count"] for shop in facets["shop_id"]] == sorted(
+            [shop["count"] for shop in facets["shop_id"]], reverse=True
+        )
+        assert {shop["shop_id"]: shop["count"] for shop in facets["shop_id"]}[1] == 3
+
+        for column in ["age", "cost_at_auction"]:
+            buckets = facets[column]
+            assert len(buckets) == 5
+            assert sum(bucket["count"] for bucket in buckets) == 26
+            assert buckets[0]["lower"] == min(t[column] for t in treasures)
+            assert buckets[-1]["upper"] == max(t[column] for t in treasures)
+            assert all(a["upper"] == b["lower"] for a, b in zip(buckets, buckets[1:]))
+
+    def test_200_applies_pre_filters(self, client):
+        facets = client.get("/api/treasures/facets?colour=gold").json()
+        assert facets["total"] == 2
+        assert facets["facets"]["colour"] == [{"colour": "gold", "count": 2}]
+
+        facets = client.get("/api/treasures/facets?shop_id=1&buckets=1").json()
+        assert facets["total"] == 3
+        assert facets["facets"]["shop_id"] == [{"shop_id": 1, "count": 3}]
+        assert facets["facets"]["age"][0]["count"] == 3
+
+        facets = client.get("/api/treasures/facets?shop_id=3&shop_id=7&min_cost=5").json()
+        assert facets["total"] == 2
+        assert facets["facets"]["shop_id"] == [{"shop_id": 3, "count": 1}, {"shop_id": 7, "count": 1}]
+
+        facets = client.get("/api/treasures/facets?shop_id=500").json()
+        assert facets == {"total": 0, "facets": {"colour": [], "shop_id": [], "age": [], "cost_at_auction": []}}
+
+    def test_200_counts_null_values_separately(self, client):
+        with pool.connection() as db:
+            db.run("UPDATE treasures SET age = NULL WHERE treasure_id IN (1, 2)")
+        age = client.get("/api/treasures/facets?buckets=2").json()["facets"]["age"]
+        assert len(age) == 3
+        assert age[-1] == {"lower": None, "upper": None, "count": 2}
+        assert age[0]["count"] + age[1]["count"] == 24
+
+    def test_writes_invalidate_cached_facets(self, client):
+        etag = client.get("/api/treasures/facets").headers["etag"]
+        client.post("/api/treasures", json={
+            "treasure_name": "new-treasure",
+            "colour": "khaki",
+            "age": 30,
+            "cost_at_auction": 70.99,
+            "shop_id": 1
+        })
+        response = client.get("/api/treasures/facets", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["total"] == 27
+        assert {"colour": "khaki", "count": 2} in response.json()["facets"]["colour"]
+        etag = response.headers["etag"]
+        assert client.get("/api/treasures/facets", headers={"If-None-Match": etag}).status_code == 304
+
+    """
+    Invalid colour or bucket count; 422 handled by FastAPI
+    """
+    def test_422_if_parameters_invalid(self, client):
+        for query in ["colour=plaid", "buckets=0", f"buckets={main.MAX_FACET_BUCKETS + 1}", "shop_id=one"]:
+            response = client.get(f"/api/treasures/facets?{query}")
+            assert response.status_code == 422
+
+
+class TestSearchTreasures:
+    def test_200_finds_names_by_word_prefix_case_insensitively(self, client):
+        """
+        Test verifies:
+        - status code
+        - matches are case-insensitive prefixes of words in the name
+        - every word of the query must match
+        - results carry the listing fields
+        """
+        response = client.get("/api/treasures/search?q=TREASURE-B")
+        assert response.status_code == 200
+        treasures = response.json()["treasures"]
+        assert [treasure["treasure_name"] for treasure in treasures] == ["treasure-b"]
+        assert treasures[0] == {
+            "treasure_id": 3,
+            "treasure_name": "treasure-b",
+            "colour": "gold",
+            "age": 13,
+            "cost_at_auction": 500.0,
+            "shop_name": "shop-f",
+        }
+
+        response = client.get("/api/treasures/search?q=treas")
+        assert len(response.json()["treasures"]) == 26
+        response = client.get("/api/treasures/search?q=reasure")
+        assert response.json()["treasures"] == []
+
+    def test_200_ranks_exact_then_prefix_matches_first(self, client):
+        for name in ["golden treasure-a", "treasure-a golden", "treasure-ab"]:
+            client.post("/api/treasures", json={
+                "treasure_name": name, "colour": "gold", "age": 1, "cost_at_auction": 1, "shop_id": 1
+            })
+        treasures = client.get("/api/treasures/search?q=treasure-a").json()["treasures"]
+        assert [treasure["treasure_name"] for treasure in treasures] == [
+            "treasure-a", "treasure-a golden", "treasure-ab", "golden treasure-a"
+        ]
+
+    def test_200_pages_through_results_with_cursor(self, client):
+        """
+        Test verifies:
+        - pages hold at most `limit` results
+        - following next_cursor lists every match once, in rank order
+        - the last page has no next_cursor
+        """
+        expected = client.get("/api/treasures/search?q=treasure&limit=1000").json()["treasures"]
+        treasures = []
+        response = client.get("/api/treasures/search?q=treasure&limit=4").json()
+        treasures += response["treasures"]
+        while response["next_cursor"]:
+            response = client.get(f"/api/treasures/search?q=treasure&limit=4&after={response['next_cursor']}").json()
+            assert len(response["treasures"]) <= 4
+            treasures += response["treasures"]
+        assert treasures == expected
+        assert len(treasures) == 26
+
+    def test_200_empty_for_queries_without_words(self, client):
+        for query in ["%25", "_", "!:*&"]:
+            response = client.get(f"/api/treasures/search?q={query}")
+            assert response.status_code == 200
+            assert response.json() == {"treasures": [], "next_cursor": None}
+
+    """
+    Missing query or invalid limit; 422 handled by FastAPI. Invalid cursor or
+    cursor issued for another query; custom 400 implemented
+    """
+    def test_422_if_query_missing_or_limit_invalid(self, client):
+        for query in ["", "q=", "q=treasure&limit=0", f"q=treasure&limit={main.MAX_PAGE_SIZE + 1}"]:
+            response = client.get(f"/api/treasures/search?{query}")
+            assert response.status_code == 422
+
+    def test_400_if_cursor_is_invalid(self, client):
+        cursor = client.get("/api/treasures/search?q=treasure&limit=2").json()["next_cursor"]
+        for query in ["q=treasure&after=not-a-cursor", f"q=shop&after={cursor}"]:
+            response = client.get(f"/api/treasures/search?{query}")
+            assert response.status_code == 400
+            assert response.json() == {"detail": "Invalid cursor"}
+
+
+class TestConditionalGet:
+    def test_304_if_none_match_matches_current_etag(self, client):
+        """
+        Test verifies:
+        - listings carry an ETag and must be revalidated
+        - a request with a matching If-None-Match gets an empty 304 with the same ETag
+        - the listing query is not run for a 304
+        """
+        for path in ["/api/treasures?colour=gold", "/api/shops"]:
+            response = client.get(path)
+            etag = response.headers["etag"]
+            assert etag.startswith('W/"')
+            assert response.headers["cache-control"] == "no-cache"
+
+            main.metrics.reset()
+            response = client.get(path, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+            assert response.headers["etag"] == etag
+            lines = client.get("/metrics").text.splitlines()
+            assert not any(
+                line.startswith("db_query_duration_seconds_count") and ("FROM treasures" in line or "FROM shops" in line)
+                for line in lines
+            )
+
+    def test_etag_differs_by_query_parameters(self, client):
+        etags = {
+            client.get(path).headers["etag"]
+            for path in ["/api/treasures", "/api/treasures?order=desc", "/api/treasures?format=columns", "/api/shops"]
+        }
+        assert len(etags) == 4
+
+    def test_200_with_new_etag_after_writes(self, client):
+        """
+        Test verifies that a write through the API, or straight to the database,
+        changes the ETag of every listing
+        """
+        etag = client.get("/api/treasures").headers["etag"]
+        shops_etag = client.get("/api/shops").headers["etag"]
+        client.patch("/api/treasures/1", json={"cost_at_auction": 1})
+        response = client.get("/api/treasures", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert client.get("/api/shops", headers={"If-None-Match": shops_etag}).status_code == 200
+
+        etag = response.headers["etag"]
+        with pool.connection() as db:
+            db.run("UPDATE treasures SET age = age + 1 WHERE treasure_id = 2")
+        response = client.get("/api/treasures", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert [t["age"] for t in response.json()["treasures"] if t["treasure_id"] == 2] == [101]
+
+    def test_if_none_match_lists_and_wildcard(self, client):
+        etag = client.get("/api/shops").headers["etag"]
+        strong = etag.removeprefix("W/")
+        assert client.get("/api/shops", headers={"If-None-Match": f'"other", {strong}'}).status_code == 304
+        assert client.get("/api/shops", headers={"If-None-Match": "*"}).status_code == 304
+        assert client.get("/api/shops", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+class TestExportTreasures:
+    def test_200_streams_ndjson_matching_listing(self, client):
+        """
+        Test verifies:
+        - status code and media type
+        - one JSON object per line, in the same order and shape as GET /api/treasures
+        - the streaming connection is returned to the pool
+        """
+        expected = client.get("/api/treasures?sort_by=cost_at_auction&order=desc").json()["treasures"]
+        response = client.get("/api/treasures/export?format=ndjson&sort_by=cost_at_auction&order=desc")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = response.text.splitlines()
+        assert [json.loads(line) for line in lines] == expected
+        assert pool.size == pool.idle
+
+    def test_200_streams_csv_with_header(self, client):
+        expected = client.get("/api/treasures?colour=gold").json()["treasures"]
+        response = client.get("/api/treasures/export?format=csv&colour=gold")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.headers["content-disposition"] == "attachment; filename=treasures.csv"
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert len(rows) == 2
+        assert [int(row["treasure_id"]) for row in rows] == [t["treasure_id"] for t in expected]
+        assert [float(row["cost_at_auction"]) for row in rows] == [t["cost_at_auction"] for t in expected]
+
+    def test_200_streams_in_chunks(self, client, monkeypatch):
+        monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 5)
+        with client.stream("GET", "/api/treasures/export") as response:
+            chunks = list(response.iter_text())
+        assert len([line for chunk in chunks for line in chunk.splitlines()]) == 26
+        assert pool.size == pool.idle
+
+    def test_200_applies_filters(self, client):
+        query = "sort_by=treasure_name&min_age=50&max_cost=10&shop_id=2&shop_id=3"
+        expected = client.get(f"/api/treasures?{query}").json()["treasures"]
+        response = client.get(f"/api/treasures/export?format=ndjson&{query}")
+        assert len(expected) == 4
+        assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+    def test_200_empty_export(self, client):
+        with pool.connection() as db:
+            db.run("DELETE FROM treasures WHERE colour = 'gold'")
+        response = client.get("/api/treasures/export?colour=gold")
+        assert response.status_code == 200
+        assert response.text == ""
+
+    def test_422_if_format_not_allowed(self, client):
+        response = client.get("/api/treasures/export?format=xml")
+        assert response.status_code == 422
+
+
+class TestPostNewTreasureBatch:
+    def test_201_adds_treasures_and_returns_them_in_input_order(self, client):
+        """
+        Test verifies:
+        - status code
+        - created treasures are returned in input order with new treasure_ids
+        - the treasures are visible to subsequent reads
+        """
+        new_treasures = [
+            {"treasure_name": f"new-treasure-{n}", "colour": "saffron", "age": n, "cost_at_auction": n + 0.5, "shop_id": 11 - n}
+            for n in range(5)
+        ]
+        response = client.post("/api/treasures/batch", json={"treasures": new_treasures})
+        assert response.status_code == 201
+        assert response.json() == {
+            "treasures": [
+                {"treasure_id": 27 + n, **new_treasure} for n, new_treasure in enumerate(new_treasures)
+            ]
+        }
+        treasures = client.get("/api/treasures").json()["treasures"]
+        assert len(treasures) == 31
+
+    """
+    Item is invalid; 422 handled by FastAPI, reported per item
+    """
+    def test_422_reports_each_invalid_item(self, client):
+        response = client.post("/api/treasures/batch", json={"treasures": [
+            {"treasure_name": "ok", "colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 1},
+            {"treasure_name": 100, "colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 1},
+            {"colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 1},
+        ]})
+        assert response.status_code == 422
+        locations = [error["loc"] for error in response.json()["detail"]]
+        assert locations == [["body", "treasures", 1, "treasure_name"], ["body", "treasures", 2, "treasure_name"]]
+
+    def test_422_reports_each_item_too_long_for_its_column(self, client):
+        response = client.post("/api/treasures/batch", json={"treasures": [
+            {"treasure_name": "n" * 256, "colour": "c" * 42, "age": 1, "cost_at_auction": 1, "shop_id": 1},
+            {"treasure_name": "n" * 257, "colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 1},
+            {"treasure_name": "ok", "colour": "c" * 43, "age": 1, "cost_at_auction": 1, "shop_id": 1},
+        ]})
+        assert response.status_code == 422
+        assert [(error["loc"], error["type"]) for error in response.json()["detail"]] == [
+            (["body", "treasures", 1, "treasure_name"], "string_too_long"),
+            (["body", "treasures", 2, "colour"], "string_too_long"),
+        ]
+        assert len(client.get("/api/treasures").json()["treasures"]) == 26
+
+    """
+    Item references a shop that does not exist; custom 422 reported per item, nothing inserted
+    """
+    def test_422_reports_each_unknown_shop_and_inserts_nothing(self, client):
+        response = client.post("/api/treasures/batch", json={"treasures": [
+            {"treasure_name": "a", "colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 1},
+            {"treasure_name": "b", "colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 500},
+            {"treasure_name": "c", "colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 501},
+        ]})
+        assert response.status_code == 422
+        assert [(error["loc"], error["msg"]) for error in response.json()["detail"]] == [
+            (["body", "treasures", 1, "shop_id"], "No shop found with given ID: 500"),
+            (["body", "treasures", 2, "shop_id"], "No shop found with given ID: 501"),
+        ]
+        assert len(client.get("/api/treasures").json()["treasures"]) == 26
+
+    """
+    Batch empty or above the maximum size; 422 handled by FastAPI
+    """
+    def test_422_if_batch_is_empty_or_too_large(self, client):
+        response = client.post("/api/treasures/batch", json={"treasures": []})
+        assert response.status_code == 422
+
+        new_treasure = {"treasure_name": "a", "colour": "saffron", "age": 1, "cost_at_auction": 1, "shop_id": 1}
+        response = client.post("/api/treasures/batch", json={"treasures": [new_treasure] * (main.MAX_BATCH_SIZE + 1)})
+        assert response.status_code == 422
+
+
+
+class TestPatchUpdateTreasurePrices:
+    def test_200_updates_prices_and_returns_them_in_input_order(self, client):
+        """
+        Test verifies:
+        - status code
+        - updated treasures are returned in input order
+        - the new prices are visible to subsequent reads
+        """
+        response = client.patch("/api/treasures", json={"treasures": [
+            {"treasure_id": 3, "cost_at_auction": 30},
+            {"treasure_id": 1, "cost_at_auction": 15.5},
+        ]})
+        assert response.status_code == 200
+        treasures = response.json()["treasures"]
+        assert [(t["treasure_id"], t["cost_at_auction"]) for t in treasures] == [(3, 30), (1, 15.5)]
+        assert treasures[1] == {
+            "treasure_id": 1,
+            "treasure_name": "treasure-a",
+            "colour": "turquoise",
+            "age": 200,
+            "cost_at_auction": 15.5,
+            "shop_id": 1
+        }
+        listed = {t["treasure_id"]: t["cost_at_auction"] for t in client.get("/api/treasures").json()["treasures"]}
+        assert listed[1] == 15.5 and listed[3] == 30
+
+    """
+    Some treasure IDs do not exist; custom 404 listing them, nothing updated
+    """
+    def test_404_lists_missing_ids_and_updates_nothing(self, client):
+        response = client.patch("/api/treasures", json={"treasures": [
+            {"treasure_id": 1, "cost_at_auction": 15},
+            {"treasure_id": 500, "cost_at_auction": 15},
+            {"treasure_id": 501, "cost_at_auction": 15},
+        ]})
+        assert response.status_code == 404
+        assert response.json() == {
+            "detail": "No treasures found with given IDs: 500, 501"
+        }
+        listed = {t["treasure_id"]: t["cost_at_auction"] for t in client.get("/api/treasures").json()["treasures"]}
+        assert listed[1] == 20
+
+    """
+    422s: price 0 or below (same rule as the single update), repeated IDs, empty list
+    """
+    def test_422_for_invalid_request_body(self, client):
+        response = client.patch("/api/treasures", json={"treasures": [
+            {"treasure_id": 1, "cost_at_auction": 15},
+            {"treasure_id": 2, "cost_at_auction": -5},
+        ]})
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["body", "treasures", 1, "cost_at_auction"]
+
+        response = client.patch("/api/treasures", json={"treasures": [
+            {"treasure_id": 1, "cost_at_auction": 15},
+            {"treasure_id": 1, "cost_at_auction": 16},
+        ]})
+        assert response.status_code == 422
+        assert response.json() == {
+            "detail": "Treasure IDs must be unique, repeated: 1"
+        }
+
+        response = client.patch("/api/treasures", json={"treasures": []})
+        assert response.status_code == 422
+
+
+class TestDeleteTreasures:
+    def test_204_treasures_have_been_deleted(self, client):
+        response = client.request("DELETE", "/api/treasures", json={"treasure_ids": [1, 2, 2, 3]})
+        assert response.status_code == 204
+
+        treasures = client.get("/api/treasures").json()["treasures"]
+        assert len(treasures) == 23
+        assert not any(treasure["treasure_id"] in (1, 2, 3) for treasure in treasures)
+
+    """
+    Some treasure IDs do not exist; custom 404 listing them, nothing deleted
+    """
+    def test_404_lists_missing_ids_and_deletes_nothing(self, client):
+        response = client.request("DELETE", "/api/treasures", json={"treasure_ids": [1, 50]})
+        assert response.status_code == 404
+        assert response.json() == {
+            "detail": "No treasures found with given IDs: 50"
+        }
+        assert len(client.get("/api/treasures").json()["treasures"]) == 26
+
+    def test_422_if_request_body_is_invalid(self, client):
+        response = client.request("DELETE", "/api/treasures", json={"treasure_ids": []})
+        assert response.status_code == 422
+
+        response = client.request("DELETE", "/api/treasures", json={"treasure_ids": ["one"]})
+        assert response.status_code == 422
+
+
+class TestGetMetrics:
+    def test_200_exposes_request_query_and_pool_metrics(self, client):
+        """
+        Test verifies:
+        - status code and Prometheus text content type
+        - requests are counted by route template, not by raw path
+        - query timings and row counts are labelled by SQL shape
+        - connection pool and response cache figures are included
+        """
+        main.metrics.reset()
+        client.get("/api/treasures?colour=gold")
+        client.patch("/api/treasures/3", json={"cost_at_auction": 5})
+        client.patch("/api/treasures/4", json={"cost_at_auction": 5})
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        lines = response.text.splitlines()
+        assert 'http_requests_total{method="GET",route="/api/treasures",status="200"} 1' in lines
+        assert 'http_requests_total{method="PATCH",route="/api/treasures/{treasure_id}",status="200"} 2' in lines
+        assert any(
+            line.startswith('http_request_duration_seconds_count{method="GET",route="/api/treasures"}')
+            for line in lines
+        )
+        update_shape = query_shape(main.UPDATE_TREASURE_PRICE)
+        assert f'db_query_duration_seconds_count{{query="{update_shape}"}} 2' in lines
+        assert f'db_query_rows_total{{query="{update_shape}"}} 2' in lines
+        assert any(line.startswith("db_pool_wait_duration_seconds_count ") for line in lines)
+        assert any(line.startswith('db_pool_connections{state="idle"}') for line in lines)
+        assert 'response_cache_events_total{event="misses"} 1' in lines
+        assert any(line.startswith('response_encode_duration_seconds_count{key="treasures"} 1') for line in lines)
+
+    def test_unmatched_paths_share_one_label(self, client):
+        main.metrics.reset()
+        client.get("/api/not-a-route")
+        client.get("/api/also-not-a-route")
+        lines = client.get("/metrics").text.splitlines()
+        assert 'http_requests_total{method="GET",route="unmatched",status="404"} 2' in lines
+
+    def test_failed_queries_are_counted(self, client):
+        main.metrics.reset()
+        client.post("/api/treasures", json={
+            "treasure_name": "new-treasure",
+            "colour": "saffron",
+            "age": 30,
+            "cost_at_auction": 70.99,
+            "shop_id": 500
+        })
+        lines = client.get("/metrics").text.splitlines()
+        insert_shape = query_shape(main.INSERT_TREASURE)
+        assert f'db_query_errors_total{{query="{insert_shape}"}} 1' in lines
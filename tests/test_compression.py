@@ -0,0 +1,87 @@
+'''This module contains the test suite for the response compression used by
+the `Cat's Rare Treasures` FastAPI app.'''
+from fastapi.testclient import TestClient
+from main import app
+import main
+from compression import COMPRESSION_MIN_BYTES, negotiate
+import gzip
+import json
+import pytest
+
+
+pytestmark = pytest.mark.usefixtures("db_transaction")
+
+
+@pytest.fixture()
+def client():
+    return TestClient(app)
+
+
+def raw_get(client, path, accept_encoding, **headers):
+    '''Returns the response to `path` and its body as sent, before decoding.'''
+    with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding, **headers}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+class TestNegotiation:
+    def test_highest_quality_wins_then_server_preference(self):
+        encodings = ["zstd", "br", "gzip"]
+        assert negotiate("gzip, deflate, br, zstd", encodings) == "zstd"
+        assert negotiate("gzip;q=1.0, br;q=0.8", encodings) == "gzip"
+        assert negotiate("*;q=0.5, gzip;q=0.1", encodings) == "zstd"
+        assert negotiate("br;q=0, gzip", encodings) == "gzip"
+        assert negotiate("identity", encodings) is None
+        assert negotiate("", encodings) is None
+        assert negotiate("gzip;q=bad", encodings) is None
+
+
+class TestCompressedResponses:
+    def test_large_listings_are_gzipped(self, client):
+        """
+        Test verifies:
+        - a listing above the threshold is sent gzipped, with its compressed length
+        - responses vary on Accept-Encoding and keep their ETag
+        - the decoded body is the uncompressed one
+        """
+        plain, plain_body = raw_get(client, "/api/treasures", "identity")
+        assert len(plain_body) >= COMPRESSION_MIN_BYTES
+        assert "content-encoding" not in plain.headers
+
+        response, body = raw_get(client, "/api/treasures", "gzip")
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert int(response.headers["content-length"]) == len(body) < len(plain_body) / 3
+        assert response.headers["etag"] == plain.headers["etag"]
+        assert gzip.decompress(body) == plain_body
+
+    def test_small_and_not_modified_responses_are_not_compressed(self, client):
+        response, body = raw_get(client, "/api/shops?fields=shop_id", "gzip")
+        assert len(body) < COMPRESSION_MIN_BYTES
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+
+        etag = client.get("/api/treasures").headers["etag"]
+        response, body = raw_get(client, "/api/treasures", "gzip", **{"If-None-Match": etag})
+        assert response.status_code == 304
+        assert body == b"" and "content-encoding" not in response.headers
+
+    def test_exports_are_compressed_as_they_stream(self, client, monkeypatch):
+        monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 5)
+        expected = client.get("/api/treasures?format=columns").json()["rows"]
+        with client.stream("GET", "/api/treasures/export", headers={"Accept-Encoding": "gzip"}) as response:
+            assert response.headers["content-encoding"] == "gzip"
+            assert "content-length" not in response.headers
+            body = b"".join(response.iter_raw())
+        # Each chunk is flushed on its own, ending in an empty stored block.
+        assert body.count(b"\x00\x00\xff\xff") > 1
+        rows = [json.loads(line) for line in gzip.decompress(body).splitlines()]
+        assert [list(row.values()) for row in rows] == expected
+
+    @pytest.mark.parametrize("encoding, module", [("br", "brotli"), ("zstd", "zstandard")])
+    def test_optional_encodings(self, client, encoding, module):
+        library = pytest.importorskip(module)
+        plain, plain_body = raw_get(client, "/api/treasures", "identity")
+        response, body = raw_get(client, "/api/treasures", encoding)
+        assert response.headers["content-encoding"] == encoding
+        decompress = library.decompress if encoding == "br" else library.ZstdDecompressor().decompress
+        assert decompress(body) == plain_body
@@ -0,0 +1,81 @@
+'''This module contains the test suite for the connection pool
+used by the `Cat's Rare Treasures` FastAPI app.'''
+from db.connection import ConnectionPool, PoolTimeout, PoolClosed
+import threading
+import pytest
+
+
+@pytest.fixture()
+def test_pool(make_pool):
+    return make_pool(min_size=2, max_size=3, acquire_timeout=0.2)
+
+
+class TestConnectionPool:
+    def test_open_warms_pool_to_min_size(self, test_pool):
+        test_pool.open()
+        assert test_pool.size == 2
+        assert test_pool.idle == 2
+
+    def test_released_connections_are_reused(self, test_pool):
+        with test_pool.connection() as db:
+            first = db
+            assert db.run("SELECT 1") == [[1]]
+        with test_pool.connection() as db:
+            assert db is first
+        assert test_pool.size == 1
+
+    def test_acquire_times_out_when_pool_is_exhausted(self, test_pool):
+        borrowed = [test_pool.acquire() for _ in range(3)]
+        with pytest.raises(PoolTimeout):
+            test_pool.acquire()
+        for db in borrowed:
+            test_pool.release(db)
+        assert test_pool.size == 3
+
+    def test_waiting_caller_gets_released_connection(self, test_pool):
+        test_pool.acquire_timeout = 2
+        borrowed = [test_pool.acquire() for _ in range(3)]
+        threading.Timer(0.1, test_pool.release, args=(borrowed[0],)).start()
+        db = test_pool.acquire()
+        assert db is borrowed[0]
+        for db in borrowed:
+            test_pool.release(db)
+
+    def test_broken_connection_is_replaced_after_health_check(self, test_pool):
+        test_pool.check_after = 0
+        with test_pool.connection() as db:
+            broken = db
+            pid = db.run("SELECT pg_backend_pid()")[0][0]
+        admin = ConnectionPool(max_size=1)
+        with admin.connection() as db:
+            db.run("SELECT pg_terminate_backend(:pid)", pid=pid)
+        admin.close()
+        with test_pool.connection() as db:
+            assert db is not broken
+            assert db.run("SELECT 1") == [[1]]
+        assert test_pool.size == 1
+
+    def test_open_transaction_is_rolled_back_on_release(self, test_pool):
+        with test_pool.connection() as db:
+            db.run("START TRANSACTION")
+        with test_pool.connection() as db:
+            assert db._transaction_status == b"I"
+
+    def test_idle_connections_above_min_size_are_evicted(self, test_pool):
+        test_pool.max_idle = 0
+        borrowed = [test_pool.acquire() for _ in range(3)]
+        for db in borrowed:
+            test_pool.release(db)
+        with test_pool.connection():
+            pass
+        assert test_pool.size == 2
+
+    def test_close_drains_pool(self, test_pool):
+        test_pool.open()
+        borrowed = test_pool.acquire()
+        test_pool.close()
+        assert test_pool.size == 1
+        test_pool.release(borrowed)
+        assert test_pool.size == 0
+        with pytest.raises(PoolClosed):
+            test_pool.acquire()
@@ -0,0 +1,50 @@
+'''This module contains the test suite for the request and query
+instrumentation used by the `Cat's Rare Treasures` FastAPI app.'''
+from metrics import MetricsRegistry, query_shape
+import logging
+
+
+class TestMetricsRegistry:
+    def test_render_outputs_counters_and_histograms_in_prometheus_text_format(self):
+        registry = MetricsRegistry(buckets=(0.1, 1.0))
+        registry.inc("http_requests_total", method="GET", route="/api/shops", status=200)
+        registry.inc("http_requests_total", method="GET", route="/api/shops", status=200)
+        registry.observe("db_query_duration_seconds", 0.05, query="SELECT 1")
+        registry.observe("db_query_duration_seconds", 0.5, query="SELECT 1")
+        lines = registry.render().splitlines()
+        assert "# TYPE http_requests_total counter" in lines
+        assert 'http_requests_total{method="GET",route="/api/shops",status="200"} 2' in lines
+        assert "# TYPE db_query_duration_seconds histogram" in lines
+        assert 'db_query_duration_seconds_bucket{query="SELECT 1",le="0.1"} 1' in lines
+        assert 'db_query_duration_seconds_bucket{query="SELECT 1",le="1.0"} 2' in lines
+        assert 'db_query_duration_seconds_bucket{query="SELECT 1",le="+Inf"} 2' in lines
+        assert 'db_query_duration_seconds_sum{query="SELECT 1"} 0.55' in lines
+        assert 'db_query_duration_seconds_count{query="SELECT 1"} 2' in lines
+
+    def test_label_values_are_escaped(self):
+        registry = MetricsRegistry()
+        registry.inc("db_query_errors_total", query='SELECT "a\\b"\nFROM t')
+        assert 'db_query_errors_total{query="SELECT \\"a\\\\b\\"\\nFROM t"} 1' in registry.render()
+
+    def test_query_shape_collapses_whitespace(self):
+        assert query_shape("\n    SELECT *\n    FROM treasures\n    WHERE age = :age;\n") == (
+            "SELECT * FROM treasures WHERE age = :age;"
+        )
+
+    def test_slow_queries_are_logged_with_their_parameters(self, caplog):
+        registry = MetricsRegistry(slow_query_seconds=0.1)
+        with caplog.at_level(logging.WARNING, logger="cats_rare_treasures.slow_query"):
+            registry.record_query("SELECT * FROM treasures WHERE age = :age", {"age": 7}, 0.05, 1)
+            registry.record_query("SELECT * FROM treasures\n WHERE age = :age", {"age": 9}, 0.2, 3)
+        assert len(caplog.records) == 1
+        message = caplog.records[0].getMessage()
+        assert "SELECT * FROM treasures WHERE age = :age" in message
+        assert "{'age': 9}" in message
+        assert registry.get("db_slow_queries_total", query="SELECT * FROM treasures WHERE age = :age") == 1
+        assert registry.get("db_query_rows_total", query="SELECT * FROM treasures WHERE age = :age") == 4
+
+    def test_slow_query_log_is_off_by_default(self, caplog):
+        registry = MetricsRegistry()
+        with caplog.at_level(logging.WARNING, logger="cats_rare_treasures.slow_query"):
+            registry.record_query("SELECT pg_sleep(10)", {}, 10.0, 1)
+        assert caplog.records == []
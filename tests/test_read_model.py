@@ -0,0 +1,305 @@
+'''This module contains the test suite for the in-process read model used
+by the `Cat's Rare Treasures` FastAPI app, with a second local database
+taking the writes that the change feed reports.'''
+from fastapi.testclient import TestClient
+from main import app, Order, SortBy, TreasureFilters, keyset_segments, select_treasures_query
+import main
+from db.connection import connect_to_db
+from db.shop_stock import SELECT_SHOPS
+from metrics import metrics
+from read_model import ReadModel, Snapshot, SELECT_COLLATION, float4, float4_output
+from functools import partial
+import time
+import pytest
+
+
+pytestmark = pytest.mark.usefixtures("db_transaction")
+
+
+@pytest.fixture(scope="module")
+def feed_database(seeded_copy):
+    '''A seeded copy of the test database that tests write to and commit.'''
+    return seeded_copy("feed")
+
+
+@pytest.fixture()
+def feed_db(feed_database):
+    db = connect_to_db(database=feed_database)
+    yield db
+    db.close()
+
+
+def skip_unless_enabled(model):
+    '''Skips the test where the read model switched itself off, because the
+    database does not sort names by code point.'''
+    if not model.enabled:
+        pytest.skip("the read model is off under the collation of the test database")
+
+
+@pytest.fixture()
+def feed_model(feed_database):
+    model = ReadModel(enabled=True, poll_interval=0.05, connect=partial(connect_to_db, database=feed_database))
+    model._subscribe()
+    skip_unless_enabled(model)
+    yield model
+    model.stop()
+
+
+@pytest.fixture()
+def read_model(monkeypatch):
+    '''A read model of the seeded test database, serving the app.'''
+    model = ReadModel(enabled=True, poll_interval=0.05)
+    model.start()
+    skip_unless_enabled(model)
+    monkeypatch.setattr(main, "read_model", model)
+    yield model
+    model.stop()
+
+
+@pytest.fixture()
+def client():
+    return TestClient(app)
+
+
+def database_listing(db, sort_by, order, filters):
+    predicate, order_by = keyset_segments(sort_by.value, order, None)[0]
+    query = select_treasures_query(predicate, order_by, filters.conditions())
+    return db.run(query, limit=None, **filters.params())
+
+
+def assert_snapshot_matches(model, db):
+    '''Checks every sort order, with and without filters, against the database.'''
+    for sort_by in SortBy:
+        for order in Order:
+            for filters in [
+                TreasureFilters(),
+                TreasureFilters(min_age=10, max_age=100, shop_id=[1, 2, 4, 8]),
+                TreasureFilters(min_cost=6.99, max_cost=60.99),
+            ]:
+                with model.reading() as snapshot:
+                    _, rows = snapshot.treasures(sort_by.value, order == Order.desc, filters)
+                assert rows == database_listing(db, sort_by, order, filters)
+    with model.reading() as snapshot:
+        assert snapshot.version == db.run("SELECT version FROM data_version")[0][0]
+        assert snapshot.shops[1] == db.run(SELECT_SHOPS)
+
+
+class TestSnapshot:
+    def test_float4_output_matches_postgres_real_output(self):
+        for value in [60.99, 0.01, 99999.99, 1001.0, 3.99, 0.59, 2340.99]:
+            assert float4_output(float4(value)) == value
+
+    def test_upsert_and_delete_keep_sort_orders_and_reuse_slots(self):
+        snapshot = Snapshot(version=1)
+        snapshot.shop_names = {1: "shop-a"}
+        snapshot.load([
+            (1, "b", "gold", 5, float4(1.5), 1),
+            (2, "a", "onyx", None, float4(0.5), 1),
+            (3, "c", None, 5, None, 1),
+        ])
+        snapshot.delete(1)
+        snapshot.upsert((4, "aa", "gold", 1, float4(2.5), 1))
+        snapshot.upsert((3, "c", "gold", 7, float4(0.25), 1))
+        assert snapshot.slots == {2: 1, 3: 2, 4: 0}
+
+        def ids(sort_by, descending=False, **filters):
+            _, rows = snapshot.treasures(sort_by, descending, TreasureFilters(**filters))
+            return [row[0] for row in rows]
+
+        assert ids("age") == [4, 3, 2]
+        assert ids("age", descending=True) == [2, 3, 4]
+        assert ids("cost_at_auction") == [3, 2, 4]
+        assert ids("treasure_name") == [2, 4, 3]
+        assert ids("age", colour=main.Colour.gold) == [4, 3]
+        assert ids("age", min_age=2) == [3]
+
+
+class TestReadModelServing:
+    QUERIES = [
+        "/api/treasures",
+        "/api/treasures?sort_by=cost_at_auction&order=desc",
+        "/api/treasures?sort_by=treasure_name&colour=gold",
+        "/api/treasures?min_age=13&max_age=77&shop_id=6&shop_id=11",
+        "/api/treasures?min_cost=6.99&max_cost=60.99&format=columns",
+        "/api/treasures?colour=plaid",
+        "/api/treasures?fields=treasure_id,cost_at_auction&sort_by=cost_at_auction&limit=5",
+        "/api/shops",
+        "/api/shops?format=columns",
+        "/api/shops?fields=shop_name,stock_value",
+    ]
+
+    def test_listings_match_database_without_querying_it(self, client, read_model, monkeypatch):
+        """
+        Test verifies, for listings with sorts, filters and formats:
+        - the read model serves the same status, body and ETag as the database
+        - no database connection is borrowed
+        """
+        expected = {}
+        monkeypatch.setattr(read_model, "ready", False)
+        for query in self.QUERIES:
+            response = client.get(query)
+            expected[query] = (response.status_code, response.json(), response.headers.get("etag"))
+
+        monkeypatch.setattr(read_model, "ready", True)
+        monkeypatch.setattr(main, "read_connection", None)
+        main.response_cache.clear()
+        for query in self.QUERIES:
+            response = client.get(query)
+            assert (response.status_code, response.json(), response.headers.get("etag")) == expected[query]
+
+    def test_pages_match_database(self, client, read_model, monkeypatch):
+        for sort_by in ["age", "cost_at_auction", "treasure_name"]:
+            for order in ["asc", "desc"]:
+                query = f"/api/treasures?sort_by={sort_by}&order={order}&limit=4"
+                monkeypatch.setattr(read_model, "ready", False)
+                expected = client.get(query.removesuffix("&limit=4")).json()["treasures"]
+                monkeypatch.setattr(read_model, "ready", True)
+
+                pages = []
+                response = client.get(query).json()
+                pages.append(response["treasures"])
+                while response["next_cursor"]:
+                    response = client.get(f"{query}&after={response['next_cursor']}").json()
+                    pages.append(response["treasures"])
+                assert [treasure for page in pages for treasure in page] == expected
+
+    def test_reads_after_a_write_go_to_database(self, client, read_model):
+        response = client.post("/api/treasures", json={
+            "treasure_name": "new-treasure", "colour": "saffron", "age": 30, "cost_at_auction": 70.99, "shop_id": 1
+        })
+        assert main.PRIMARY_READS_COOKIE in response.cookies
+        names = [treasure["treasure_name"] for treasure in client.get("/api/treasures").json()["treasures"]]
+        assert "new-treasure" in names
+
+    def test_memory_footprint_is_reported(self, client, read_model):
+        stats = client.get("/api/read-model").json()["read_model"]
+        assert stats["enabled"] and stats["ready"]
+        assert stats["rows"] == 26
+        assert stats["bytes"] > 0
+        assert f"read_model_bytes {stats['bytes']}" in client.get("/metrics").text
+
+    def test_disabled_by_default(self, client):
+        stats = client.get("/api/read-model").json()["read_model"]
+        assert stats == {"enabled": False, "ready": False, "version": None, "rows": 0, "bytes": 0}
+
+    @pytest.mark.parametrize("collation, provider, enabled", [
+        ("C", "c", True),
+        ("POSIX", "c", True),
+        ("C.UTF-8", "c", True),
+        ("C.utf8", "c", True),
+        ("en_US.UTF-8", "c", False),
+        ("C", "i", False),
+        ("C", "b", False),
+    ])
+    def test_enabled_only_where_names_sort_by_code_point(self, collation, provider, enabled, monkeypatch):
+        """
+        Test verifies, for the default collation and locale provider of the database:
+        - the read model stays on for libc locales that sort by code point
+        - it turns itself off, without loading a snapshot, for any other
+        """
+        class Connection:
+            closed = False
+
+            def run(self, sql, **params):
+                return [[collation, provider]] if sql == SELECT_COLLATION else []
+
+            def close(self):
+                self.closed = True
+
+        conn = Connection()
+        model = ReadModel(enabled=True, connect=lambda: conn)
+        loads = []
+        monkeypatch.setattr(model, "reload", lambda: loads.append(True))
+        model._subscribe()
+        assert model.enabled == enabled
+        assert bool(loads) == enabled
+        assert conn.closed != enabled
+
+
+class TestChangeFeed:
+    def test_committed_writes_are_applied_incrementally(self, feed_model, feed_db):
+        """
+        Test verifies, after inserts, updates (including to NULL) and deletes:
+        - the snapshot matches the database for every sort order and filter
+        - only the changed rows were re-read
+        """
+        reloads = metrics.get("read_model_refreshes_total", kind="reload")
+        feed_db.run("""
+            INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
+            VALUES ('feed-a', 'gold', 40, 12.5, 2), ('feed-b', NULL, NULL, NULL, 4)
+        """)
+        feed_db.run("UPDATE treasures SET age = NULL, colour = 'onyx' WHERE treasure_id IN (1, 7)")
+        feed_db.run("UPDATE treasures SET cost_at_auction = 0.1, shop_id = 8 WHERE treasure_id = 3")
+        feed_db.run("DELETE FROM treasures WHERE treasure_id IN (2, 5)")
+        assert feed_model.refresh()
+        assert metrics.get("read_model_refreshes_total", kind="reload") == reloads
+        assert_snapshot_matches(feed_model, feed_db)
+
+        feed_db.run("INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id) "
+                    "VALUES ('feed-c', 'azure', 1, 1.5, 1)")
+        assert feed_model.refresh()
+        assert_snapshot_matches(feed_model, feed_db)
+
+    def test_write_committed_during_a_refresh_is_applied_before_its_version(self, feed_model, feed_db, monkeypatch):
+        """
+        Test verifies, when a write commits after the notifications are drained
+        but before the changed rows are re-read:
+        - the refresh does not publish the `data_version` counting that write
+          until the write's rows are in the snapshot
+        """
+        conn = feed_model._conn
+        run = conn.run
+
+        def run_with_a_concurrent_write(sql, **params):
+            if sql.startswith("START TRANSACTION") and not concurrent_writes:
+                concurrent_writes.append(feed_db.run("UPDATE treasures SET age = 999 WHERE treasure_id = 4"))
+            return run(sql, **params)
+
+        concurrent_writes = []
+        monkeypatch.setattr(conn, "run", run_with_a_concurrent_write)
+        feed_db.run("UPDATE treasures SET age = 998 WHERE treasure_id = 6")
+        assert feed_model.refresh()
+        assert concurrent_writes
+        assert_snapshot_matches(feed_model, feed_db)
+
+    def test_rolled_back_writes_are_ignored(self, feed_model, feed_db):
+        feed_db.run("START TRANSACTION")
+        feed_db.run("DELETE FROM treasures")
+        feed_db.run("ROLLBACK")
+        assert not feed_model.refresh()
+
+    def test_shop_changes_update_names(self, feed_model, feed_db):
+        feed_db.run("UPDATE shops SET shop_name = 'renamed' WHERE shop_id = 1")
+        assert feed_model.refresh()
+        assert_snapshot_matches(feed_model, feed_db)
+
+    def test_truncate_reloads_the_snapshot(self, feed_model, feed_db):
+        reloads = metrics.get("read_model_refreshes_total", kind="reload")
+        feed_db.run("TRUNCATE treasures")
+        assert feed_model.refresh()
+        assert metrics.get("read_model_refreshes_total", kind="reload") == reloads + 1
+        assert feed_model.stats()["rows"] == 0
+        assert_snapshot_matches(feed_model, feed_db)
+
+        feed_db.run("""
+            INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
+            SELECT 'refill-' || n, 'gold', n, n / 4.0, 1 + n % 11 FROM generate_series(1, 20) AS n
+        """)
+        assert feed_model.refresh()
+        assert_snapshot_matches(feed_model, feed_db)
+
+    def test_background_thread_follows_the_feed(self, feed_database, feed_db):
+        model = ReadModel(enabled=True, poll_interval=0.05, connect=partial(connect_to_db, database=feed_database))
+        model.start()
+        skip_unless_enabled(model)
+        try:
+            feed_db.run("UPDATE treasures SET age = age + 1")
+            version = feed_db.run("SELECT version FROM data_version")[0][0]
+            deadline = time.monotonic() + 5
+            while model.stats()["version"] != version and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert model.stats()["version"] == version
+            assert_snapshot_matches(model, feed_db)
+        finally:
+            model.stop()
+
@@ -0,0 +1,135 @@
+'''This module contains the test suite for the read-replica routing used
+by the `Cat's Rare Treasures` FastAPI app, with a second local database
+standing in for the replica.'''
+from fastapi.testclient import TestClient
+from main import app
+import main
+from db.connection import ConnectionPool, connect_to_db, pool
+from db.replicas import Replica, ReplicaSet, parse_replicas
+from functools import partial
+import pytest
+
+
+pytestmark = pytest.mark.usefixtures("db_transaction")
+
+
+@pytest.fixture(scope="module")
+def replica_database(seeded_copy):
+    '''A seeded copy of the test database in which treasure 1 is renamed, so
+    that responses show which database served them.'''
+    database = seeded_copy("replica")
+    db = connect_to_db(database=database)
+    db.run("UPDATE treasures SET treasure_name = 'replica-treasure' WHERE treasure_id = 1")
+    db.close()
+    return database
+
+
+def replica_pool(database, port=None):
+    return ConnectionPool(connect=partial(connect_to_db, database=database, port=port), min_size=0, max_size=2)
+
+
+@pytest.fixture()
+def replica_set(replica_database, monkeypatch):
+    replica_set = ReplicaSet(pool, [Replica("replica", replica_pool(replica_database))], retry_after=60)
+    monkeypatch.setattr(main, "replicas", replica_set)
+    yield replica_set
+    replica_set.close()
+
+@pytest.fixture()
+def client():
+    return TestClient(app)
+
+
+def treasure_names(client, path="/api/treasures"):
+    return {treasure["treasure_name"] for treasure in client.get(path).json()["treasures"]}
+
+
+class TestReplicaRouting:
+    def test_reads_go_to_replica(self, client, replica_set):
+        """
+        Test verifies that every GET endpoint reads from the replica
+        """
+        assert "replica-treasure" in treasure_names(client)
+        assert "replica-treasure" in treasure_names(client, "/api/treasures/search?q=replica")
+        export = client.get("/api/treasures/export").text
+        assert "replica-treasure" in export
+        assert client.get("/api/shops").status_code == 200
+        assert replica_set.replicas[0].pool.size == replica_set.replicas[0].pool.idle > 0
+
+    def test_writes_go_to_primary_and_later_reads_follow_them(self, client, replica_set):
+        """
+        Test verifies:
+        - writes reach the primary only
+        - a successful write pins the client's reads to the primary for a while
+        - other clients keep reading from the replica
+        """
+        response = client.post("/api/treasures", json={
+            "treasure_name": "new-treasure", "colour": "saffron", "age": 30, "cost_at_auction": 70.99, "shop_id": 1
+        })
+        assert response.status_code == 201
+        assert main.PRIMARY_READS_COOKIE in response.cookies
+
+        names = treasure_names(client)
+        assert "new-treasure" in names
+        assert "replica-treasure" not in names
+
+        other_client = TestClient(app)
+        names = treasure_names(other_client)
+        assert "new-treasure" not in names
+        assert "replica-treasure" in names
+
+    def test_failed_writes_do_not_pin_reads(self, client, replica_set):
+        response = client.patch("/api/treasures/500", json={"cost_at_auction": 1})
+        assert response.status_code == 404
+        assert main.PRIMARY_READS_COOKIE not in response.cookies
+        assert "replica-treasure" in treasure_names(client)
+
+    def test_no_cookie_without_replicas(self, client):
+        response = client.patch("/api/treasures/1", json={"cost_at_auction": 1})
+        assert response.status_code == 200
+        assert main.PRIMARY_READS_COOKIE not in response.cookies
+
+    def test_reads_fall_back_to_primary_when_replica_is_down(self, client, monkeypatch):
+        """
+        Test verifies:
+        - reads succeed from the primary when the replica cannot be reached
+        - the replica is then skipped until it is retried
+        """
+        down = Replica("down", replica_pool("nowhere", port=1))
+        replica_set = ReplicaSet(pool, [down], retry_after=60)
+        monkeypatch.setattr(main, "replicas", replica_set)
+
+        response = client.get("/api/treasures")
+        assert response.status_code == 200
+        assert "treasure-a" in treasure_names(client)
+        assert not down.healthy
+        assert replica_set.choose() is None
+
+        down.unhealthy_until = 0
+        assert replica_set.choose() is down
+
+
+class TestReplicaSet:
+    def test_parse_replicas_defaults_port_and_database(self, monkeypatch):
+        monkeypatch.setenv("PG_PORT", "5432")
+        monkeypatch.setenv("PG_DATABASE", "primary")
+        assert parse_replicas(" replica-a:5433/other, replica-b ,") == [
+            ("replica-a", 5433, "other"),
+            ("replica-b", 5432, "primary"),
+        ]
+        assert parse_replicas("") == []
+
+    def test_choose_takes_turns_and_prefers_least_busy(self, replica_database):
+        first = Replica("first", replica_pool(replica_database))
+        second = Replica("second", replica_pool(replica_database))
+        replica_set = ReplicaSet(pool, [first, second])
+        try:
+            assert {replica_set.choose().name for _ in range(4)} == {"first", "second"}
+
+            owner, conn = replica_set.acquire_read()
+            busy = first if owner is first.pool else second
+            assert all(replica_set.choose() is not busy for _ in range(4))
+            replica_set.release(owner, conn)
+            assert busy.healthy
+        finally:
+            replica_set.close()
@@ -0,0 +1,409 @@
+'''This module contains the test suite for the database schema
+built by `seed_db` for the `Cat's Rare Treasures` FastAPI app.'''
+from main import (
+    Colour, Order, SortBy, TreasureFilters, keyset_segments, select_treasures_query, search_treasures_query,
+    search_tsquery, like_prefix,
+)
+from fastapi.testclient import TestClient
+from main import app
+from db.connection import connect_to_db
+from db.seed import seed_db, iter_json_array, iter_copy_chunks, TREASURES_INDEXES
+from db.partitioning import Partitioning
+from db.shop_stock import check_shop_stock
+from pg8000.native import literal
+import json
+import os
+import pytest
+import re
+import shutil
+
+
+scale = pytest.mark.skipif(
+    not os.getenv("RUN_SCALE_TESTS"),
+    reason="seeds a million rows; set RUN_SCALE_TESTS=1 to run"
+)
+
+
+@pytest.fixture(scope="module")
+def million_treasures():
+    '''Seeds the test database, with a plain `treasures` table, and tops it up
+    to 1M synthetic rows.'''
+    seed_db(env='test', partition_by='')
+    db = connect_to_db()
+    db.run("""
+        INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
+        SELECT
+            'synthetic-' || n,
+            (ARRAY['turquoise', 'mikado', 'ivory', 'onyx', 'carmine', 'cobalt', 'magenta',
+                   'gold', 'azure', 'silver', 'khaki', 'saffron', 'burgundy'])[1 + n % 13],
+            n % 500,
+            (n % 100000) / 100.0,
+            1 + n % 11
+        FROM generate_series(1, 1000000 - (SELECT COUNT(*) FROM treasures)) AS n
+    """)
+    db.run("ANALYZE treasures")
+    yield db
+    db.close()
+    seed_db(env='test')
+
+
+def explain(db, query, **params):
+    '''Returns the nodes of the query plan as a flat list of dicts.'''
+    plan = db.run(f"EXPLAIN (FORMAT JSON) {query}", **params)[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return explain_nodes(plan)
+
+
+def explain_nodes(plan):
+    nodes = []
+    pending = [plan[0]["Plan"]]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending += node.get("Plans", [])
+    return nodes
+
+
+def scans_of(nodes, relation):
+    return [node["Node Type"] for node in nodes if node.get("Relation Name") == relation]
+
+
+class TestBulkLoad:
+    @pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+    def test_iter_json_array_streams_same_rows_as_json_load(self, chunk_size):
+        for env, key in [("test", "shops"), ("test", "treasures"), ("dev", "treasures")]:
+            path = f"data/{env}-data/{key}.json"
+            with open(path) as file:
+                expected = json.load(file)[key]
+            assert list(iter_json_array(path, key, chunk_size=chunk_size)) == expected
+
+    def test_iter_copy_chunks_escapes_text_format(self):
+        rows = [("tab\there", None, 3), ("back\\slash\nnewline", "", 4.5)]
+        assert list(iter_copy_chunks(rows, rows_per_chunk=1)) == [
+            "tab\\there\t\\N\t3\n",
+            "back\\\\slash\\nnewline\t\t4.5\n",
+        ]
+
+    def test_seed_db_round_trips_rows_through_copy(self):
+        seed_db(env="test")
+        db = connect_to_db()
+        treasures = db.run("SELECT treasure_name, colour, age, cost_at_auction FROM treasures ORDER BY treasure_id")
+        constraints = db.run("SELECT conname FROM pg_constraint WHERE conrelid = 'treasures'::regclass")
+        db.close()
+        with open("data/test-data/treasures.json") as file:
+            expected = json.load(file)["treasures"]
+        assert treasures == [
+            [row["treasure_name"], row["colour"], row["age"], float(row["cost_at_auction"])] for row in expected
+        ]
+        assert ["treasures_shop_id_fkey"] in constraints
+
+
+@pytest.fixture()
+def seed_files(tmp_path, monkeypatch):
+    '''Copies the test data to `data/incremental-data` under a temporary
+    working directory and seeds it; reseeds the test data afterwards.'''
+    shutil.copytree("data/test-data", tmp_path / "data" / "incremental-data")
+    monkeypatch.chdir(tmp_path)
+    seed_db(env="incremental")
+    yield tmp_path / "data" / "incremental-data"
+    monkeypatch.undo()
+    seed_db(env="test")
+
+
+def edit_seed_file(directory, key, edit):
+    path = directory / f"{key}.json"
+    data = json.loads(path.read_text())
+    edit(data[key])
+    path.write_text(json.dumps(data, indent=2))
+
+
+def seeded_rows(db):
+    '''Returns the seeded rows by their natural keys, with each treasure's
+    row version.'''
+    shops = db.run("SELECT shop_name, owner, slogan FROM shops ORDER BY shop_name")
+    treasures = db.run("""
+        SELECT treasure_id, treasure_name, colour, age, cost_at_auction, shop_name, treasures.xmin::TEXT
+        FROM treasures LEFT JOIN shops USING (shop_id)
+        ORDER BY treasure_id
+    """)
+    return shops, {row[0]: row[1:] for row in treasures}
+
+
+def contents(treasures):
+    '''Returns the seeded treasures from `seeded_rows` without their ids.'''
+    return sorted(tuple(row[:-1]) for row in treasures.values())
+
+
+def data_version(db):
+    return db.run("SELECT version FROM data_version")[0][0]
+
+
+class TestIncrementalSeed:
+    def test_unchanged_files_are_a_no_op(self, seed_files, capsys):
+        db = connect_to_db()
+        before = seeded_rows(db), data_version(db)
+        capsys.readouterr()
+        seed_db(env="incremental", incremental=True)
+        assert "nothing to seed" in capsys.readouterr().out
+        assert (seeded_rows(db), data_version(db)) == before
+        db.close()
+
+    def test_only_changed_rows_are_written(self, seed_files, capsys):
+        """
+        Test verifies, after removing the first treasure, editing one, moving
+        some to a new shop, and editing, adding and removing shops:
+        - only the treasures that changed are written, and the others keep
+          their `treasure_id` and are not rewritten
+        - an edited treasure is updated in place
+        - the result has the same rows as a full seed of the same files
+        - the `shop_stock` summary and `data_version` follow the changes
+        """
+        db = connect_to_db()
+        (_, before), version = seeded_rows(db), data_version(db)
+        removed_shop = json.loads((seed_files / "shops.json").read_text())["shops"][1]["shop_name"]
+        moved = {id for id, row in before.items() if row[4] == removed_shop}
+
+        def edit_shops(shops):
+            shops[0]["slogan"] = "Under new management"
+            shops.append({"shop_name": "pop-up", "owner": "Nova", "slogan": "Here today"})
+            del shops[1]
+
+        def edit_treasures(treasures):
+            for treasure in treasures:
+                if treasure["shop"] == removed_shop:
+                    treasure["shop"] = "pop-up"
+            treasures[2]["cost_at_auction"] = "99.50"
+            del treasures[0]
+
+        edit_seed_file(seed_files, "treasures", edit_treasures)
+        edit_seed_file(seed_files, "shops", edit_shops)
+        capsys.readouterr()
+        seed_db(env="incremental", incremental=True)
+        shops, after = seeded_rows(db)
+
+        assert moved and 1 not in moved and 3 not in moved
+        assert (
+            f"`treasures`: {len(moved)} inserted, 1 updated and {len(moved) + 1} deleted rows"
+            in capsys.readouterr().out
+        )
+        assert 1 not in after and not moved & set(after)
+        assert after[3][3] == 99.5 and after[3][-1] != before[3][-1]
+        assert all(after[id] == before[id] for id in set(before) - moved - {1, 3})
+        assert data_version(db) > version
+        assert check_shop_stock(db) == []
+
+        seed_db(env="incremental")
+        rebuilt_shops, rebuilt = seeded_rows(db)
+        assert shops == rebuilt_shops
+        assert contents(after) == contents(rebuilt)
+        db.close()
+
+    def test_writes_since_the_last_seed_are_reverted(self, seed_files):
+        db = connect_to_db()
+        before, treasures = seeded_rows(db)
+        db.run("UPDATE shops SET owner = 'Someone else' WHERE shop_id = 1")
+        db.run("INSERT INTO treasures (treasure_name, shop_id) VALUES ('posted', 1)")
+        db.run("UPDATE treasures SET age = 999 WHERE treasure_id = 4")
+        db.run("DELETE FROM treasures WHERE treasure_id = 5")
+
+        seed_db(env="incremental", incremental=True)
+        shops, reverted = seeded_rows(db)
+        assert shops == before
+        assert contents(reverted) == contents(treasures)
+        assert reverted[4][:-1] == treasures[4][:-1] and 5 not in reverted
+        db.close()
+
+    def test_unseeded_database_gets_a_full_seed(self, seed_files, capsys):
+        db = connect_to_db()
+        db.run("DROP TABLE seed_state")
+        capsys.readouterr()
+        seed_db(env="incremental", incremental=True)
+        assert "Seeding Database..." in capsys.readouterr().out
+        assert db.run("SELECT env FROM seed_state") == [["incremental"]]
+        db.close()
+
+    def test_another_partitioning_gets_a_full_seed(self, seed_files, capsys):
+        capsys.readouterr()
+        seed_db(env="incremental", incremental=True, partition_by="hash:shop_id")
+        assert "Seeding Database... (treasures partitioned by hash:shop_id:8)" in capsys.readouterr().out
+        seed_db(env="incremental", incremental=True, partition_by="hash:shop_id:8")
+        assert "nothing to seed" in capsys.readouterr().out
+
+
+class TestPartitioning:
+    def test_parse_layouts(self):
+        assert Partitioning.parse("") is None
+        assert str(Partitioning.parse("LIST:colour")) == "list:colour"
+        assert str(Partitioning.parse("hash:shop_id")) == "hash:shop_id:8"
+        assert Partitioning.parse("hash:colour:16").partitions == 16
+        for spec in ["range:colour", "list:shop_id", "hash:age", "list:colour:4", "hash:shop_id:0", "hash:shop_id:many"]:
+            with pytest.raises(ValueError):
+                Partitioning.parse(spec)
+
+    def test_list_layout_leaves_out_indexes_leading_with_colour(self):
+        assert len(Partitioning.parse("hash:colour").indexes(TREASURES_INDEXES)) == len(TREASURES_INDEXES)
+        by_colour = Partitioning.parse("list:colour").indexes(TREASURES_INDEXES)
+        assert len(by_colour) == len(TREASURES_INDEXES) - 3
+        assert not any("(colour," in index for index in by_colour)
+
+
+@pytest.fixture(scope="class", params=["list:colour", "hash:colour", "hash:shop_id"])
+def partitioned_treasures(request):
+    '''Seeds the test database with `treasures` laid out as each partitioned
+    layout in turn; reseeds it as configured afterwards.'''
+    seed_db(env="test", partition_by=request.param)
+    yield request.param
+    seed_db(env="test")
+
+
+def partitions_scanned(nodes):
+    return {node["Relation Name"] for node in nodes if node.get("Relation Name", "").startswith("treasures_")}
+
+
+def listing_query(filters):
+    predicate, order_by = keyset_segments(SortBy.age.value, Order.asc, None)[0]
+    return select_treasures_query(predicate, order_by, filters.conditions()), {"limit": 51, **filters.params()}
+
+
+@pytest.mark.usefixtures("partitioned_treasures")
+class TestPartitionedTreasures:
+    @pytest.mark.parametrize("column, filters", [
+        ("colour", TreasureFilters(colour=Colour.gold)),
+        ("shop_id", TreasureFilters(shop_id=[3])),
+    ], ids=["colour", "shop"])
+    def test_filter_on_the_partition_column_reads_one_partition(self, partitioned_treasures, column, filters):
+        """
+        Test verifies, for a listing planned for its bound parameters:
+        - a filter on the partition column only reads the partition holding the value
+        - a filter on another column reads every partition
+        """
+        query, params = listing_query(filters)
+        db = connect_to_db()
+        scanned = partitions_scanned(explain(db, query, **params))
+        db.close()
+        if column == partitioned_treasures.split(":")[1]:
+            assert len(scanned) == 1
+        else:
+            assert len(scanned) > 1
+
+    def test_generic_plan_prunes_colour_partitions(self, partitioned_treasures):
+        """
+        Test verifies, for the colour-filtered listing prepared with a generic
+        plan, as the app's prepared statements end up with:
+        - the other partitions are pruned when the executor starts
+        """
+        if not partitioned_treasures.endswith("colour"):
+            pytest.skip("treasures are not partitioned by colour")
+        query, params = listing_query(TreasureFilters(colour=Colour.gold))
+        names = list(dict.fromkeys(re.findall(r"(?<!:):(\w+)", query)))
+        prepared = re.sub(r"(?<!:):(\w+)", lambda match: f"${names.index(match.group(1)) + 1}", query)
+        db = connect_to_db()
+        db.run(f"PREPARE partitioned_listing AS {prepared}")
+        db.run("SET plan_cache_mode = force_generic_plan")
+        arguments = ", ".join(literal(params[name]) for name in names)
+        plan = db.run(f"EXPLAIN (FORMAT JSON) EXECUTE partitioned_listing ({arguments})")[0][0]
+        nodes = explain_nodes(json.loads(plan) if isinstance(plan, str) else plan)
+        partitions = db.run("SELECT COUNT(*) FROM pg_inherits WHERE inhparent = 'treasures'::regclass")[0][0]
+        db.close()
+        assert len(partitions_scanned(nodes)) == 1
+        assert [node["Subplans Removed"] for node in nodes if "Subplans Removed" in node] == [partitions - 1]
+
+    def test_endpoints_work_on_partitioned_treasures(self, db_transaction):
+        """
+        Test verifies, on every partitioned layout:
+        - a posted treasure is stored in the partition for its colour or shop
+        - its price can be updated and it can be deleted by `treasure_id`
+        - the listings and the `shop_stock` summary follow the writes
+        """
+        client = TestClient(app)
+        new = {"treasure_name": "partitioned", "colour": "gold", "age": 3, "cost_at_auction": 7.5, "shop_id": 2}
+        response = client.post("/api/treasures", json=new)
+        assert response.status_code == 201
+        treasure_id = response.json()["treasure"]["treasure_id"]
+        partition = db_transaction.run(
+            "SELECT tableoid::regclass::TEXT FROM treasures WHERE treasure_id = :treasure_id", treasure_id=treasure_id
+        )[0][0]
+        assert partition.startswith("treasures_") and partition != "treasures_default"
+
+        response = client.patch(f"/api/treasures/{treasure_id}", json={"cost_at_auction": 70.0})
+        assert response.json()["treasure"] == {**new, "cost_at_auction": 70.0, "treasure_id": treasure_id}
+        listed = client.get("/api/treasures?colour=gold").json()["treasures"]
+        assert [treasure["cost_at_auction"] for treasure in listed if treasure["treasure_id"] == treasure_id] == [70.0]
+        assert check_shop_stock(db_transaction) == []
+
+        assert client.delete(f"/api/treasures/{treasure_id}").status_code == 204
+        assert client.delete(f"/api/treasures/{treasure_id}").status_code == 404
+        assert client.get("/api/shops").status_code == 200
+        assert check_shop_stock(db_transaction) == []
+
+
+@scale
+class TestTreasuresIndexes:
+    @pytest.mark.parametrize("sort_by", list(SortBy))
+    @pytest.mark.parametrize("order", list(Order))
+    @pytest.mark.parametrize("colour", [None, Colour.gold])
+    @pytest.mark.parametrize("plan_cache_mode", ["force_custom_plan", "force_generic_plan"])
+    def test_paginated_listing_uses_index_scan(self, million_treasures, sort_by, order, colour, plan_cache_mode):
+        """
+        Test verifies, for every query shape `get_all_treasures` prepares
+        (first page and a deep page), planned for the bound parameters or generically:
+        - the treasures table is read through an index
+        - no full sort of the table is needed
+        """
+        million_treasures.run(f"SET plan_cache_mode = {plan_cache_mode}")
+        deep_page = {
+            SortBy.age: (250, 500000),
+            SortBy.cost_at_auction: (500.0, 500000),
+            SortBy.treasure_name: ("synthetic-500000", 500000),
+        }[sort_by]
+        for after in [None, deep_page]:
+            predicate, order_by = keyset_segments(sort_by.value, order, after)[0]
+            filters = TreasureFilters(colour=colour)
+            query = select_treasures_query(predicate, order_by, filters.conditions())
+            params = {"limit": 51, **filters.params()}
+            if after:
+                params["after_value"], params["after_id"] = after
+            nodes = explain(million_treasures, query, **params)
+            assert scans_of(nodes, "treasures") == ["Index Scan"]
+            assert not any(node["Node Type"] == "Sort" for node in nodes)
+
+    def test_colour_filter_uses_index(self, million_treasures):
+        predicate, order_by = keyset_segments(SortBy.age.value, Order.asc, None)[0]
+        million_treasures.run("RESET plan_cache_mode")
+        filters = TreasureFilters(colour=Colour.gold)
+        query = select_treasures_query(predicate, order_by, filters.conditions())
+        nodes = explain(million_treasures, query, limit=None, **filters.params())
+        assert "Seq Scan" not in scans_of(nodes, "treasures")
+        assert any(node.get("Index Name") == "treasures_colour_age_idx" for node in nodes)
+
+    @pytest.mark.parametrize("sort_by", list(SortBy))
+    @pytest.mark.parametrize("filters", [
+        {"min_age": 100, "max_age": 110},
+        {"min_cost": 10, "max_cost": 20},
+        {"shop_id": [3]},
+        {"shop_id": [3, 7], "max_age": 5},
+        {"shop_id": [3], "min_cost": 10, "max_cost": 20},
+    ], ids=["age", "cost", "shop", "shops-age", "shop-cost"])
+    @pytest.mark.parametrize("plan_cache_mode", ["force_custom_plan", "force_generic_plan"])
+    def test_range_and_shop_filters_use_indexes(self, million_treasures, sort_by, filters, plan_cache_mode):
+        """
+        Test verifies, for selective range and shop filters in every sort order,
+        planned for the bound parameters or generically:
+        - the treasures table is never read sequentially
+        """
+        million_treasures.run(f"SET plan_cache_mode = {plan_cache_mode}")
+        filters = TreasureFilters(**filters)
+        predicate, order_by = keyset_segments(sort_by.value, Order.asc, None)[0]
+        query = select_treasures_query(predicate, order_by, filters.conditions())
+        nodes = explain(million_treasures, query, limit=51, **filters.params())
+        assert scans_of(nodes, "treasures")
+        assert "Seq Scan" not in scans_of(nodes, "treasures")
+
+    def test_name_search_uses_full_text_index(self, million_treasures):
+        million_treasures.run("RESET plan_cache_mode")
+        q = "synthetic-123456"
+        params = {"tsquery": search_tsquery(q), "name": q.lower(), "name_prefix": like_prefix(q.lower()), "limit": 51}
+        nodes = explain(million_treasures, search_treasures_query(), **params)
+        assert "Seq Scan" not in scans_of(nodes, "treasures")
+        assert any(node.get("Index Name") == "treasures_treasure_name_search_idx" for node in nodes)
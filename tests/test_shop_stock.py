@@ -0,0 +1,75 @@
+'''This module contains the test suite for the `shop_stock` summary
+maintained for `GET /api/shops` in the `Cat's Rare Treasures` FastAPI app.'''
+from fastapi.testclient import TestClient
+from main import app
+from db.connection import pool
+from db.shop_stock import check_shop_stock
+from decimal import Decimal
+import pytest
+
+
+pytestmark = pytest.mark.usefixtures("db_transaction")
+
+@pytest.fixture()
+def client():
+    return TestClient(app)
+
+
+class TestShopStock:
+    def test_seeded_summary_is_consistent(self):
+        with pool.connection() as db:
+            assert check_shop_stock(db) == []
+
+    def test_writes_keep_summary_consistent(self, client):
+        """
+        Test verifies that after each write endpoint:
+        - the summary matches a from-scratch recomputation
+        - `/api/shops` reflects the write
+        """
+        client.post("/api/treasures", json={
+            "treasure_name": "new-treasure",
+            "colour": "saffron",
+            "age": 30,
+            "cost_at_auction": 70.99,
+            "shop_id": 1
+        })
+        with pool.connection() as db:
+            assert check_shop_stock(db) == []
+        assert client.get("/api/shops").json()["shops"][0]["stock_value"] == 2492.97
+
+        client.patch("/api/treasures/27", json={"cost_at_auction": 0.02})
+        with pool.connection() as db:
+            assert check_shop_stock(db) == []
+        assert client.get("/api/shops").json()["shops"][0]["stock_value"] == 2422.0
+
+        client.delete("/api/treasures/27")
+        with pool.connection() as db:
+            assert check_shop_stock(db) == []
+        assert client.get("/api/shops").json()["shops"][0]["stock_value"] == 2421.98
+
+    def test_shops_without_treasures_are_not_listed(self, client):
+        with pool.connection() as db:
+            shop_ids = [row[0] for row in db.run("SELECT treasure_id FROM treasures WHERE shop_id = 1")]
+        for treasure_id in shop_ids:
+            client.delete(f"/api/treasures/{treasure_id}")
+        shops = client.get("/api/shops").json()["shops"]
+        assert len(shops) == 10
+        assert all(shop["shop_id"] != 1 for shop in shops)
+
+    def test_moving_treasures_between_shops_updates_both(self):
+        with pool.connection() as db:
+            db.run("UPDATE treasures SET shop_id = 2 WHERE shop_id = 1")
+            assert check_shop_stock(db) == []
+            assert db.run("SELECT treasure_count FROM shop_stock WHERE shop_id = 1") == [[0]]
+
+    def test_check_reports_and_repairs_drift(self):
+        with pool.connection() as db:
+            db.run("UPDATE shop_stock SET stock_value = stock_value + 1, treasure_count = 99 WHERE shop_id = 2")
+            drift = check_shop_stock(db)
+            assert len(drift) == 1
+            assert drift[0]["shop_id"] == 2
+            assert drift[0]["stored_stock_value"] - drift[0]["actual_stock_value"] == Decimal(1)
+            assert drift[0]["stored_treasure_count"] == 99
+
+            assert check_shop_stock(db, repair=True) == drift
+            assert check_shop_stock(db) == []
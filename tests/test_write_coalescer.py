@@ -0,0 +1,113 @@
+'''This module contains the test suite for the write coalescing of
+`POST /api/treasures` in the `Cat's Rare Treasures` FastAPI app.'''
+from fastapi.testclient import TestClient
+from main import app
+import main
+from metrics import metrics
+from write_coalescer import WriteCoalescer
+import asyncio
+import httpx
+import pytest
+
+
+@pytest.fixture()
+def client():
+    return TestClient(app)
+
+
+def new_treasure(name, shop_id=1):
+    return {"treasure_name": name, "colour": "gold", "age": 5, "cost_at_auction": 12.5, "shop_id": shop_id}
+
+
+def post_concurrently(treasures):
+    async def scenario():
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(client.post("/api/treasures", json=treasure) for treasure in treasures))
+
+    return asyncio.run(scenario())
+
+
+def batch_sizes():
+    histogram = metrics.get("write_coalesce_batch_size")
+    return (histogram.count, histogram.sum) if histogram else (0, 0)
+
+
+class TestWriteCoalescer:
+    def test_items_within_the_window_are_flushed_together(self):
+        """
+        Test verifies:
+        - items submitted within the window reach `flush` as one batch, in order
+        - a full batch is flushed without waiting for the window
+        - each caller gets its own result or exception
+        """
+        batches = []
+
+        async def flush(items):
+            batches.append(items)
+            return [ValueError(item) if item == "bad" else item.upper() for item in items]
+
+        coalescer = WriteCoalescer(flush, window=0.05, max_batch=3)
+
+        async def scenario():
+            return await asyncio.gather(
+                *(coalescer.submit(item) for item in ["a", "bad", "c", "d"]), return_exceptions=True
+            )
+
+        results = asyncio.run(scenario())
+        assert batches == [["a", "bad", "c"], ["d"]]
+        assert results[0] == "A" and results[2] == "C" and results[3] == "D"
+        assert isinstance(results[1], ValueError)
+
+    def test_failed_flush_fails_every_item(self):
+        async def flush(items):
+            raise RuntimeError("database is down")
+
+        coalescer = WriteCoalescer(flush, window=0.01)
+
+        async def scenario():
+            return await asyncio.gather(coalescer.submit(1), coalescer.submit(2), return_exceptions=True)
+
+        assert all(isinstance(result, RuntimeError) for result in asyncio.run(scenario()))
+
+    def test_disabled_by_default(self):
+        assert not main.treasure_writes.enabled
+
+
+@pytest.mark.usefixtures("db_transaction")
+class TestCoalescedPosts:
+    @pytest.fixture(autouse=True)
+    def coalescing(self, monkeypatch):
+        monkeypatch.setattr(main, "treasure_writes", WriteCoalescer(main.insert_coalesced_treasures, window=0.05))
+
+    def test_concurrent_posts_are_inserted_together(self, client):
+        """
+        Test verifies:
+        - every request gets a 201 with its own new treasure
+        - the treasures were inserted in one batch
+        """
+        count, total = batch_sizes()
+        treasures = [new_treasure(f"coalesced-{n}", shop_id=1 + n % 11) for n in range(10)]
+        responses = post_concurrently(treasures)
+
+        assert [response.status_code for response in responses] == [201] * 10
+        created = [response.json()["treasure"] for response in responses]
+        for treasure, sent in zip(created, treasures):
+            assert {key: treasure[key] for key in sent} == sent
+        assert sorted(treasure["treasure_id"] for treasure in created) == list(range(27, 37))
+        assert batch_sizes() == (count + 1, total + 10)
+
+        names = {treasure["treasure_name"] for treasure in client.get("/api/treasures").json()["treasures"]}
+        assert {treasure["treasure_name"] for treasure in treasures} <= names
+
+    def test_a_failing_item_only_fails_its_own_request(self, client):
+        fallbacks = metrics.get("write_coalesce_fallbacks_total") or 0
+        responses = post_concurrently([
+            new_treasure("kept-1"), new_treasure("orphan", shop_id=999), new_treasure("kept-2")
+        ])
+
+        assert [response.status_code for response in responses] == [201, 500, 201]
+        assert responses[1].json() == {"detail": "Server error: logged for investigation"}
+        assert metrics.get("write_coalesce_fallbacks_total") == fallbacks + 1
+        names = {treasure["treasure_name"] for treasure in client.get("/api/treasures").json()["treasures"]}
+        assert {"kept-1", "kept-2"} <= names and "orphan" not in names
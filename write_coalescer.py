@@ -0,0 +1,102 @@
+'''This module merges concurrent single-row writes of the `Cat's Rare
+Treasures` FastAPI app into batches, so that heavy ingestion pays for one
+connection, one statement and one commit per batch instead of per item.
+
+A `WriteCoalescer` collects the items submitted within `window` seconds of
+the first one, or until `max_batch` items have arrived, and hands them to
+its `flush` coroutine together. `flush` returns one result or exception per
+item, in order, and each `submit` call receives its own. A `window` of `0`
+disables coalescing.
+'''
+from metrics import metrics, SIZE_BUCKETS
+import asyncio
+import time
+import weakref
+import os
+
+
+class Batch:
+    def __init__(self):
+        self.items = []
+        self.futures = []
+        self.queued_at = []
+        self.timer = None
+
+    def add(self, item, future):
+        self.items.append(item)
+        self.futures.append(future)
+        self.queued_at.append(time.perf_counter())
+
+
+class WriteCoalescer:
+    def __init__(self, flush, window=0.0, max_batch=100):
+        if window < 0 or max_batch < 1:
+            raise ValueError("WriteCoalescer limits must satisfy window >= 0 and max_batch >= 1")
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        # asyncio primitives belong to one event loop; the tests start several.
+        self._open = weakref.WeakKeyDictionary()
+        self._flushing = set()
+
+    @classmethod
+    def from_env(cls, flush):
+        return cls(
+            flush,
+            window=float(os.getenv("WRITE_COALESCE_MS", 0)) / 1000,
+            max_batch=int(os.getenv("WRITE_COALESCE_MAX_BATCH", 100)),
+        )
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    async def submit(self, item):
+        '''Queues `item` for the next batch and returns its result, or raises
+        its exception, once the batch has been flushed.'''
+        loop = asyncio.get_running_loop()
+        batch = self._open.get(loop)
+        if batch is None:
+            batch = self._open[loop] = Batch()
+            batch.timer = loop.call_later(self.window, self._close, loop, batch)
+        future = loop.create_future()
+        batch.add(item, future)
+        if len(batch.items) >= self.max_batch:
+            self._close(loop, batch)
+        # The caller may go away, but the batch is written regardless.
+        return await asyncio.shield(future)
+
+    async def drain(self):
+        '''Flushes the open batch now and waits for every batch in flight.'''
+        loop = asyncio.get_running_loop()
+        batch = self._open.get(loop)
+        if batch is not None:
+            self._close(loop, batch)
+        await asyncio.gather(*(task for task in self._flushing if task.get_loop() is loop), return_exceptions=True)
+
+    def _close(self, loop, batch):
+        if self._open.get(loop) is batch:
+            del self._open[loop]
+        batch.timer.cancel()
+        task = loop.create_task(self._flush(batch))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        metrics.observe("write_coalesce_batch_size", len(batch.items), buckets=SIZE_BUCKETS)
+        for queued_at in batch.queued_at:
+            metrics.observe("write_coalesce_queue_duration_seconds", started - queued_at)
+        try:
+            results = await self.flush(batch.items)
+        except Exception as exc:
+            results = [exc] * len(batch.items)
+        except BaseException:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        for future, result in zip(batch.futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)